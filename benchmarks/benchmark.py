@@ -0,0 +1,432 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the Raspberry Pi demo app.  They run on any Linux box - no
+# sensors, no display and no internet connection needed.  RPIDemoApp.py is
+# imported with a simulated I2C bus and display standing in for the hardware,
+# and it talks to the local broker in localbroker.py instead of
+# mqtt.gigabits.io.
+#
+# The stages we time are:
+#   status_cycle     one whole sendStatus: read, convert, encode and publish
+#   on_message       handling one command from the server
+#   on_message_batch handling a batch of 8 commands in one message
+#   connect          connecting a fresh client to the broker
+#   reconnect        reconnecting a client that just disconnected
+#   encode_record    json.dumps of one sensorVals record
+#   compress_record  compressing that JSON with the zlib preset dictionary.
+#                    The result also records the plain and compressed sizes.
+#   series_json      json.dumps of a batch of 60 samples for every sensor
+#   series_columnar  encodeSeries of the same batch.  Both record the payload
+#                    size, and the columnar batch is decoded again to make
+#                    sure it survives the trip.
+#   interrupt_event  from an edge on the proximity sensor's simulated INT line
+#                    to its reading being published and the sensor re-armed.
+#                    Records the bus transactions that took.
+#   dashboard_frame  one dashboard frame in which every reading changed, so
+#                    every field is drawn and every page sent.  Records the
+#                    bytes sent to the display.
+#
+# The sensors make us wait for their conversions (0.5 s for the HCPA and the
+# MPL115A2).  That's time the hardware takes, not time we spend, so those
+# waits are skipped here.
+#
+# Results are written as JSON.  Give --compare a previous result file to
+# check for regressions.  Any stage whose median got slower by more than
+# --threshold (10% by default) is reported, and the exit status is 1.
+#
+#     python3 benchmark.py --output baseline.json
+#     ... change something ...
+#     python3 benchmark.py --output new.json --compare baseline.json
+
+import argparse
+import contextlib
+import importlib.util
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import threading
+import time
+import types
+from pathlib import Path
+
+import paho.mqtt.client as mqtt
+
+from localbroker import LocalBroker
+
+REPO_DIR = Path(__file__).parent.absolute().parent
+APP_PATH = REPO_DIR / "examples" / "RPIDemoApp" / "RPIDemoApp.py"
+DEVKEY = "benchmarkDevkey0000001"
+
+# A stand-in for smbus2.SMBus.  Every read returns the same plausible bytes
+# for a given device, with a little deterministic noise so the values aren't
+# completely flat.  Like smbus2, and unlike python-smbus, read_i2c_block_data
+# has no default length, so a read that leaves it out fails here too.
+class SimulatedBus:
+    def __init__(self, bus=1):
+        self.random = random.Random(bus)
+        self.transactions = 0
+
+    def write_byte(self, addr, value):
+        self.transactions += 1
+
+    def write_byte_data(self, addr, reg, value):
+        self.transactions += 1
+
+    def write_word_data(self, addr, reg, value):
+        self.transactions += 1
+
+    def write_i2c_block_data(self, addr, reg, data):
+        self.transactions += 1
+
+    def read_i2c_block_data(self, addr, reg, length):
+        self.transactions += 1
+        data = [(addr * 7 + reg * 13 + i * 29) & 0xFF for i in range(length)]
+        if length > 1:
+            data[1] = self.random.randrange(256)
+        return data
+
+# The display's end of the I2C bus.  It counts the bytes sent to it.
+class SimulatedI2CDevice:
+    def __init__(self):
+        self.bytesWritten = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def write(self, data):
+        self.bytesWritten += len(data)
+
+# A stand-in for the SSD1306 display.  It remembers what it was told and
+# that's all.
+class SimulatedDisplay:
+    def __init__(self, width=128, height=32, i2c=None, addr=0x3C, reset=None):
+        self.width = width
+        self.height = height
+        self.buffer = bytearray(width * height // 8)
+        self.shows = 0
+        self.i2c_device = SimulatedI2CDevice()
+
+    def write_cmd(self, cmd):
+        self.i2c_device.write(bytes([0x80, cmd]))
+
+    def fill(self, color):
+        self.buffer[:] = bytes([0xFF if color else 0]) * len(self.buffer)
+
+    def show(self):
+        self.shows += 1
+
+    def invert(self, invert):
+        pass
+
+# Put simulated versions of the hardware modules where the app's imports
+# will find them.
+def installSimulatedHardware():
+    smbus = types.ModuleType("smbus")
+    smbus.SMBus = SimulatedBus
+    board = types.ModuleType("board")
+    board.D4 = 4
+    board.SCL = 3
+    board.SDA = 2
+    busio = types.ModuleType("busio")
+    busio.I2C = lambda scl, sda: None
+    digitalio = types.ModuleType("digitalio")
+    digitalio.DigitalInOut = lambda pin: pin
+    ssd1306 = types.ModuleType("adafruit_ssd1306")
+    ssd1306.SSD1306_I2C = SimulatedDisplay
+    for module in (smbus, board, busio, digitalio, ssd1306):
+        sys.modules[module.__name__] = module
+
+# time.sleep that doesn't, for skipping the sensor conversion waits.
+class NoSleepTime:
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    def sleep(self, seconds):
+        pass
+
+def loadApp(broker):
+    os.environ["MQTT_BROKER"] = "127.0.0.1"
+    os.environ["MQTT_PORT"] = str(broker.port)
+    os.environ["MQTT_DEVKEY"] = DEVKEY
+    os.environ["MQTT_PASSWORD"] = "benchmark"
+    installSimulatedHardware()
+
+    spec = importlib.util.spec_from_file_location("RPIDemoApp", APP_PATH)
+    app = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(app)
+    app.time = NoSleepTime()
+    app.bus = app.GuardedBus(SimulatedBus(), app.I2C_TIMEOUT)
+    # metrics go out once a minute; keep them out of the measurements
+    app.METRICS_PERIOD = float("inf")
+    return app
+
+# Connect a client the way the app does and wait for the CONNACK.
+def connectClient(broker, clientId=DEVKEY):
+    connected = threading.Event()
+    client = mqtt.Client(client_id=clientId)
+    client.username_pw_set(username=clientId, password="benchmark")
+    client.on_connect = lambda client, data, flags, rc: connected.set()
+    client.connect("127.0.0.1", broker.port)
+    while not connected.is_set():
+        client.loop(0.01)
+    return client, connected
+
+# Run fn warmup + iterations times and return the durations of the timed
+# iterations in microseconds.
+def measure(fn, iterations, warmup):
+    for i in range(warmup):
+        fn()
+    samples = []
+    for i in range(iterations):
+        start = time.perf_counter_ns()
+        fn()
+        samples.append((time.perf_counter_ns() - start) / 1000.0)
+    return samples
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        "unit": "us",
+        "n": len(samples),
+        "median": round(statistics.median(samples), 3),
+        "mean": round(statistics.fmean(samples), 3),
+        "p90": round(samples[int(0.9 * (len(samples) - 1))], 3),
+        "min": round(samples[0], 3),
+        "max": round(samples[-1], 3),
+    }
+
+def benchStatusCycle(app, iterations):
+    def cycle():
+        # empty the cache so every cycle really goes to the (simulated) bus
+        app.sensorCache.entries.clear()
+        app.sendStatus({})
+    return measure(cycle, iterations, iterations // 10)
+
+def benchOnMessage(app, iterations):
+    msg = mqtt.MQTTMessage(topic=("server/%s/command"%(DEVKEY)).encode())
+    msg.payload = json.dumps({"si": app.OLED_INVERT_COMMAND_IDX, "c": "1"}).encode()
+    def handle():
+        app.on_message(app.client, None, msg)
+    return measure(handle, iterations, iterations // 10)
+
+def benchOnMessageBatch(app, iterations):
+    msg = mqtt.MQTTMessage(topic=("server/%s/command"%(DEVKEY)).encode())
+    msg.payload = json.dumps([{"si": str(10 + i), "c": "1"} for i in range(8)]).encode()
+    def handle():
+        app.on_message(app.client, None, msg)
+    return measure(handle, iterations, iterations // 10)
+
+def benchConnect(broker, iterations):
+    def connect():
+        client, connected = connectClient(broker, "benchmarkConnect")
+        client.disconnect()
+    return measure(connect, iterations, 2)
+
+def benchReconnect(broker, iterations):
+    client, connected = connectClient(broker, "benchmarkReconnect")
+    def reconnect():
+        client.disconnect()
+        connected.clear()
+        client.reconnect()
+        while not connected.is_set():
+            client.loop(0.01)
+    samples = measure(reconnect, iterations, 2)
+    client.disconnect()
+    return samples
+
+def benchEncodeRecord(app, iterations):
+    record = sampleRecord(app)
+    def encode():
+        json.dumps(record, separators=(',', ':'))
+    return measure(encode, iterations, iterations // 10)
+
+def sampleRecord(app):
+    record = {}
+    app.sensorCache.entries.clear()
+    for readRoutine, sensorIndices in app.SENSOR_READERS:
+        record.update(app.sensorCache.read(readRoutine, sensorIndices, 0))
+    return record
+
+def benchCompressRecord(app, iterations):
+    data = json.dumps(sampleRecord(app), separators=(',', ':'))
+    compressor = app.PayloadCompressor("zlib")
+    def compress():
+        compressor.encode(data)
+    results = summarize(measure(compress, iterations, iterations // 10))
+    results["rawBytes"] = len(data.encode())
+    results["sentBytes"] = len(compressor.encode(data))
+    return results
+
+# A batch like the one a device sends with batch.maxSamples at 60: a reading
+# every 10 s with a few ms of jitter, slowly drifting decimals for the
+# environmental sensors and noisy 12-bit counts for the rest.
+def sampleBatch(app):
+    generator = random.Random(0)
+    start = 1700000000000
+    times = [start + 10000 * i + generator.randint(-3, 3) for i in range(60)]
+    batch = {}
+    for sensorIndex in app.ALL_SENSOR_INDICES:
+        if sensorIndex in (app.HUMIDITY_SENSOR_IDX, app.TEMPERATURE_SENSOR_IDX, 
+                           app.PRESSURE_SENSOR_IDX):
+            values = [round(50.0 + 0.01 * i + generator.gauss(0, 0.05), 5) for i in range(60)]
+        else:
+            values = [generator.randint(500, 530) for i in range(60)]
+        batch[sensorIndex] = {"t": times, "v": values}
+    return batch
+
+def benchSeriesJson(app, iterations):
+    batch = sampleBatch(app)
+    def encode():
+        json.dumps(batch, separators=(',', ':'))
+    results = summarize(measure(encode, iterations, iterations // 10))
+    results["bytes"] = len(json.dumps(batch, separators=(',', ':')))
+    return results
+
+def benchSeriesColumnar(app, iterations):
+    batch = sampleBatch(app)
+    def encode():
+        app.encodeSeries(batch)
+    results = summarize(measure(encode, iterations, iterations // 10))
+    payload = app.encodeSeries(batch)
+    if app.decodeSeries(payload) != batch:
+        raise AssertionError("columnar batch didn't survive encoding and decoding")
+    results["bytes"] = len(payload)
+    return results
+
+def benchInterruptEvent(app, iterations):
+    app.GPIO_BACKEND = "sim"
+    app.INTERRUPT_HEARTBEAT = 3600.0
+    source = app.INTERRUPT_SOURCES[app.sendProximityData]
+    source.pin = "17"
+    watcher = app.startInterruptSensing()
+    def event():
+        handled = watcher.events
+        watcher.request.trigger(17)
+        while watcher.events == handled:
+            time.sleep(0)
+    results = summarize(measure(event, iterations, iterations // 10))
+    simulated = app.bus.bus
+    before = simulated.transactions
+    event()
+    results["transactions"] = simulated.transactions - before
+
+    watcher.stop()
+    watcher.join()
+    source.pin = None
+    app.interruptRoutines.clear()
+    return results
+
+def benchDashboardFrame(app, iterations):
+    display = SimulatedDisplay()
+    dashboard = app.Dashboard(display, budget=float("inf"))
+    sensorIndices = [field[0] for field in app.DASHBOARD_FIELDS]
+    counter = iter(range(sys.maxsize))
+    def frame():
+        value = next(counter) % 1000
+        for sensorIndex in sensorIndices:
+            app.sensorCache.put(sensorIndex, value)
+        dashboard.frame()
+    results = summarize(measure(frame, iterations, iterations // 10))
+    before = display.i2c_device.bytesWritten
+    frame()
+    results["bytes"] = display.i2c_device.bytesWritten - before
+    return results
+
+def runBenchmarks(iterations):
+    random.seed(0)
+    broker = LocalBroker().start()
+    # the app prints a lot.  That's part of what it costs, so it still
+    # happens, but into a black hole instead of the terminal.
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        app = loadApp(broker)
+        app.client, connected = connectClient(broker)
+        app.client.loop_start()
+        app.client.display = SimulatedDisplay()
+        app.client.display.displayIsOn = False
+
+        results = {
+            "status_cycle": summarize(benchStatusCycle(app, iterations)),
+            "on_message": summarize(benchOnMessage(app, iterations)),
+            "on_message_batch": summarize(benchOnMessageBatch(app, iterations)),
+            "connect": summarize(benchConnect(broker, max(iterations // 10, 5))),
+            "reconnect": summarize(benchReconnect(broker, max(iterations // 10, 5))),
+            "encode_record": summarize(benchEncodeRecord(app, iterations * 10)),
+            "compress_record": benchCompressRecord(app, iterations * 10),
+            "series_json": benchSeriesJson(app, iterations),
+            "series_columnar": benchSeriesColumnar(app, iterations),
+            "interrupt_event": benchInterruptEvent(app, iterations),
+            "dashboard_frame": benchDashboardFrame(app, iterations),
+        }
+
+        app.client.loop_stop()
+        app.client.disconnect()
+    broker.stop()
+    return results
+
+# Return a list of (name, old median, new median) for every metric that got
+# slower by more than threshold (0.10 is 10%).
+def findRegressions(baseline, current, threshold):
+    regressions = []
+    for name, old in baseline["results"].items():
+        new = current["results"].get(name)
+        if new is None:
+            continue
+        if new["median"] > old["median"] * (1.0 + threshold):
+            regressions.append((name, old["median"], new["median"]))
+    return regressions
+
+def printResults(results, baseline=None):
+    print("%-16s %8s %12s %12s %12s"%("benchmark (us)", "n", "median", "p90", "vs baseline"))
+    for name, stats in results["results"].items():
+        change = ""
+        if baseline is not None and name in baseline["results"]:
+            old = baseline["results"][name]["median"]
+            change = "%+.1f%%"%(100.0 * (stats["median"] - old) / old)
+        print("%-16s %8d %12.3f %12.3f %12s"%(name, stats["n"], stats["median"],
+                                              stats["p90"], change))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gigabits demo app benchmarks")
+    parser.add_argument("--iterations", type=int, default=200,
+                        help="timed iterations per benchmark")
+    parser.add_argument("--output", metavar="FILE",
+                        help="write the results to FILE as JSON")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare against an earlier result file")
+    parser.add_argument("--threshold", type=float, default=0.10,
+                        help="allowed slowdown before a regression fails (0.10 is 10%%)")
+    args = parser.parse_args()
+
+    results = {
+        "meta": {
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "platform": platform.platform(),
+            "iterations": args.iterations,
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        },
+        "results": runBenchmarks(args.iterations),
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    printResults(results, baseline)
+
+    if baseline is not None:
+        regressions = findRegressions(baseline, results, args.threshold)
+        for name, old, new in regressions:
+            print("REGRESSION: %s median went from %.3f us to %.3f us"%(name, old, new))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+
+# Fleet throughput for the ingestion service in examples/ingest.  Starts the
+# local broker, an ingestor subscribed to device/+/records, and a fleet of
+# simulated devices that each publish --rate records a second.  The devices
+# are spread over --publishers processes, each with one connection, so the
+# load generator doesn't end up fighting the ingestor for the GIL.
+#
+# While it runs, the ingestor prints its usual report every second.  At the
+# end we print how many messages were sent and stored, and the overall rate.
+#
+#     python3 ingestbench.py --devices 500 --rate 2 --duration 20
+#
+# By default each record is a one-sample JSON batch, which carries the time
+# it was sampled, so the lag is the whole trip from device to database.
+# With --format json they're plain records like an unbatched device sends,
+# and the lag only covers the time from arrival to commit.
+
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import paho.mqtt.client as mqtt
+
+from localbroker import LocalBroker
+
+REPO_DIR = Path(__file__).parent.absolute().parent
+sys.path.insert(0, str(REPO_DIR / "examples" / "ingest"))
+import ingest
+
+SENSOR_INDICES = ("1", "2", "4", "5", "6", "7", "8", "9")
+
+# One publisher process.  It pretends to be devices first .. first+count-1
+# and returns how many records it sent through the queue.
+def publishRecords(port, first, count, rate, duration, recordFormat, sent):
+    generator = random.Random(first)
+    client = mqtt.Client(client_id="fleet%d"%(first))
+    client.connect("127.0.0.1", port)
+    client.loop_start()
+
+    topics = ["device/fleetDevice%06d/records"%(first + i) for i in range(count)]
+    interval = 1.0 / (count * rate)
+    messages = 0
+    start = time.monotonic()
+    nextTime = start
+    while time.monotonic() - start < duration:
+        for topic in topics:
+            now = time.time()
+            if recordFormat == "batch":
+                millis = int(now * 1000)
+                record = {si: {"t": [millis], "v": [round(generator.uniform(0, 100), 2)]}
+                          for si in SENSOR_INDICES}
+            else:
+                record = {si: round(generator.uniform(0, 100), 2) for si in SENSOR_INDICES}
+            client.publish(topic, payload=json.dumps(record, separators=(',', ':')), qos=0)
+            messages += 1
+            nextTime += interval
+            delay = nextTime - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+    # give paho a moment to get the last ones out
+    time.sleep(0.5)
+    client.loop_stop()
+    client.disconnect()
+    sent.put(messages)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingestion fleet benchmark")
+    parser.add_argument("--devices", type=int, default=200)
+    parser.add_argument("--rate", type=float, default=1.0,
+                        help="records per second from each device")
+    parser.add_argument("--duration", type=float, default=10.0, metavar="SECONDS")
+    parser.add_argument("--publishers", type=int, default=2,
+                        help="processes the simulated devices are spread over")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="the ingestor's decoding processes")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--format", choices=("batch", "json"), default="batch")
+    parser.add_argument("--db", help="keep the database here instead of in a temporary directory")
+    args = parser.parse_args()
+
+    broker = LocalBroker().start()
+    with tempfile.TemporaryDirectory() as tempDir:
+        db = args.db or os.path.join(tempDir, "records.db")
+        ingestor = ingest.Ingestor(db, workers=args.workers, batchSize=args.batch_size)
+        ingestor.connect("127.0.0.1", broker.port, "ingestbench")
+        # let the subscription get there before the fleet starts
+        time.sleep(0.5)
+
+        sent = multiprocessing.Queue()
+        perPublisher = max(args.devices // args.publishers, 1)
+        publishers = []
+        for first in range(0, args.devices, perPublisher):
+            count = min(perPublisher, args.devices - first)
+            publisher = multiprocessing.Process(target=publishRecords, args=(
+                broker.port, first, count, args.rate, args.duration, args.format, sent))
+            publisher.start()
+            publishers.append(publisher)
+
+        start = time.monotonic()
+        ingestor.run(args.duration + 1.0, reportPeriod=1.0)
+        totalSent = sum(sent.get() for publisher in publishers)
+        for publisher in publishers:
+            publisher.join()
+        ingestor.drain()
+        elapsed = time.monotonic() - start
+        ingestor.report()
+
+        stats = ingestor.stats
+        print()
+        print("devices %d, sent %d, stored %d messages (%d rows), %d bad"%(
+            args.devices, totalSent, stats.totalMessages, stats.totalRows, stats.totalErrors))
+        print("%.1f msgs/s overall"%(stats.totalMessages / elapsed))
+        ingestor.stop()
+    broker.stop()
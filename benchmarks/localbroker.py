@@ -0,0 +1,420 @@
+#!/usr/bin/env python3
+
+# A small MQTT 3.1.1 and 5 broker that's good enough to stand in for the real
+# one when we're benchmarking on a laptop.  It understands CONNECT, PUBLISH 
+# (QoS 0 and 1), SUBSCRIBE, UNSUBSCRIBE, PINGREQ and DISCONNECT, routes 
+# messages using the + and # wildcards and counts the bytes and messages that
+# go through it.  Version 5 clients can publish with topic aliases (up to
+# TOPIC_ALIAS_MAXIMUM of them) and a message expiry interval, which is passed
+# on to version 5 subscribers, and can make shared subscriptions: a filter 
+# like $share/group/device/+/records gets each message to only one of the 
+# group's subscribers, taking turns.  Other properties are read and ignored.
+# There are no retained messages, no wills, no sessions and no security.
+# Don't put it anywhere near a real network.
+#
+# LocalBroker(v5=False), or --no-v5, turns version 5 clients away the way a
+# 3.1.1 broker does, for trying out clients that fall back.
+#
+# Use it from Python:
+#     broker = LocalBroker()
+#     broker.start()
+#     ... connect to 127.0.0.1:broker.port ...
+#     broker.stop()
+# or run it on its own:
+#     python3 localbroker.py --port 1883
+
+import argparse
+import socket
+import struct
+import threading
+
+CONNECT = 1
+CONNACK = 2
+PUBLISH = 3
+PUBACK = 4
+PUBREC = 5
+PUBREL = 6
+PUBCOMP = 7
+SUBSCRIBE = 8
+SUBACK = 9
+UNSUBSCRIBE = 10
+UNSUBACK = 11
+PINGREQ = 12
+PINGRESP = 13
+DISCONNECT = 14
+
+# the CONNACK return code for a protocol version we don't speak
+REFUSED_PROTOCOL_VERSION = 1
+
+TOPIC_ALIAS_MAXIMUM = 16
+
+# MQTT 5 properties we look at
+MESSAGE_EXPIRY_INTERVAL = 0x02
+TOPIC_ALIAS_MAXIMUM_PROPERTY = 0x22
+TOPIC_ALIAS = 0x23
+
+# How each MQTT 5 property is encoded, so we can step over the ones we don't
+# care about.
+PROPERTY_TYPES = {}
+for ids, kind in (((0x01, 0x17, 0x19, 0x24, 0x25, 0x28, 0x29, 0x2A), "byte"),
+                  ((0x13, 0x21, 0x22, 0x23), "short"),
+                  ((0x02, 0x11, 0x18, 0x27), "int"),
+                  ((0x0B,), "varint"),
+                  ((0x03, 0x08, 0x12, 0x15, 0x1A, 0x1C, 0x1F), "string"),
+                  ((0x09, 0x16), "binary"),
+                  ((0x26,), "pair")):
+    for propertyId in ids:
+        PROPERTY_TYPES[propertyId] = kind
+
+# Does topic match the subscription filter?  Filters may use + for one level
+# and # for everything from there on down.
+def topicMatches(topicFilter, topic):
+    filterLevels = topicFilter.split("/")
+    topicLevels = topic.split("/")
+    for i, level in enumerate(filterLevels):
+        if level == "#":
+            return True
+        if i >= len(topicLevels):
+            return False
+        if level != "+" and level != topicLevels[i]:
+            return False
+    return len(filterLevels) == len(topicLevels)
+
+def encodeLength(length):
+    out = bytearray()
+    while True:
+        byte = length % 128
+        length //= 128
+        if length > 0:
+            byte |= 0x80
+        out.append(byte)
+        if length == 0:
+            return bytes(out)
+
+def encodeString(text):
+    data = text.encode()
+    return struct.pack("!H", len(data)) + data
+
+# Read a variable byte integer.  Returns (value, offset after it).
+def decodeLength(data, offset):
+    multiplier = 1
+    value = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value += (byte & 0x7F) * multiplier
+        multiplier *= 128
+        if not byte & 0x80:
+            return value, offset
+
+# Read an MQTT 5 property block.  Returns ({property id: value}, offset after
+# it, the raw block without its length).
+def decodeProperties(data, offset):
+    length, offset = decodeLength(data, offset)
+    end = offset + length
+    raw = data[offset:end]
+    properties = {}
+    while offset < end:
+        propertyId, offset = decodeLength(data, offset)
+        kind = PROPERTY_TYPES.get(propertyId)
+        if kind == "byte":
+            value = data[offset]
+            offset += 1
+        elif kind == "short":
+            value = struct.unpack_from("!H", data, offset)[0]
+            offset += 2
+        elif kind == "int":
+            value = struct.unpack_from("!I", data, offset)[0]
+            offset += 4
+        elif kind == "varint":
+            value, offset = decodeLength(data, offset)
+        elif kind in ("string", "binary"):
+            size = struct.unpack_from("!H", data, offset)[0]
+            value = data[offset + 2:offset + 2 + size]
+            offset += 2 + size
+        elif kind == "pair":
+            size = struct.unpack_from("!H", data, offset)[0]
+            offset += 2 + size
+            size = struct.unpack_from("!H", data, offset)[0]
+            offset += 2 + size
+            value = None
+        else:
+            raise ConnectionError("unknown property 0x%02x"%(propertyId))
+        properties[propertyId] = value
+    return properties, end, raw
+
+def encodeProperties(raw):
+    return encodeLength(len(raw)) + raw
+
+def readExactly(sock, count):
+    data = bytearray()
+    while len(data) < count:
+        chunk = sock.recv(count - len(data))
+        if not chunk:
+            raise ConnectionError("client went away")
+        data += chunk
+    return bytes(data)
+
+# One connected client.
+class Session:
+    def __init__(self, broker, sock):
+        self.broker = broker
+        self.sock = sock
+        self.sendLock = threading.Lock()
+        self.clientId = ""
+        self.version = 4
+        self.nextPacketId = 1
+        # topic alias -> topic, for what this client publishes
+        self.topicAliases = {}
+        # topic filter -> granted qos
+        self.subscriptions = {}
+
+    def send(self, packet):
+        with self.sendLock:
+            self.sock.sendall(packet)
+        self.broker.count("bytesOut", len(packet))
+
+    def readPacket(self):
+        header = readExactly(self.sock, 1)[0]
+        multiplier = 1
+        length = 0
+        while True:
+            byte = readExactly(self.sock, 1)[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        body = readExactly(self.sock, length) if length else b""
+        self.broker.count("bytesIn", 1 + len(encodeLength(length)) + length)
+        return header >> 4, header & 0x0F, body
+
+    def run(self):
+        try:
+            while True:
+                packetType, flags, body = self.readPacket()
+                if packetType == CONNECT:
+                    self.handleConnect(body)
+                elif packetType == PUBLISH:
+                    self.handlePublish(flags, body)
+                elif packetType == PUBREL:
+                    self.send(bytes([PUBCOMP << 4, 2]) + body[:2])
+                elif packetType == SUBSCRIBE:
+                    self.handleSubscribe(body)
+                elif packetType == UNSUBSCRIBE:
+                    self.handleUnsubscribe(body)
+                elif packetType == PINGREQ:
+                    self.send(bytes([PINGRESP << 4, 0]))
+                elif packetType == DISCONNECT:
+                    break
+                # PUBACK, PUBREC and PUBCOMP from clients need nothing from us
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.broker.remove(self)
+            self.sock.close()
+
+    def handleConnect(self, body):
+        nameLength = struct.unpack_from("!H", body, 0)[0]
+        self.version = body[2 + nameLength]
+        if self.version == 5 and not self.broker.v5:
+            # what a 3.1.1 broker says, and then it hangs up
+            self.send(bytes([CONNACK << 4, 2, 0, REFUSED_PROTOCOL_VERSION]))
+            raise ConnectionError("client wanted MQTT 5")
+        offset = 2 + nameLength + 4
+        if self.version == 5:
+            properties, offset, raw = decodeProperties(body, offset)
+        idLength = struct.unpack_from("!H", body, offset)[0]
+        self.clientId = body[offset + 2:offset + 2 + idLength].decode()
+        self.broker.count("connects", 1)
+        if self.version == 5:
+            properties = bytes([TOPIC_ALIAS_MAXIMUM_PROPERTY]) + struct.pack("!H", TOPIC_ALIAS_MAXIMUM)
+            variable = bytes([0, 0]) + encodeProperties(properties)
+            self.send(bytes([CONNACK << 4]) + encodeLength(len(variable)) + variable)
+        else:
+            self.send(bytes([CONNACK << 4, 2, 0, 0]))
+
+    def handlePublish(self, flags, body):
+        qos = (flags >> 1) & 0x03
+        topicLength = struct.unpack_from("!H", body, 0)[0]
+        topic = body[2:2 + topicLength].decode()
+        offset = 2 + topicLength
+        if qos > 0:
+            packetId = body[offset:offset + 2]
+            offset += 2
+            if qos == 1:
+                self.send(bytes([PUBACK << 4, 2]) + packetId)
+            else:
+                self.send(bytes([PUBREC << 4, 2]) + packetId)
+        forward = b""
+        if self.version == 5:
+            properties, offset, raw = decodeProperties(body, offset)
+            alias = properties.get(TOPIC_ALIAS)
+            if alias is not None:
+                if not 0 < alias <= TOPIC_ALIAS_MAXIMUM:
+                    raise ConnectionError("topic alias %d out of range"%(alias))
+                if topic:
+                    self.topicAliases[alias] = topic
+                else:
+                    topic = self.topicAliases.get(alias)
+                    if topic is None:
+                        raise ConnectionError("unknown topic alias %d"%(alias))
+                    self.broker.count("aliasedMessages", 1)
+            # the expiry is all we pass on.  We deliver straight away, so 
+            # none of it has gone by.
+            expiry = properties.get(MESSAGE_EXPIRY_INTERVAL)
+            if expiry is not None:
+                forward = bytes([MESSAGE_EXPIRY_INTERVAL]) + struct.pack("!I", expiry)
+        self.broker.count("messagesIn", 1)
+        self.broker.route(topic, body[offset:], qos, forward)
+
+    def handleSubscribe(self, body):
+        packetId = body[:2]
+        offset = 2
+        if self.version == 5:
+            properties, offset, raw = decodeProperties(body, offset)
+        granted = bytearray()
+        while offset < len(body):
+            filterLength = struct.unpack_from("!H", body, offset)[0]
+            topicFilter = body[offset + 2:offset + 2 + filterLength].decode()
+            qos = min(body[offset + 2 + filterLength] & 0x03, 1)
+            offset += 3 + filterLength
+            with self.broker.lock:
+                self.subscriptions[topicFilter] = qos
+            granted.append(qos)
+        variable = packetId + (encodeProperties(b"") if self.version == 5 else b"")
+        self.send(bytes([SUBACK << 4]) + encodeLength(len(variable) + len(granted)) + variable + bytes(granted))
+
+    def handleUnsubscribe(self, body):
+        packetId = body[:2]
+        offset = 2
+        if self.version == 5:
+            properties, offset, raw = decodeProperties(body, offset)
+        removed = 0
+        while offset < len(body):
+            filterLength = struct.unpack_from("!H", body, offset)[0]
+            topicFilter = body[offset + 2:offset + 2 + filterLength].decode()
+            offset += 2 + filterLength
+            with self.broker.lock:
+                self.subscriptions.pop(topicFilter, None)
+            removed += 1
+        if self.version == 5:
+            # properties, then a reason code (0, success) for every filter
+            variable = packetId + encodeProperties(b"") + bytes(removed)
+            self.send(bytes([UNSUBACK << 4]) + encodeLength(len(variable)) + variable)
+        else:
+            self.send(bytes([UNSUBACK << 4, 2]) + packetId)
+
+    def deliver(self, topic, payload, qos, properties=b""):
+        variable = encodeString(topic)
+        if qos > 0:
+            with self.sendLock:
+                packetId = self.nextPacketId
+                self.nextPacketId = packetId % 65535 + 1
+            variable += struct.pack("!H", packetId)
+        if self.version == 5:
+            variable += encodeProperties(properties)
+        header = bytes([(PUBLISH << 4) | (qos << 1)])
+        self.send(header + encodeLength(len(variable) + len(payload)) + variable + payload)
+        self.broker.count("messagesOut", 1)
+
+class LocalBroker:
+    def __init__(self, host="127.0.0.1", port=0, v5=True):
+        self.host = host
+        self.port = port
+        self.v5 = v5
+        self.lock = threading.Lock()
+        self.sessions = []
+        # shared subscription filter -> how many messages it has had, to
+        # pick whose turn it is
+        self.shareTurns = {}
+        self.counters = {}
+        self.resetCounters()
+        self.server = None
+
+    def resetCounters(self):
+        with self.lock:
+            self.counters = {"connects": 0, "bytesIn": 0, "bytesOut": 0,
+                             "messagesIn": 0, "messagesOut": 0, "aliasedMessages": 0}
+
+    def count(self, name, amount):
+        with self.lock:
+            self.counters[name] += amount
+
+    def start(self):
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((self.host, self.port))
+        self.server.listen(128)
+        # port 0 means "pick one for me", so find out which one we got
+        self.port = self.server.getsockname()[1]
+        threading.Thread(target=self.acceptLoop, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.close()
+        with self.lock:
+            sessions = list(self.sessions)
+        for session in sessions:
+            try:
+                session.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def acceptLoop(self):
+        while True:
+            try:
+                sock, address = self.server.accept()
+            except OSError:
+                return
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = Session(self, sock)
+            with self.lock:
+                self.sessions.append(session)
+            threading.Thread(target=session.run, daemon=True).start()
+
+    def remove(self, session):
+        with self.lock:
+            if session in self.sessions:
+                self.sessions.remove(session)
+
+    # Send a message to everybody subscribed to its topic.  properties are
+    # the encoded MQTT 5 properties to pass on.
+    def route(self, topic, payload, qos, properties=b""):
+        # session -> granted qos
+        deliveries = {}
+        # shared filter -> [(session, granted qos), ...]
+        shared = {}
+        with self.lock:
+            for session in self.sessions:
+                for topicFilter, subQos in session.subscriptions.items():
+                    if topicFilter.startswith("$share/"):
+                        group, _, sharedFilter = topicFilter[len("$share/"):].partition("/")
+                        if topicMatches(sharedFilter, topic):
+                            shared.setdefault(topicFilter, []).append((session, subQos))
+                    elif topicMatches(topicFilter, topic):
+                        deliveries[session] = max(deliveries.get(session, -1), subQos)
+            for topicFilter, members in shared.items():
+                turn = self.shareTurns.get(topicFilter, 0)
+                self.shareTurns[topicFilter] = turn + 1
+                session, subQos = members[turn % len(members)]
+                deliveries[session] = max(deliveries.get(session, -1), subQos)
+        for session, granted in deliveries.items():
+            try:
+                session.deliver(topic, payload, min(qos, granted), properties)
+            except OSError:
+                pass
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local MQTT broker stand-in")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument("--no-v5", action="store_true",
+                        help="turn MQTT 5 clients away like a 3.1.1 broker")
+    args = parser.parse_args()
+
+    broker = LocalBroker(args.host, args.port, not args.no_v5).start()
+    print("Local broker listening on %s:%d"%(args.host, broker.port))
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        broker.stop()
@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+# Memory budget check for RPIDemoApp.py.  Memory that creeps up on a Pi Zero
+# ends in swap on the SD card, and then every latency we care about goes out
+# the window, so this runs the app for a long simulated stretch and fails if
+#   - the peak resident set size is over --rss-budget megabytes, or
+#   - the Python heap grew by more than --growth-budget kilobytes between the
+#     end of the warm-up and the end of the run.
+#
+# The app runs with LOW_MEMORY=True (--normal runs it without) on the same
+# simulated hardware as benchmark.py, and talks to the local broker, which
+# runs in a process of its own so it isn't counted.  Every cycle reads all
+# the sensors and publishes, every tenth one also handles a batch of
+# commands, and history is recorded to a temporary directory.  The peak RSS
+# is measured first; heap growth is measured afterwards with tracemalloc,
+# which costs memory of its own.
+#
+#     python3 membudget.py --cycles 10000 --rss-budget 32 --growth-budget 64
+#
+# It exits with status 1 if either budget is blown.
+
+import argparse
+import contextlib
+import gc
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import threading
+import tracemalloc
+
+import paho.mqtt.client as mqtt
+
+from localbroker import LocalBroker
+import benchmark
+
+def runBroker(ports):
+    broker = LocalBroker().start()
+    ports.put(broker.port)
+    threading.Event().wait()
+
+class RemoteBroker:
+    def __init__(self, port):
+        self.port = port
+
+def peakRss():
+    # kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def heapKb():
+    return tracemalloc.get_traced_memory()[0] / 1024.0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Memory budget check for the demo app")
+    parser.add_argument("--cycles", type=int, default=10000,
+                        help="simulated status cycles in each phase")
+    parser.add_argument("--warmup", type=int, default=1000,
+                        help="cycles before heap growth starts counting")
+    parser.add_argument("--rss-budget", type=float, default=32.0, metavar="MB")
+    parser.add_argument("--growth-budget", type=float, default=64.0, metavar="KB")
+    parser.add_argument("--normal", action="store_true",
+                        help="run without LOW_MEMORY, to compare")
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context("spawn")
+    ports = context.Queue()
+    brokerProcess = context.Process(target=runBroker, args=(ports,), daemon=True)
+    brokerProcess.start()
+    broker = RemoteBroker(ports.get())
+
+    with tempfile.TemporaryDirectory() as historyDir:
+        os.environ["LOW_MEMORY"] = "False" if args.normal else "True"
+        os.environ["HISTORY_DIR"] = historyDir
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            app = benchmark.loadApp(broker)
+            app.openHistory()
+            app.client, connected = benchmark.connectClient(broker)
+            app.client.loop_start()
+            app.client.display = benchmark.SimulatedDisplay()
+            app.client.display.displayIsOn = False
+
+            command = mqtt.MQTTMessage(topic=b"server/x/command")
+            command.payload = json.dumps([{"si": str(10 + i), "c": str(i)} 
+                                          for i in range(4)]).encode()
+            def run(cycles):
+                for i in range(cycles):
+                    app.sensorCache.entries.clear()
+                    app.sendStatus({})
+                    if i % 10 == 0:
+                        app.on_message(app.client, None, command)
+
+            run(args.warmup + args.cycles)
+            rss = peakRss()
+
+            tracemalloc.start()
+            run(args.warmup)
+            gc.collect()
+            start = heapKb()
+            run(args.cycles)
+            gc.collect()
+            growth = heapKb() - start
+            tracemalloc.stop()
+
+            app.client.loop_stop()
+            app.client.disconnect()
+
+    print("mode            %s"%("normal" if args.normal else "low memory"))
+    print("peak RSS        %.1f MB (budget %.1f MB)"%(rss, args.rss_budget))
+    print("heap growth     %.1f KB over %d cycles (budget %.1f KB)"%(growth, args.cycles,
+                                                                  args.growth_budget))
+    failed = False
+    if rss > args.rss_budget:
+        print("peak RSS is over budget")
+        failed = True
+    if growth > args.growth_budget:
+        print("heap growth is over budget")
+        failed = True
+    sys.exit(1 if failed else 0)
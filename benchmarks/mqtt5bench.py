@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+
+# How many bytes MQTT version 5 saves RPIDemoApp.py.  The app publishes the
+# same records message --messages times over each kind of connection, and
+# the local broker counts the bytes that arrive:
+#   mqtt311        version 3.1.1, the whole topic in every message
+#   mqtt5          version 5 with topic aliases and no expiry
+#   mqtt5_expiry   version 5 with topic aliases and the message expiry
+#                  interval, which is how the app runs by default
+# Each result is the bytes per message on the wire and the saving against
+# mqtt311.  A version 5 subscriber checks that the aliased messages still
+# arrive on the right topic with their expiry interval.
+#
+# Two more checks are run:
+#   fallback   a version 5 client against a broker that only speaks 3.1.1
+#              is turned down, and connects with 3.1.1 instead
+#   shared     two subscribers in a $share group get half the messages each
+#
+#     python3 mqtt5bench.py --messages 1000 --output mqtt5.json
+
+import argparse
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+import paho.mqtt.client as mqtt
+
+from localbroker import LocalBroker
+import benchmark
+
+# Connect a version 5 subscriber to topicFilter.  Returns the client and the
+# list the messages it gets go into.
+def subscriber(broker, clientId, topicFilter):
+    received = []
+    subscribed = threading.Event()
+    client = mqtt.Client(client_id=clientId, protocol=mqtt.MQTTv5)
+    client.on_message = lambda client, data, msg: received.append(msg)
+    client.on_subscribe = lambda client, data, mid, reasons, properties: subscribed.set()
+    client.connect("127.0.0.1", broker.port)
+    client.loop_start()
+    client.subscribe(topicFilter, 0)
+    subscribed.wait(5)
+    return client, received
+
+def waitFor(condition, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+def measureBytes(app, broker, record, v5, expiry, messages):
+    app.MQTT_MESSAGE_EXPIRY = expiry
+    watcher, received = subscriber(broker, "watcher", "device/+/records")
+    app.client = app.makeClient(v5)
+    app.connectBroker(app.client)
+    app.client.loop_start()
+
+    broker.resetCounters()
+    for i in range(messages):
+        app.publishRecords(record)
+    waitFor(lambda: broker.counters["messagesIn"] >= messages and len(received) >= messages)
+    counters = dict(broker.counters)
+
+    app.client.disconnect()
+    app.client.loop_stop()
+    watcher.disconnect()
+    watcher.loop_stop()
+
+    last = received[-1]
+    return {
+        "messages": counters["messagesIn"],
+        "aliased": counters["aliasedMessages"],
+        "bytesPerMessage": round(counters["bytesIn"] / max(counters["messagesIn"], 1), 1),
+        "delivered": len(received),
+        "topic": last.topic,
+        "expiry": getattr(last.properties, "MessageExpiryInterval", None),
+    }
+
+def checkFallback(app):
+    broker = LocalBroker(v5=False).start()
+    app.MQTT_BROKER = "127.0.0.1"
+    app.MQTT_PORT = broker.port
+    client = app.makeClient(True)
+    refused = not app.connectBroker(client) and client.protocolRefused
+    client = app.makeClient(False)
+    connected = app.connectBroker(client)
+    client.disconnect()
+    broker.stop()
+    return {"refused": refused, "connected": connected}
+
+def checkShared(broker, messages):
+    subscribers = [subscriber(broker, "share%d"%(i), "$share/bench/device/+/records")
+                   for i in range(2)]
+    publisher, connected = benchmark.connectClient(broker, "sharePublisher")
+    publisher.loop_start()
+    for i in range(messages):
+        publisher.publish("device/dev%d/records"%(i % 10), payload='{"1":1}', qos=0)
+    waitFor(lambda: sum(len(received) for client, received in subscribers) >= messages)
+    publisher.loop_stop()
+    publisher.disconnect()
+    counts = []
+    for client, received in subscribers:
+        client.disconnect()
+        client.loop_stop()
+        counts.append(len(received))
+    return counts
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MQTT version 5 byte savings for the demo app")
+    parser.add_argument("--messages", type=int, default=1000,
+                        help="records messages to publish over each connection")
+    parser.add_argument("--output", metavar="FILE",
+                        help="write the results to this JSON file")
+    args = parser.parse_args()
+
+    broker = LocalBroker().start()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        app = benchmark.loadApp(broker)
+        # the same record every time, so only the connection differs
+        record = benchmark.sampleRecord(app)
+        results = {
+            "devkey": app.MQTT_DEVKEY,
+            "mqtt311": measureBytes(app, broker, record, False, 0, args.messages),
+            "mqtt5": measureBytes(app, broker, record, True, 0, args.messages),
+            "mqtt5_expiry": measureBytes(app, broker, record, True, 300, args.messages),
+            "shared": checkShared(broker, args.messages),
+            "fallback": checkFallback(app),
+        }
+    broker.stop()
+
+    baseline = results["mqtt311"]["bytesPerMessage"]
+    failed = False
+    print("%-14s %14s %8s"%("connection", "bytes/message", "saving"))
+    for name in ("mqtt311", "mqtt5", "mqtt5_expiry"):
+        result = results[name]
+        result["saving"] = round(1.0 - result["bytesPerMessage"] / baseline, 3)
+        print("%-14s %14.1f %7.1f%%"%(name, result["bytesPerMessage"], 100.0 * result["saving"]))
+        if result["delivered"] != args.messages or not result["topic"].endswith("/records"):
+            print("%s: messages went missing or arrived on the wrong topic"%(name))
+            failed = True
+    if results["mqtt5_expiry"]["expiry"] != 300:
+        print("mqtt5_expiry: the expiry interval didn't reach the subscriber")
+        failed = True
+    print("shared subscription split %s"%(results["shared"]))
+    print("fallback to 3.1.1: refused %s, connected %s"%(results["fallback"]["refused"],
+                                                       results["fallback"]["connected"]))
+    if not all(results["fallback"].values()) or min(results["shared"]) == 0:
+        failed = True
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# Replays an I2C trace through RPIDemoApp.py's status pipeline as fast as it
+# will go.  The trace comes from a Pi in the field (run the app there with
+# I2C_TRACE=trace.i2c in its environment), so every pipeline version gets
+# exactly the same real-world input and their numbers can be compared.
+# Status cycles run back to back until the trace runs out, on the same
+# simulated display and local broker as benchmark.py, and the results are
+# the time per cycle, the app's own per-stage timings and what reached the
+# broker.
+#
+#     python3 replaybench.py trace.i2c --output before.json
+#     ... change something ...
+#     python3 replaybench.py trace.i2c --output after.json
+#
+# With no Pi to hand, --record makes a trace from the simulated bus instead:
+#
+#     python3 replaybench.py --record trace.i2c --cycles 1000
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import time
+
+from localbroker import LocalBroker
+import benchmark
+
+def runCycles(app, cycles):
+    samples = []
+    try:
+        for i in range(cycles):
+            # empty the cache so every cycle really goes to the bus
+            app.sensorCache.entries.clear()
+            start = time.perf_counter_ns()
+            app.sendStatus({})
+            samples.append((time.perf_counter_ns() - start) / 1000.0)
+    except app.ReplayFinished:
+        pass
+    return samples
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay an I2C trace through the demo app")
+    parser.add_argument("trace", nargs="?",
+                        help="trace file to replay")
+    parser.add_argument("--record", metavar="FILE",
+                        help="record a trace from the simulated bus instead")
+    parser.add_argument("--cycles", type=int, default=1000,
+                        help="status cycles to record")
+    parser.add_argument("--output", metavar="FILE",
+                        help="write the results to this JSON file")
+    args = parser.parse_args()
+    if (args.trace is None) == (args.record is None):
+        parser.error("give a trace to replay or --record FILE")
+
+    broker = LocalBroker().start()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        app = benchmark.loadApp(broker)
+        app.client, connected = benchmark.connectClient(broker)
+        app.client.loop_start()
+        app.client.display = benchmark.SimulatedDisplay()
+        app.client.display.displayIsOn = False
+
+        if args.record:
+            tracer = app.TracingBus(benchmark.SimulatedBus(), args.record)
+            app.bus = app.GuardedBus(tracer, app.I2C_TIMEOUT)
+            samples = runCycles(app, args.cycles)
+            tracer.close()
+        else:
+            replay = app.ReplayBus(args.trace, 0)
+            app.bus = app.GuardedBus(replay, app.I2C_TIMEOUT)
+            broker.resetCounters()
+            start = time.perf_counter()
+            samples = runCycles(app, sys.maxsize)
+            elapsed = time.perf_counter() - start
+
+        app.client.loop_stop()
+        app.client.disconnect()
+    broker.stop()
+
+    if args.record:
+        print("Recorded %d transactions in %d cycles to %s"%(
+              tracer.records, len(samples), args.record))
+        sys.exit(0)
+
+    results = {
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "trace": os.path.basename(args.trace),
+        "transactions": replay.replayed,
+        "cycles": len(samples),
+        "cycles_per_second": round(len(samples) / elapsed, 1),
+        "status_cycle": benchmark.summarize(samples),
+        "stages": app.profiler.summary(),
+        "broker": dict(broker.counters),
+    }
+    print("%d cycles, %d transactions in %.2f s (%.1f cycles/s)"%(
+          results["cycles"], results["transactions"], elapsed, results["cycles_per_second"]))
+    print("status_cycle median %.3f us, p90 %.3f us"%(
+          results["status_cycle"]["median"], results["status_cycle"]["p90"]))
+    print(app.profiler.report())
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
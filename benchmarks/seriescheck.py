@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+# Round trip checks for the columnar series encoding (see encodeSeries in
+# RPIDemoApp.py).  Every batch is encoded by the app and decoded both by the
+# app and by the copy of the decoder in examples/ingest/ingest.py, and has to
+# come back exactly: the same times, and values with the same bits, so NaN,
+# infinities and -0.0 count.  The fixed cases cover the edges of each value
+# type - empty and single sample series, negative integers, the XOR path with
+# all 64 bits significant, NaN and sign flips, and values too big to scale to
+# decimals.  --random adds that many batches of random doubles.
+#
+#     python3 seriescheck.py --random 1000
+#
+# It exits with status 1 if any batch doesn't survive.
+
+import argparse
+import contextlib
+import importlib.util
+import os
+import random
+import struct
+import sys
+from pathlib import Path
+
+from localbroker import LocalBroker
+import benchmark
+
+INGEST_PATH = Path(__file__).resolve().parents[1] / "examples" / "ingest" / "ingest.py"
+
+DOUBLE = struct.Struct('>d')
+NAN = float("nan")
+INF = float("inf")
+
+def loadIngest():
+    spec = importlib.util.spec_from_file_location("ingest", INGEST_PATH)
+    ingest = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(ingest)
+    return ingest
+
+def series(values, start=1700000000000, step=10000):
+    return {"t": [start + i * step for i in range(len(values))], "v": list(values)}
+
+# A double with random bits, so all 64 of them are significant.
+def randomDouble(rng):
+    return DOUBLE.unpack(rng.getrandbits(64).to_bytes(8, "big"))[0]
+
+CASES = {
+    "empty batch": {},
+    "empty series": {"1": series([])},
+    "single integer": {"5": series([3812])},
+    "single decimal": {"1": series([20.09888])},
+    "single float": {"1": series([0.1 + 0.2])},
+    "single nan": {"1": series([NAN])},
+    "negative integers": {"8": series([-15930, -1, 0, -32768, 32767, -5])},
+    "integer steps": {"7": series([4095, 0, 4095, 0, 1, 2])},
+    "decimals": {"1": series([20.5, 20.25, -3.125, 0.0])},
+    "irregular times": {"2": {"t": [5000, 4000, 4000, 9000000000000, -12],
+                              "v": [1.5, 2.5, 3.5, 4.5, 5.5]}},
+    "xor full significance": {"1": series([randomDouble(random.Random(seed))
+                                           for seed in range(64)])},
+    "xor nan and infinities": {"1": series([1.5, NAN, INF, -INF, NAN, 0.1, NAN])},
+    "xor sign flips": {"1": series([0.1, -0.1, 0.1, -0.1, 0.0, -0.0, 1e-300, -1e-300])},
+    "negative zero": {"1": series([-0.0, 1.0, 2.0])},
+    "large with fractions": {"1": series([1e308, 0.5, -1.7976931348623157e308, 2.25])},
+    "large decimals": {"1": series([2.0 ** 52, 0.5])},
+    "large integers": {"1": series([2 ** 62, -2 ** 63, 2 ** 64 + 1, 0])},
+    "several indices": {"1": series([20.5, 21.0]), "5": series([3812, 3800]),
+                        "9": series([0.1 + 0.2, NAN])},
+}
+
+def randomBatch(rng):
+    batch = {}
+    for sensorIndex in rng.sample(range(1, 10), rng.randint(1, 4)):
+        length = rng.randint(0, 50)
+        kind = rng.choice(("bits", "decimals", "integers", "mixed"))
+        if kind == "bits":
+            values = [randomDouble(rng) for i in range(length)]
+        elif kind == "decimals":
+            values = [round(rng.uniform(-1e6, 1e6), rng.randint(0, 6)) for i in range(length)]
+        elif kind == "integers":
+            values = [rng.randint(-2 ** 40, 2 ** 40) for i in range(length)]
+        else:
+            values = [rng.choice((rng.uniform(-1e300, 1e300), rng.randint(-9, 9) / 4.0))
+                      for i in range(length)]
+        times = sorted(rng.randint(0, 2 ** 42) for i in range(length))
+        batch[str(sensorIndex)] = {"t": times, "v": values}
+    return batch
+
+def sameValue(expected, actual):
+    if isinstance(expected, int):
+        return actual == expected
+    return isinstance(actual, float) and DOUBLE.pack(actual) == DOUBLE.pack(expected)
+
+# Return None if decoded is batch, otherwise what's different.
+def difference(batch, decoded):
+    if set(decoded) != set(batch):
+        return "sensor indices %s, expected %s"%(sorted(decoded), sorted(batch))
+    for sensorIndex, entry in batch.items():
+        got = decoded[sensorIndex]
+        if got["t"] != entry["t"]:
+            return "sensor %s times %s, expected %s"%(sensorIndex, got["t"], entry["t"])
+        if (len(got["v"]) != len(entry["v"])
+                or not all(map(sameValue, entry["v"], got["v"]))):
+            return "sensor %s values %r, expected %r"%(sensorIndex, got["v"], entry["v"])
+    return None
+
+# Return None if batch survives both decoders, otherwise what went wrong.
+def check(app, ingest, batch):
+    try:
+        payload = app.encodeSeries(batch)
+    except Exception as err:
+        return "encoding raised %r"%(err)
+    for name, decoder in (("app", app.decodeSeries), ("ingest", ingest.decodeSeries)):
+        try:
+            problem = difference(batch, decoder(payload))
+        except Exception as err:
+            problem = "decoding raised %r"%(err)
+        if problem is not None:
+            return "%s: %s"%(name, problem)
+    return None
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Round trip checks for the columnar series encoding")
+    parser.add_argument("--random", type=int, default=200,
+                        help="random batches to check as well as the fixed cases")
+    parser.add_argument("--seed", type=int, default=1,
+                        help="seed for the random batches")
+    args = parser.parse_args()
+
+    # the app is only imported here, so the broker is never connected to
+    broker = LocalBroker()
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        app = benchmark.loadApp(broker)
+        ingest = loadIngest()
+
+    failures = 0
+    for name, batch in CASES.items():
+        problem = check(app, ingest, batch)
+        print("%-24s %s"%(name, "ok" if problem is None else "FAILED"))
+        if problem is not None:
+            print("    " + problem)
+            failures += 1
+
+    rng = random.Random(args.seed)
+    for i in range(args.random):
+        batch = randomBatch(rng)
+        problem = check(app, ingest, batch)
+        if problem is not None:
+            print("random batch %d FAILED\n    %s"%(i, problem))
+            failures += 1
+    print("%d random batches, %d failures in all"%(args.random, failures))
+    sys.exit(1 if failures else 0)
@@ -5,19 +5,28 @@
 # the main server.
 
 import paho.mqtt.client as mqtt
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
 import random
 import math
 import json
 import time
 import os
-from decimal import *
-import smbus
+import sys
+import argparse
+import concurrent.futures
+import threading
+import zlib
+import mmap
+import struct
+import atexit
+import signal
+import array
+import queue
+import collections
+import errno
 from dotenv import load_dotenv
 load_dotenv()
-import board
-import busio
-import digitalio
-import adafruit_ssd1306
 
 # Here are some values that we don't want to bake into the source code.  
 # They're held in environment variables instead.
@@ -34,6 +43,15 @@ MQTT_USERNAME=os.getenv('MQTT_USERNAME')
 MQTT_PASSWORD=os.getenv('MQTT_PASSWORD')
 MQTT_DEVKEY=os.getenv('MQTT_DEVKEY')
 
+# Low-memory mode, for the Pi Zero and other boards with 512 MB or less.  It
+# keeps less history, lets fewer outgoing messages queue up while we're 
+# disconnected and compresses with a lighter zstd level.  The README has the
+# rest of the story.
+LOW_MEMORY = os.getenv('LOW_MEMORY', 'False') == 'True'
+# Most outgoing messages paho may hold on to.  Past that, publishing fails
+# instead of piling messages up in memory until the broker comes back.
+MAX_QUEUED_MESSAGES = 20 if LOW_MEMORY else 200
+
 # Here are the routines used to setup and periodically read sensor data.
 # The routines that carry out commands from the server are here too.
 # Start by listing the sensors we'll use, their I2C addresses and their 
@@ -68,8 +86,444 @@ INFRARED_LIGHT_SENSOR_IDX = "9"
 # server.
 sensorVals = {}
 
+# Bus helpers.  Every bus call costs a trip through the kernel and a pile of 
+# Python overhead, so we'd like to read as many bytes as possible in each one.
+# When the bus is an smbus2 SMBus, burstRead sends the register address and
+# reads the data back in a single combined i2c_rdwr transaction, and isn't 
+# limited to the 32 bytes of an SMBus block read.  Otherwise it falls back to
+# read_i2c_block_data.  openBus uses smbus2 when it's installed and the older
+# python-smbus, which has no i2c_rdwr, when it isn't.
+try:
+    from smbus2 import i2c_msg
+except ImportError:
+    i2c_msg = None
+
+# the most an SMBus block read can return
+I2C_BLOCK_MAX = 32
+
+def burstRead(addr, reg, length):
+    if i2c_msg is not None and hasattr(bus, 'i2c_rdwr'):
+        write = i2c_msg.write(addr, [reg])
+        read = i2c_msg.read(addr, length)
+        bus.i2c_rdwr(write, read)
+        return list(read)
+    return bus.read_i2c_block_data(addr, reg, length)
+
+# Read several registers from one device.  registers is a list of 
+# (register, length) pairs.  Registers that sit next to each other are read
+# in one block transaction and split up afterwards.  That relies on the
+# device auto-incrementing its register address during a read, which all of
+# our sensors do.  command is OR-ed into the register address for devices
+# like the TSL2561 that want a command bit.  The data comes back as a list
+# of byte lists in the same order as registers.
+def readRegisters(addr, registers, command=0):
+    # merge adjacent or overlapping registers into [start, end) spans
+    spans = []
+    for reg, length in sorted(registers):
+        if spans and reg <= spans[-1][1] and reg + length - spans[-1][0] <= I2C_BLOCK_MAX:
+            spans[-1][1] = max(spans[-1][1], reg + length)
+        else:
+            spans.append([reg, reg + length])
+
+    blocks = []
+    for start, end in spans:
+        blocks.append((start, burstRead(addr, command | start, end - start)))
+
+    results = []
+    for reg, length in registers:
+        for start, data in blocks:
+            if start <= reg and reg + length <= start + len(data):
+                results.append(data[reg - start:reg - start + length])
+                break
+    return results
+
+# Bounded bus access.  A wedged device can hold an I2C transaction forever,
+# and that would stop everything else.  GuardedBus wraps the real bus and
+# runs every call on a worker thread with a deadline of I2C_TIMEOUT seconds.
+# If the deadline passes we raise TimeoutError (an OSError, like any other
+# bus failure) and carry on with a fresh worker.  The stuck one is left to
+# finish, or not, on its own.  Workers are daemon threads, because Python
+# waits for every other kind at exit, and a device that never lets go would
+# then keep us from exiting at all.
+I2C_TIMEOUT = float(os.getenv('I2C_TIMEOUT', '0.25'))
+
+class BusWorker(threading.Thread):
+    def __init__(self):
+        super().__init__(daemon=True)
+        # (future, method, args), or None to stop once the current call is done
+        self.calls = queue.Queue()
+        self.start()
+
+    def submit(self, method, *args):
+        future = concurrent.futures.Future()
+        self.calls.put((future, method, args))
+        return future
+
+    def abandon(self):
+        self.calls.put(None)
+
+    def run(self):
+        while True:
+            call = self.calls.get()
+            if call is None:
+                return
+            future, method, args = call
+            try:
+                future.set_result(method(*args))
+            except BaseException as err:
+                future.set_exception(err)
+
+class GuardedBus:
+    def __init__(self, bus, timeout):
+        self.bus = bus
+        self.timeout = timeout
+        self.worker = BusWorker()
+
+    def call(self, method, *args):
+        future = self.worker.submit(method, *args)
+        try:
+            return future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            self.worker.abandon()
+            self.worker = BusWorker()
+            raise TimeoutError("I2C %s%s took longer than %.3f s"%(
+                               method.__name__, args[:2], self.timeout))
+
+    # Anything we don't define ourselves comes from the real bus, with
+    # methods wrapped in the deadline.  Methods the real bus doesn't have
+    # still raise AttributeError, so hasattr() works as usual.
+    def __getattr__(self, name):
+        attr = getattr(self.bus, name)
+        if not callable(attr):
+            return attr
+        def guarded(*args):
+            return self.call(attr, *args)
+        return guarded
+
+# I2C traces.  Problems that only show up in the field are much easier to 
+# chase when the field's own bus traffic can be fed back into the app on a
+# desk.  Set I2C_TRACE to a file name and TracingBus records every 
+# transaction on the real bus there.  Set I2C_REPLAY to a trace file instead
+# and ReplayBus stands in for the hardware, so no Pi is needed: reads return
+# the bytes that were recorded and calls that failed fail again.  Each call 
+# takes as long as it did in the field divided by REPLAY_SPEED, so 1 keeps
+# the original bus timing (timeouts included) and 0 answers at once.  The 
+# gaps between calls come from the app's own schedule;
+# benchmarks/replaybench.py runs the cycles back to back instead.  When the
+# trace runs out, the app exits.
+#
+# A trace starts with TRACE_MAGIC.  Each transaction is a TRACE_RECORD - 
+# nanoseconds since the trace started, nanoseconds the call took, the 
+# operation, a status (0, or the errno if the call failed), the device 
+# address, the register and the number of data bytes - followed by the data
+# bytes: what was written, or what was read back.  burstRead's combined 
+# i2c_rdwr transactions are recorded as block reads.
+I2C_TRACE = os.getenv('I2C_TRACE')
+I2C_REPLAY = os.getenv('I2C_REPLAY')
+REPLAY_SPEED = float(os.getenv('REPLAY_SPEED', '1'))
+
+TRACE_MAGIC = b'GBI2C\x01'
+TRACE_RECORD = struct.Struct('<QIBBBBH')
+TRACE_WRITE_BYTE = 1
+TRACE_WRITE_BYTE_DATA = 2
+TRACE_WRITE_WORD_DATA = 3
+TRACE_WRITE_BLOCK_DATA = 4
+TRACE_READ_BLOCK_DATA = 5
+
+# seconds between flushes of the trace file
+TRACE_FLUSH_INTERVAL = 1.0
+
+class TracingBus:
+    def __init__(self, bus, path):
+        self.bus = bus
+        self.lock = threading.Lock()
+        self.file = open(path, 'wb')
+        self.file.write(TRACE_MAGIC)
+        self.start = time.perf_counter_ns()
+        self.flushTime = time.monotonic()
+        self.records = 0
+        # burstRead only uses i2c_rdwr if the real bus has it
+        if hasattr(bus, 'i2c_rdwr'):
+            self.i2c_rdwr = self.traceRdwr
+        atexit.register(self.close)
+
+    def trace(self, op, addr, reg, data, method, *args):
+        start = time.perf_counter_ns()
+        try:
+            result = method(*args)
+        except OSError as err:
+            self.write(start, op, err.errno or errno.EIO, addr, reg, ())
+            raise
+        self.write(start, op, 0, addr, reg, result if op == TRACE_READ_BLOCK_DATA else data)
+        return result
+
+    def write(self, start, op, status, addr, reg, data):
+        duration = min(time.perf_counter_ns() - start, 0xFFFFFFFF)
+        data = bytes(data)
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.write(TRACE_RECORD.pack(start - self.start, duration, op, 
+                            min(status, 255), addr, reg, len(data)) + data)
+            self.records += 1
+            if time.monotonic() - self.flushTime >= TRACE_FLUSH_INTERVAL:
+                self.flushTime = time.monotonic()
+                self.file.flush()
+
+    def write_byte(self, addr, value):
+        return self.trace(TRACE_WRITE_BYTE, addr, 0, [value], 
+                          self.bus.write_byte, addr, value)
+
+    def write_byte_data(self, addr, reg, value):
+        return self.trace(TRACE_WRITE_BYTE_DATA, addr, reg, [value], 
+                          self.bus.write_byte_data, addr, reg, value)
+
+    def write_word_data(self, addr, reg, value):
+        return self.trace(TRACE_WRITE_WORD_DATA, addr, reg, [value & 0xFF, value >> 8], 
+                          self.bus.write_word_data, addr, reg, value)
+
+    def write_i2c_block_data(self, addr, reg, data):
+        return self.trace(TRACE_WRITE_BLOCK_DATA, addr, reg, data, 
+                          self.bus.write_i2c_block_data, addr, reg, data)
+
+    def read_i2c_block_data(self, addr, reg, length):
+        return self.trace(TRACE_READ_BLOCK_DATA, addr, reg, (), 
+                          self.bus.read_i2c_block_data, addr, reg, length)
+
+    # burstRead's register write and the read that follows it
+    def traceRdwr(self, write, read):
+        return self.trace(TRACE_READ_BLOCK_DATA, read.addr, list(write)[0], (), 
+                          self.transfer, write, read)
+
+    def transfer(self, write, read):
+        self.bus.i2c_rdwr(write, read)
+        return list(read)
+
+    # Close the trace file.  The bus itself stays open.
+    def close(self):
+        with self.lock:
+            if not self.file.closed:
+                self.file.close()
+
+# Raised by ReplayBus when the trace runs out.  It's a SystemExit so the app
+# stops quietly, from whichever thread happens to notice first.
+class ReplayFinished(SystemExit):
+    pass
+
+class ReplayBus:
+    def __init__(self, path, speed):
+        self.speed = speed
+        self.lock = threading.Lock()
+        self.replayed = 0
+        # (operation, address, register) -> recorded transactions, oldest 
+        # first.  Keeping each register separate lets a pipeline that reads
+        # its sensors in a different order still get the right bytes.
+        self.transactions = {}
+        with open(path, 'rb') as f:
+            trace = f.read()
+        if not trace.startswith(TRACE_MAGIC):
+            raise ValueError("%s isn't an I2C trace"%(path))
+        offset = len(TRACE_MAGIC)
+        while offset + TRACE_RECORD.size <= len(trace):
+            t, duration, op, status, addr, reg, length = TRACE_RECORD.unpack_from(trace, offset)
+            offset += TRACE_RECORD.size
+            # a trace cut short by a crash ends with a partial record
+            if offset + length > len(trace):
+                break
+            data = list(trace[offset:offset + length])
+            offset += length
+            recorded = self.transactions.setdefault((op, addr, reg), collections.deque())
+            recorded.append((duration, status, data))
+
+    # Take the next recorded transaction for this register, wait as long as it
+    # took and return its data, or raise its error.  Returns None if there
+    # isn't one.
+    def replay(self, op, addr, reg):
+        with self.lock:
+            recorded = self.transactions.get((op, addr, reg))
+            if not recorded:
+                return None
+            duration, status, data = recorded.popleft()
+            self.replayed += 1
+        if self.speed > 0:
+            time.sleep(duration / 1e9 / self.speed)
+        if status != 0:
+            raise OSError(status, os.strerror(status))
+        return data
+
+    # Writes that aren't in the trace are accepted; there's nobody to object.
+    def write_byte(self, addr, value):
+        self.replay(TRACE_WRITE_BYTE, addr, 0)
+
+    def write_byte_data(self, addr, reg, value):
+        self.replay(TRACE_WRITE_BYTE_DATA, addr, reg)
+
+    def write_word_data(self, addr, reg, value):
+        self.replay(TRACE_WRITE_WORD_DATA, addr, reg)
+
+    def write_i2c_block_data(self, addr, reg, data):
+        self.replay(TRACE_WRITE_BLOCK_DATA, addr, reg)
+
+    def read_i2c_block_data(self, addr, reg, length):
+        key = (TRACE_READ_BLOCK_DATA, addr, reg)
+        if key not in self.transactions:
+            # nothing ever answered here, just like an empty address
+            raise OSError(errno.EREMOTEIO, "0x%02x register 0x%02x isn't in the trace"%(addr, reg))
+        data = self.replay(*key)
+        if data is None:
+            print("Replay finished after %d transactions"%(self.replayed))
+            raise ReplayFinished(0)
+        if len(data) < length:
+            raise OSError(errno.EIO, "trace has %d bytes for 0x%02x register 0x%02x, not %d"%(
+                          len(data), addr, reg, length))
+        return data[:length]
+
+    def close(self):
+        pass
+
+# The bus the sensors are on: the hardware, the hardware with a trace being
+# recorded, or a trace being played back.  Every transaction gets a deadline
+# so one wedged device can't hang us.
+def openBus():
+    if I2C_REPLAY:
+        print("Replaying I2C trace %s at %gx"%(I2C_REPLAY, REPLAY_SPEED))
+        rawBus = ReplayBus(I2C_REPLAY, REPLAY_SPEED)
+    else:
+        try:
+            import smbus2 as smbus
+        except ImportError:
+            import smbus
+        rawBus = smbus.SMBus(1)
+        if I2C_TRACE:
+            print("Recording I2C trace to %s"%(I2C_TRACE))
+            rawBus = TracingBus(rawBus, I2C_TRACE)
+    return GuardedBus(rawBus, I2C_TIMEOUT)
+
+# Profiling.  When a cycle gets slow we want to know whether it was the I2C
+# bus, JSON encoding, the publish call or a callback.  Every interesting stage
+# is timed with perf_counter_ns, which is cheap enough to leave on all the 
+# time.  The timings go into a per-stage histogram with power-of-two buckets
+# in microseconds, so we can report percentiles without keeping samples.
+# Use profiler.timed() around a call, or put @profiled on a routine.  The
+# --timing-report and --publish-timing flags decide where the numbers go.
+class Profiler:
+    BUCKETS = 32
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # stage -> [count, total ns, max ns, histogram]
+        self.stages = {}
+
+    def record(self, stage, ns):
+        bucket = min((ns // 1000).bit_length(), self.BUCKETS - 1)
+        with self.lock:
+            stats = self.stages.get(stage)
+            if stats is None:
+                stats = self.stages[stage] = [0, 0, 0, [0] * self.BUCKETS]
+            stats[0] += 1
+            stats[1] += ns
+            if ns > stats[2]:
+                stats[2] = ns
+            stats[3][bucket] += 1
+
+    # Call fn(*args, **kwargs) and charge the time to stage.
+    def timed(self, stage, fn, *args, **kwargs):
+        start = time.perf_counter_ns()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            self.record(stage, time.perf_counter_ns() - start)
+
+    # Per-stage statistics in milliseconds.  Percentiles are the upper edge of
+    # the histogram bucket they fall in.
+    def summary(self):
+        with self.lock:
+            stages = {stage: (stats[0], stats[1], stats[2], list(stats[3]))
+                      for stage, stats in self.stages.items()}
+        summary = {}
+        for stage, (count, total, biggest, histogram) in stages.items():
+            biggest = round(biggest / 1e6, 3)
+            summary[stage] = {
+                "n": count,
+                "mean": round(total / count / 1e6, 3),
+                "p50": min(self.percentile(histogram, count, 0.50), biggest),
+                "p90": min(self.percentile(histogram, count, 0.90), biggest),
+                "p99": min(self.percentile(histogram, count, 0.99), biggest),
+                "max": biggest,
+            }
+        return summary
+
+    def percentile(self, histogram, count, fraction):
+        seen = 0
+        for bucket, n in enumerate(histogram):
+            seen += n
+            if seen >= fraction * count:
+                # bucket b holds durations below 2**b microseconds
+                return (1 << bucket) / 1000.0
+        return (1 << (self.BUCKETS - 1)) / 1000.0
+
+    def report(self):
+        lines = ["%-20s %8s %10s %10s %10s %10s %10s"%(
+                 "stage (ms)", "n", "mean", "p50", "p90", "p99", "max")]
+        for stage, stats in sorted(self.summary().items()):
+            lines.append("%-20s %8d %10.3f %10.3f %10.3f %10.3f %10.3f"%(
+                         stage, stats["n"], stats["mean"], stats["p50"], 
+                         stats["p90"], stats["p99"], stats["max"]))
+        return "\n".join(lines)
+
+profiler = Profiler()
+
+# Decorator that times every call of a routine under its own name.
+def profiled(fn):
+    stage = fn.__name__
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter_ns()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profiler.record(stage, time.perf_counter_ns() - start)
+    wrapper.__name__ = fn.__name__
+    return wrapper
+
+# The stage timings tell us which stage is slow but not why.  The sampling
+# profiler (--sample-profile HZ) runs in its own thread, looks at what every
+# other thread is doing HZ times a second and counts the functions it finds.
+# The ones with the most samples are where the time goes.
+class SamplingProfiler(threading.Thread):
+    def __init__(self, hz):
+        threading.Thread.__init__(self, daemon=True)
+        self.interval = 1.0 / hz
+        self.counts = {}
+        self.total = 0
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            for ident, frame in sys._current_frames().items():
+                if ident == self.ident:
+                    continue
+                where = "%s (%s:%d)"%(frame.f_code.co_name, 
+                        os.path.basename(frame.f_code.co_filename), frame.f_lineno)
+                self.counts[where] = self.counts.get(where, 0) + 1
+                self.total += 1
+
+    def report(self, top=15):
+        lines = ["%6s  %s"%("%", "sampled location")]
+        counts = sorted(self.counts.items(), key=lambda item: item[1], reverse=True)
+        for where, count in counts[:top]:
+            lines.append("%6.2f  %s"%(100.0 * count / max(self.total, 1), where))
+        return "\n".join(lines)
+
 # Initialize the display.
+@profiled
 def setupDisplay():
+    # The display libraries are big, so they're only imported when there's
+    # a display to set up.
+    import board
+    import busio
+    import digitalio
+    import adafruit_ssd1306
+
     # set the display size in pixels
     DISPLAY_WIDTH = 128
     DISPLAY_HEIGHT = 32
@@ -96,6 +550,198 @@ def setupDisplay():
     # return the display so other code and use it.
     return display
 
+# Stands in for the OLED while we replay an I2C trace, which can happen on a
+# box with no display and no display libraries.  Commands still flip
+# displayIsOn; there's just nothing to see.
+class NullDisplay:
+    def fill(self, color):
+        pass
+
+    def show(self):
+        pass
+
+    def invert(self, invert):
+        pass
+
+# The dashboard.  The display shows the latest readings from sensorCache, 
+# four rows of two fields each, so somebody standing next to the Pi can see
+# what it's sending.  Drawing text through framebuf every frame is far too
+# slow on a Pi Zero, so the font is turned into GLYPH_ATLAS once: six bytes
+# per character, each one a column of eight pixels, the same layout as the
+# SSD1306's own memory.  A row of text is then one slice assignment into a 
+# page of our buffer.  Fields sit in fixed places and are only drawn when
+# their text changes, and only the pages that changed go over the bus.
+#
+# Everything the display does happens on the dashboard's own thread, which
+# wakes every DASHBOARD_PERIOD seconds.  A frame that runs past 
+# DASHBOARD_FRAME_BUDGET seconds stops, and whatever it didn't get to is
+# left for the next one, so the display never holds up the bus or the MQTT
+# callbacks.  Readings older than DASHBOARD_MAX_AGE seconds show as "--".
+DASHBOARD = os.getenv('DASHBOARD', 'True') == 'True'
+DASHBOARD_PERIOD = float(os.getenv('DASHBOARD_PERIOD', '0.5'))
+DASHBOARD_FRAME_BUDGET = float(os.getenv('DASHBOARD_FRAME_BUDGET', '0.02'))
+DASHBOARD_MAX_AGE = float(os.getenv('DASHBOARD_MAX_AGE', '180'))
+
+# A 5x8 font, one hex byte per column with the top pixel in bit 0.  Text is
+# upper-cased before it's drawn and anything missing is drawn as "?".
+GLYPHS = {
+    ' ': '0000000000', '%': '2313086462', '*': '14083e0814', '+': '08083e0808', '-': '0808080808',
+    '.': '0060600000', '/': '2010080402', ':': '0036360000', '?': '0201510906',
+    '0': '3e5149453e', '1': '00427f4000', '2': '4261514946', '3': '2141454b31',
+    '4': '1814127f10', '5': '2745454539', '6': '3c4a494930', '7': '0171090503',
+    '8': '3649494936', '9': '064949291e', 'A': '7e1111117e', 'B': '7f49494936',
+    'C': '3e41414122', 'D': '7f4141221c', 'E': '7f49494941', 'F': '7f09090101',
+    'G': '3e4149497a', 'H': '7f0808087f', 'I': '00417f4100', 'J': '2040413f01',
+    'K': '7f08142241', 'L': '7f40404040', 'M': '7f0204027f', 'N': '7f0408107f',
+    'O': '3e4141413e', 'P': '7f09090906', 'Q': '3e4151215e', 'R': '7f09192946',
+    'S': '4649494931', 'T': '01017f0101', 'U': '3f4040403f', 'V': '1f2040201f',
+    'W': '7f2018207f', 'X': '6314081463', 'Y': '0304780403', 'Z': '6151494543',
+}
+GLYPH_WIDTH = 6
+GLYPH_ATLAS = {char: bytes.fromhex(columns) + b'\x00' for char, columns in GLYPHS.items()}
+
+# (sensor index, label, format, row, column, width), with the column and
+# width in characters.  A row is one 8 pixel page of the display.  Each 
+# field is wide enough for the biggest value its sensor gives: proximity and
+# the light channels go up to 65535, and the ADCs to 4095.
+DASHBOARD_FIELDS = (
+    (TEMPERATURE_SENSOR_IDX, "TEMP", "%.1fF", 0, 0, 11),
+    (HUMIDITY_SENSOR_IDX, "RH", "%.0f%%", 0, 12, 9),
+    (PRESSURE_SENSOR_IDX, "PRES", "%.1f", 1, 0, 11),
+    (GAS_SENSOR_IDX, "GAS", "%d", 1, 12, 9),
+    (PROXY_SENSOR_IDX, "PROX", "%d", 2, 0, 11),
+    (SOIL_SENSOR_IDX, "SOIL", "%d", 2, 12, 9),
+    (VISIBLE_LIGHT_SENSOR_IDX, "VIS", "%d", 3, 0, 11),
+    (INFRARED_LIGHT_SENSOR_IDX, "IR", "%d", 3, 12, 9),
+)
+
+# SSD1306 commands for the range of columns and pages the next data fills
+SSD1306_SET_COL_ADDR = 0x21
+SSD1306_SET_PAGE_ADDR = 0x22
+
+def renderText(text):
+    missing = GLYPH_ATLAS['?']
+    return b''.join([GLYPH_ATLAS.get(char, missing) for char in text.upper()])
+
+# The text a field shows for value: the label, then the value right-aligned.
+# A value that doesn't fit shows as stars rather than with digits missing.
+def fieldText(label, format, width, value):
+    room = width - len(label) - 1
+    shown = "--" if value is None else format%(value)
+    if len(shown) > room:
+        shown = "*" * room
+    return "%s %*s"%(label, room, shown)
+
+class Dashboard(threading.Thread):
+    def __init__(self, display, period=DASHBOARD_PERIOD, budget=DASHBOARD_FRAME_BUDGET):
+        super().__init__(daemon=True)
+        self.display = display
+        self.period = period
+        self.budget = budget
+        self.width = display.width
+        self.pages = display.height // 8
+        # our copy of the display memory, page after page
+        self.buffer = bytearray(self.width * self.pages)
+        # the text each field shows right now
+        self.shown = [None] * len(DASHBOARD_FIELDS)
+        self.dirtyPages = set()
+        # where the next frame starts, so a frame that runs out of time
+        # doesn't always leave the same fields behind
+        self.nextField = 0
+        # An adafruit SSD1306_I2C can be sent some of its pages.  Anything 
+        # else gets our whole buffer and a show().
+        self.paged = hasattr(display, 'write_cmd') and hasattr(display, 'i2c_device')
+        self.inverted = False
+        self.wantInverted = False
+        self.wake = threading.Event()
+        self.running = True
+        self.frames = 0
+        self.overBudget = 0
+        self.bytesSent = 0
+
+    # Ask for the display to be inverted, or not.  It happens on the next 
+    # frame, which starts right away.
+    def setInverted(self, inverted):
+        self.wantInverted = inverted
+        self.wake.set()
+
+    def run(self):
+        while self.running:
+            self.wake.wait(self.period)
+            self.wake.clear()
+            try:
+                self.frame()
+            except OSError as err:
+                print("Display failed (%s)"%(err))
+
+    def stop(self):
+        self.running = False
+        self.wake.set()
+
+    def frame(self):
+        deadline = time.monotonic() + self.budget
+        if self.wantInverted != self.inverted:
+            self.inverted = self.wantInverted
+            self.display.invert(self.inverted)
+
+        # every frame gets at least one field drawn and one page sent, so
+        # even a display slower than the budget gets there in the end
+        count = len(DASHBOARD_FIELDS)
+        for i in range(count):
+            field = (self.nextField + i) % count
+            if i > 0 and time.monotonic() > deadline:
+                self.nextField = field
+                self.overBudget += 1
+                break
+            self.drawField(field)
+
+        if self.paged:
+            for i, page in enumerate(sorted(self.dirtyPages)):
+                if i > 0 and time.monotonic() > deadline:
+                    self.overBudget += 1
+                    break
+                self.flushPage(page)
+                self.dirtyPages.discard(page)
+        elif self.dirtyPages:
+            self.flushAll()
+            self.dirtyPages.clear()
+        self.frames += 1
+
+    def drawField(self, field):
+        sensorIndex, label, format, row, column, width = DASHBOARD_FIELDS[field]
+        text = fieldText(label, format, width, sensorCache.get(sensorIndex, DASHBOARD_MAX_AGE))
+        if text == self.shown[field]:
+            return
+        start = row * self.width + column * GLYPH_WIDTH
+        self.buffer[start:start + width * GLYPH_WIDTH] = renderText(text)
+        self.shown[field] = text
+        self.dirtyPages.add(row)
+
+    def flushPage(self, page):
+        display = self.display
+        for command in (SSD1306_SET_COL_ADDR, 0, self.width - 1, 
+                        SSD1306_SET_PAGE_ADDR, page, page):
+            display.write_cmd(command)
+        # 0x40 says what follows is display data
+        data = b'\x40' + self.buffer[page * self.width:(page + 1) * self.width]
+        with display.i2c_device:
+            display.i2c_device.write(data)
+        self.bytesSent += len(data)
+
+    def flushAll(self):
+        # the display's buffer may start with a control byte
+        offset = len(self.display.buffer) - len(self.buffer)
+        self.display.buffer[offset:] = self.buffer
+        self.display.show()
+        self.bytesSent += len(self.buffer)
+
+    def stats(self):
+        return {"frames": self.frames, "overBudget": self.overBudget, 
+                "bytesSent": self.bytesSent}
+
+# the running dashboard, if there is one
+dashboard = None
+
 # This is the temperature and humidity sensor that's in the training board.
 # Reference https://github.com/ControlEverythingCommunity/HCPA-5V-U3/blob/master/Python/HCPA_5V_U3.py
 
@@ -105,6 +751,7 @@ def setupDisplay():
 # This routine gets the sensor data, converts it to sensible values and  
 # stuffs it into sensorVals.  After all the sensors have been processed, 
 # sensorVals is returned in one wad.
+@profiled
 def sendHCPAData(sensorVals):
     print("Sending HCPA")
 
@@ -116,7 +763,8 @@ def sendHCPAData(sensorVals):
     
     # Get the next 4 bytes from the sensor
     # humidity msb, humidity lsb, cTemp msb, cTemp lsb
-    data = bus.read_i2c_block_data(HCPA_Addr, 4)
+    # smbus2 insists on a length, so ask for just the 4 we use.
+    data = bus.read_i2c_block_data(HCPA_Addr, 4, 4)
     
     # Process the incoming data.  The MS two bits of humidity data are really 
     # status bits.  The example code ignores them so we do too.
@@ -128,8 +776,8 @@ def sendHCPAData(sensorVals):
     print("Temperature (deg C): {}".format(cTemp))
     print("Temperature (deg F): {}".format(fTemp))
     # store the humidity and temperature into sensorVals dict
-    sensorVals[HUMIDITY_SENSOR_IDX] = round(humidity, 5)
-    sensorVals[TEMPERATURE_SENSOR_IDX] = round(fTemp, 5)
+    sensorVals[HUMIDITY_SENSOR_IDX] = round(humidity, config["precision"])
+    sensorVals[TEMPERATURE_SENSOR_IDX] = round(fTemp, config["precision"])
 
 # Setup the pressure sensor.
 # Note that the compensation variables A0, B1, B2 and C12 are effectively
@@ -140,6 +788,7 @@ B2 = 0.0
 C12 = 0.0
 
 # Calculate the compensation coefficients in the setup routine.
+@profiled
 def setupMPL():
     
     global A0
@@ -151,7 +800,7 @@ def setupMPL():
     # Reading Coefficents for compensation
     # Read data back from 0x04(04), 8 bytes
     # A0 MSB, A0 LSB, B1 MSB, B1 LSB, B2 MSB, B2 LSB, C12 MSB, C12 LSB
-    data = bus.read_i2c_block_data(MPL_Addr, 0x04, 8)
+    data = burstRead(MPL_Addr, 0x04, 8)
     
     # Convert the data to floating points
     A0 = (data[0] * 256 + data[1]) / 8.0
@@ -167,6 +816,7 @@ def setupMPL():
     
     print("in setupMPL:  A0: %f, B1: %f, B2: %f, C12: %f" %(A0, B1, B2, C12))
 
+@profiled
 def sendMPLData(sensorVals):
     print("Sending pressure data ...")
   
@@ -182,7 +832,7 @@ def sendMPLData(sensorVals):
     # MPL115A2 address, 0x60(96)
     # Read data back from 0x00(00), 4 bytes
     # pres MSB, pres LSB, temp MSB, temp LSB
-    data = bus.read_i2c_block_data(0x60, 0x00, 4)
+    data = burstRead(0x60, 0x00, 4)
     
     # Convert the data to 10-bits  Note that we calculate the temperature,
     # then discard it after using it for compensation
@@ -197,11 +847,12 @@ def sendMPLData(sensorVals):
     
     print("Pressure: {}".format(pressure))
     # store the pressure into sensorVals dict
-    sensorVals[PRESSURE_SENSOR_IDX] = round(pressure, 5);
+    sensorVals[PRESSURE_SENSOR_IDX] = round(pressure, config["precision"])
 
 # There's nothing for the setup routine to set up, so proceed to sending a 
 # sample back to the server.
 # This is from https://github.com/ControlEverythingCommunity/ADC121C021/blob/master/Arduino/ADC121C021.ino
+@profiled
 def setupGas():
 
     # Select configuration register, 0x02(02)
@@ -210,20 +861,22 @@ def setupGas():
     
     time.sleep(0.5)
     
+@profiled
 def sendGasData(sensorVals):
     print("Sending Gas")
     
     # Read data back from 0x00(00), 2 bytes
     # raw_adc MSB, raw_adc LSB
-    data = bus.read_i2c_block_data(GAS_Addr, 0x00, 2)
+    data = burstRead(GAS_Addr, 0x00, 2)
     
     # Convert the data to 12-bits
     raw_adc = (data[0] & 0x0F) * 256 + data[1]
     
     # store the gas measurement into sensorVals dict
     print("Gas: {}".format(raw_adc))
-    sensorVals[GAS_SENSOR_IDX] = round(raw_adc, 5)
+    sensorVals[GAS_SENSOR_IDX] = round(raw_adc, config["precision"])
     
+@profiled
 def setupSoilData():
 
     # Select configuration register, 0x02(02)
@@ -232,22 +885,24 @@ def setupSoilData():
     
     time.sleep(0.5)
     
+@profiled
 def sendSoilData(sensorVals):
     print("Sending Soil")
     
     # Read data back from 0x00(00), 2 bytes
     # raw_adc MSB, raw_adc LSB
-    data = bus.read_i2c_block_data(SOIL_Addr, 0x00, 2)
+    data = burstRead(SOIL_Addr, 0x00, 2)
     
     # Convert the data to 12-bits
     raw_adc = (data[0] & 0x0F) * 256 + data[1]
     
     # store the soil measurement into sensorVals dict
     print("Soil: {}".format(raw_adc))
-    sensorVals[SOIL_SENSOR_IDX] = round(raw_adc, 5)
+    sensorVals[SOIL_SENSOR_IDX] = round(raw_adc, config["precision"])
 
 
 # Set up the proximity detector.
+@profiled
 def setupProximity():
     print("Sending Proximity")
     
@@ -273,12 +928,13 @@ def setupProximity():
 
     time.sleep(0.8)
 
+@profiled
 def sendProximityData(sensorVals):
     print("Sending proximity data ...")
     
     # Read data back from 0x18(57) with command register 0x80(128), 2 bytes
     # Proximity lsb, Proximity msb
-    data = bus.read_i2c_block_data(PROXY_Addr, 0x18 | 0x80, 2)
+    data = burstRead(PROXY_Addr, 0x18 | 0x80, 2)
 
     # Convert the dataAccording to 
     # https://www.renesas.com/us/en/www/doc/application-note/an1436.pdf,
@@ -288,18 +944,20 @@ def sendProximityData(sensorVals):
     # and the actual distance (mostly, kinda, sort of).
     # if signal = 1 / (distance squared), distance squared = 1/signal.
     # so distance = sqrt(1/signal).  Scale the distance so it doesn't
-    # look like it's measured in light-years.
+    # look like it's measured in light-years.  A signal of 0 means there's
+    # nothing in range at all.
     proximity = data[1] * 256 + data[0]
-    distance = 1000.0 * math.sqrt(1.0 / float(proximity))
+    distance = 1000.0 * math.sqrt(1.0 / float(proximity)) if proximity else float("inf")
 
 
     # store the proximity measurement into sensorVals dict
     print("Proximity: {}".format(proximity))
     print("Distance: {}".format(distance))
-    sensorVals[PROXY_SENSOR_IDX] = round(proximity, 5)
+    sensorVals[PROXY_SENSOR_IDX] = round(proximity, config["precision"])
 
 
 # Reference: https://github.com/ControlEverythingCommunity/TSL2561/blob/master/Python/TSL2561.py
+@profiled
 def setupTSL():
 
     # Select control register, 0x00(00) with command register, 0x80(128)
@@ -312,14 +970,14 @@ def setupTSL():
 
     time.sleep(0.5)
 
+@profiled
 def sendTSLData(sensorVals):
     # Read data back from 0x0C(12) with command register, 0x80(128), 2 bytes
     # ch0 LSB, ch0 MSB
-    data = bus.read_i2c_block_data(TSL_Addr, 0x0C | 0x80, 2)
-
-    # Read data back from 0x0E(14) with command register, 0x80(128), 2 bytes
+    # and from 0x0E(14) with command register, 0x80(128), 2 bytes
     # ch1 LSB, ch1 MSB
-    data1 = bus.read_i2c_block_data(TSL_Addr, 0x0E | 0x80, 2)
+    # The registers are adjacent, so this is a single 4 byte read.
+    data, data1 = readRegisters(TSL_Addr, [(0x0C, 2), (0x0E, 2)], command=0x80)
 
     # Convert the data
     ch0 = data[1] * 256 + data[0]
@@ -328,8 +986,1487 @@ def sendTSLData(sensorVals):
     # post the current Visible and IR lux values
     print("Visible Light: {}".format(ch0 - ch1))
     print("Infrared Light: {}".format(ch1))
-    sensorVals[VISIBLE_LIGHT_SENSOR_IDX] = round((ch0 - ch1), 5)
-    sensorVals[INFRARED_LIGHT_SENSOR_IDX] = round(ch1, 5)
+    sensorVals[VISIBLE_LIGHT_SENSOR_IDX] = round((ch0 - ch1), config["precision"])
+    sensorVals[INFRARED_LIGHT_SENSOR_IDX] = round(ch1, config["precision"])
+
+# Several parts of this program want the latest sensor values - the periodic
+# status publisher, the interrupt threads and the display.  sensorVals only
+# lives for one trip through the main loop, so we also keep the latest value
+# of every sensor index in a cache.  Each entry remembers when it was read.
+# A consumer asks for a value along with the oldest reading it's willing to
+# accept (maxAge, in seconds).  If the cached value is young enough, it's
+# handed back without touching the I2C bus.  Only stale values cause a read.
+#
+# The send*Data routines each read one device and may produce more than one
+# sensor index (HCPA gives us humidity and temperature), so reads happen one
+# routine at a time.  Each routine gets its own lock.  If two threads ask for
+# the same stale value at once, the second one waits for the first one's read
+# and then uses its result instead of reading the bus again.
+class SensorCache:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # sensorIndex -> (value, time.monotonic() when it was read)
+        self.entries = {}
+        # read routine -> lock that serializes reads of that device
+        self.readLocks = {}
+
+    def put(self, sensorIndex, value, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+        with self.lock:
+            self.entries[sensorIndex] = (value, timestamp)
+
+    # Return the cached value of sensorIndex, or None if we don't have one
+    # that's younger than maxAge seconds.
+    def get(self, sensorIndex, maxAge):
+        with self.lock:
+            entry = self.entries.get(sensorIndex)
+        if entry is None or time.monotonic() - entry[1] > maxAge:
+            return None
+        return entry[0]
+
+    # Return a {sensorIndex: value} dict for every index produced by
+    # readRoutine.  The bus is only read if at least one of them is stale.
+    def read(self, readRoutine, sensorIndices, maxAge):
+        vals = self.fresh(sensorIndices, maxAge)
+        if vals is not None:
+            return vals
+
+        with self.lock:
+            readLock = self.readLocks.setdefault(readRoutine, threading.Lock())
+        with readLock:
+            # somebody else may have done the read while we were waiting
+            vals = self.fresh(sensorIndices, maxAge)
+            if vals is not None:
+                return vals
+            vals = {}
+            readRoutine(vals)
+            now = time.monotonic()
+            with self.lock:
+                for sensorIndex, value in vals.items():
+                    self.entries[sensorIndex] = (value, now)
+            return vals
+
+    # Return {sensorIndex: value} if all of sensorIndices are fresh, else None.
+    def fresh(self, sensorIndices, maxAge):
+        now = time.monotonic()
+        vals = {}
+        with self.lock:
+            for sensorIndex in sensorIndices:
+                entry = self.entries.get(sensorIndex)
+                if entry is None or now - entry[1] > maxAge:
+                    return None
+                vals[sensorIndex] = entry[0]
+        return vals
+
+sensorCache = SensorCache()
+
+# Each read routine and the sensor indices it fills in.
+SENSOR_READERS = (
+    (sendHCPAData, (HUMIDITY_SENSOR_IDX, TEMPERATURE_SENSOR_IDX)),
+    (sendMPLData, (PRESSURE_SENSOR_IDX,)),
+    (sendGasData, (GAS_SENSOR_IDX,)),
+    (sendSoilData, (SOIL_SENSOR_IDX,)),
+    (sendProximityData, (PROXY_SENSOR_IDX,)),
+    (sendTSLData, (VISIBLE_LIGHT_SENSOR_IDX, INFRARED_LIGHT_SENSOR_IDX)),
+)
+
+# The status publisher is happy with anything read in the last second.  That
+# lets it share a read that an interrupt thread just did.
+STATUS_MAX_AGE = 1.0
+
+# Each read routine has a setup routine that has to run before it works.
+SENSOR_SETUPS = {
+    sendMPLData: setupMPL,
+    sendGasData: setupGas,
+    sendSoilData: setupSoilData,
+    sendProximityData: setupProximity,
+    sendTSLData: setupTSL,
+}
+
+# Circuit breakers.  A sensor that fails (a bus error, a timeout, or anything
+# else its routines raise on a reading they can't handle) is left alone for a
+# while instead of costing us a timeout, or the whole cycle, every time.  The
+# wait starts at BREAKER_BASE_BACKOFF seconds and doubles with every failure
+# in a row, up to BREAKER_MAX_BACKOFF.  Once it's over we try the sensor again,
+# running its setup routine first, since a device that dropped off the bus
+# has probably forgotten its configuration.  One good read closes the
+# breaker.  While a breaker is open its sensor indices are left out of the
+# records, and the metrics say which sensors are failing.
+BREAKER_BASE_BACKOFF = 5.0
+BREAKER_MAX_BACKOFF = 300.0
+
+class CircuitBreaker:
+    def __init__(self, name):
+        self.name = name
+        self.failures = 0
+        self.retryTime = 0.0
+        self.needsSetup = False
+
+    def isOpen(self):
+        return self.failures > 0
+
+    # May we use the sensor now?
+    def allow(self, now):
+        return self.failures == 0 or now >= self.retryTime
+
+    def success(self):
+        if self.failures:
+            print("%s is working again"%(self.name))
+        self.failures = 0
+        self.needsSetup = False
+
+    def failure(self, now, err):
+        self.failures += 1
+        self.needsSetup = True
+        backoff = min(BREAKER_BASE_BACKOFF * 2 ** (self.failures - 1), BREAKER_MAX_BACKOFF)
+        self.retryTime = now + backoff
+        print("%s failed (%s), trying again in %.0f s"%(self.name, err, backoff))
+
+breakers = {readRoutine: CircuitBreaker(readRoutine.__name__) 
+            for readRoutine, sensorIndices in SENSOR_READERS}
+
+# Run a setup routine, tripping the breaker of its read routine if it fails.
+def setupSensor(readRoutine):
+    setupRoutine = SENSOR_SETUPS.get(readRoutine)
+    breaker = breakers[readRoutine]
+    try:
+        if setupRoutine is not None:
+            setupRoutine()
+        breaker.needsSetup = False
+        return True
+    except Exception as err:
+        breaker.failure(time.monotonic(), err)
+        return False
+
+# Read one sensor through the cache, guarded by its breaker.  Returns the
+# values, or None if the sensor is resting or just failed.
+def readSensor(readRoutine, sensorIndices, maxAge):
+    breaker = breakers[readRoutine]
+    if not breaker.allow(time.monotonic()):
+        return None
+    if breaker.needsSetup and not setupSensor(readRoutine):
+        return None
+    try:
+        vals = sensorCache.read(readRoutine, sensorIndices, maxAge)
+    except Exception as err:
+        breaker.failure(time.monotonic(), err)
+        return None
+    breaker.success()
+    return vals
+
+# Interrupt-driven sensing.  The proximity sensor and the TSL2561 can both 
+# watch their own readings and pull their INT pin low when a reading leaves a
+# window we give them.  If that pin is wired to a GPIO line (PROXY_INT_PIN
+# and TSL_INT_PIN hold the line numbers on GPIO_CHIP), the sensor isn't 
+# polled on the cycle any more.  A thread waits for the falling edge, reads 
+# the sensor, moves the window to sit around the new reading, clears the 
+# interrupt and publishes - milliseconds after the change instead of up to a
+# whole period later, and with no bus traffic at all while nothing happens.
+# Each window is INTERRUPT_BAND of the reading wide on either side, but at
+# least INTERRUPT_MIN_BAND counts.
+#
+# Every INTERRUPT_HEARTBEAT seconds without an edge the sensors are read
+# anyway, in case an edge got lost or a sensor forgot its settings.  A sensor
+# that fails is handled by its circuit breaker like any other, and arming it
+# again always rewrites the whole interrupt setup.
+#
+# The GPIO lines come from the gpiod package (the version 2 API).  Set 
+# GPIO_BACKEND to sim to use SimulatedEdges instead, which only sees edges 
+# that somebody calls trigger() for.
+PROXY_INT_PIN = os.getenv('PROXY_INT_PIN')
+TSL_INT_PIN = os.getenv('TSL_INT_PIN')
+GPIO_CHIP = os.getenv('GPIO_CHIP', '/dev/gpiochip0')
+GPIO_BACKEND = os.getenv('GPIO_BACKEND', 'gpiod')
+INTERRUPT_BAND = float(os.getenv('INTERRUPT_BAND', '0.1'))
+INTERRUPT_MIN_BAND = 16
+INTERRUPT_HEARTBEAT = 60.0
+
+# The window of raw readings that won't cause an interrupt.
+def thresholdWindow(level):
+    band = max(INTERRUPT_BAND * level, INTERRUPT_MIN_BAND)
+    return max(0, int(level - band)), min(0xFFFF, int(level + band))
+
+# The proximity thresholds are compared with the proximity reading.
+def proximityLevel(vals):
+    return vals[PROXY_SENSOR_IDX]
+
+def armProximityInterrupt(low, high):
+    # PILTL, PILTH, PIHTL and PIHTH, 0x08 - 0x0B, with command register
+    # 0xA0 (auto-increment) so all four go in one write
+    bus.write_i2c_block_data(PROXY_Addr, 0x08 | 0xA0, 
+                             [low & 0xFF, low >> 8, high & 0xFF, high >> 8])
+    # Select persistence register, 0x0C(12), with command register 0x80(128)
+    #       0x20(32)    Interrupt after 2 readings in a row out of the window
+    bus.write_byte_data(PROXY_Addr, 0x0C | 0x80, 0x20)
+    # Select the ENABLE register, 0x00(0), with command register 0x80(128)
+    #       0x2D(45)    As in setupProximity, plus proximity interrupt enabled
+    bus.write_byte_data(PROXY_Addr, 0x00 | 0x80, 0x2D)
+
+def clearProximityInterrupt():
+    # special function 0x05, proximity interrupt clear
+    bus.write_byte(PROXY_Addr, 0xE5)
+
+# The TSL2561 compares its thresholds with channel 0, which is visible plus
+# infrared.
+def tslLevel(vals):
+    return vals[VISIBLE_LIGHT_SENSOR_IDX] + vals[INFRARED_LIGHT_SENSOR_IDX]
+
+def armTSLInterrupt(low, high):
+    # THRESHLOW at 0x02(02) and THRESHHIGH at 0x04(04), with command 
+    # register 0xA0 (word protocol)
+    bus.write_word_data(TSL_Addr, 0x02 | 0xA0, low)
+    bus.write_word_data(TSL_Addr, 0x04 | 0xA0, high)
+    # Select interrupt register, 0x06(06) with command register, 0x80(128)
+    #       0x11(17)    Level interrupt, after 1 integration out of the window
+    bus.write_byte_data(TSL_Addr, 0x06 | 0x80, 0x11)
+
+def clearTSLInterrupt():
+    # command register with the CLEAR bit
+    bus.write_byte(TSL_Addr, 0xC0)
+
+class InterruptSource:
+    def __init__(self, pin, level, arm, clear):
+        self.pin = pin
+        self.level = level
+        self.arm = arm
+        self.clear = clear
+
+INTERRUPT_SOURCES = {
+    sendProximityData: InterruptSource(PROXY_INT_PIN, proximityLevel, 
+                                       armProximityInterrupt, clearProximityInterrupt),
+    sendTSLData: InterruptSource(TSL_INT_PIN, tslLevel, armTSLInterrupt, clearTSLInterrupt),
+}
+
+# The read routines that are interrupt driven, so the cycle leaves them alone.
+interruptRoutines = set()
+
+# One edge on one line, like a gpiod.EdgeEvent.
+class EdgeEvent:
+    __slots__ = ("line_offset", "timestamp_ns")
+
+    def __init__(self, line_offset, timestamp_ns):
+        self.line_offset = line_offset
+        self.timestamp_ns = timestamp_ns
+
+# Stands in for a gpiod line request.  Edges only happen when trigger() is
+# called.
+class SimulatedEdges:
+    def __init__(self, offsets):
+        self.offsets = offsets
+        self.condition = threading.Condition()
+        self.events = []
+        self.released = False
+
+    def trigger(self, offset):
+        with self.condition:
+            self.events.append(EdgeEvent(offset, time.monotonic_ns()))
+            self.condition.notify_all()
+
+    def wait_edge_events(self, timeout=None):
+        with self.condition:
+            return bool(self.condition.wait_for(lambda: self.events or self.released, timeout) 
+                        and self.events)
+
+    def read_edge_events(self):
+        with self.condition:
+            events = self.events
+            self.events = []
+        return events
+
+    # wake up anybody who's waiting, like closing the request would
+    def release(self):
+        with self.condition:
+            self.released = True
+            self.condition.notify_all()
+
+# Ask for falling edges on the INT lines.  The INT pins are open drain, so
+# the lines get a pull-up.
+def requestEdgeEvents(offsets):
+    if GPIO_BACKEND == "sim":
+        return SimulatedEdges(offsets)
+    import gpiod
+    from gpiod.line import Bias, Edge
+    settings = gpiod.LineSettings(edge_detection=Edge.FALLING, bias=Bias.PULL_UP)
+    return gpiod.request_lines(GPIO_CHIP, consumer="gigabits", 
+                               config={tuple(offsets): settings})
+
+class InterruptWatcher(threading.Thread):
+    def __init__(self, request, lines):
+        super().__init__(daemon=True)
+        self.request = request
+        # GPIO line -> read routine
+        self.lines = lines
+        self.events = 0
+        self.running = True
+
+    def run(self):
+        while self.running:
+            edges = self.request.wait_edge_events(INTERRUPT_HEARTBEAT)
+            if not self.running:
+                return
+            if not edges:
+                for readRoutine in self.lines.values():
+                    self.service(readRoutine)
+                continue
+            for event in self.request.read_edge_events():
+                readRoutine = self.lines.get(event.line_offset)
+                if readRoutine is not None:
+                    self.service(readRoutine)
+                    self.events += 1
+
+    def stop(self):
+        self.running = False
+        self.request.release()
+
+    # Read the sensor, arm its window around the new reading, clear the
+    # interrupt and publish what we read.  Whatever goes wrong trips the
+    # sensor's breaker rather than ending the thread, and the heartbeat tries
+    # again once the breaker lets it.
+    def service(self, readRoutine):
+        source = INTERRUPT_SOURCES[readRoutine]
+        vals = readSensor(readRoutine, dict(SENSOR_READERS)[readRoutine], 0)
+        if vals is None:
+            return
+        try:
+            source.arm(*thresholdWindow(source.level(vals)))
+            source.clear()
+        except Exception as err:
+            breakers[readRoutine].failure(time.monotonic(), err)
+            return
+        try:
+            publishSamples({}, [(time.time(), vals)], config)
+        except Exception as err:
+            print("Couldn't publish %s: %r"%(readRoutine.__name__, err))
+
+# Start watching every sensor that has an INT line set up.  Returns the
+# watcher, or None if no sensor is interrupt driven.
+def startInterruptSensing():
+    lines = {}
+    for readRoutine, source in INTERRUPT_SOURCES.items():
+        if source.pin:
+            lines[int(source.pin)] = readRoutine
+    if not lines:
+        return None
+    try:
+        request = requestEdgeEvents(list(lines))
+    except ImportError:
+        print("Interrupt sensing needs the gpiod package, polling instead")
+        return None
+
+    watcher = InterruptWatcher(request, lines)
+    for readRoutine in lines.values():
+        interruptRoutines.add(readRoutine)
+        # the first read arms the window
+        watcher.service(readRoutine)
+    watcher.start()
+    return watcher
+
+# Adaptive sampling.  A fixed period wastes power and bandwidth on a flat
+# signal and misses events on a busy one.  When ADAPTIVE_SAMPLING is on, each
+# read routine gets its own sampling interval.  After every sample we work out
+# how much its values changed since the last sample, relative to their size.
+# A busy signal halves the interval, down to ADAPTIVE_MIN_INTERVAL.  A quiet one
+# grows it by half again, up to ADAPTIVE_MAX_INTERVAL.  The main loop then
+# wakes up every ADAPTIVE_MIN_INTERVAL seconds and only reads, and publishes,
+# the sensors that are due.
+ADAPTIVE_SAMPLING = os.getenv('ADAPTIVE_SAMPLING', 'False') == 'True'
+ADAPTIVE_MIN_INTERVAL = float(os.getenv('ADAPTIVE_MIN_INTERVAL', '2'))
+ADAPTIVE_MAX_INTERVAL = float(os.getenv('ADAPTIVE_MAX_INTERVAL', '60'))
+# relative change between samples that counts as "busy".  0.02 is 2%.
+ADAPTIVE_CHANGE_THRESHOLD = float(os.getenv('ADAPTIVE_CHANGE_THRESHOLD', '0.02'))
+
+# Without adaptive sampling everything is read every STATUS_PERIOD seconds.
+STATUS_PERIOD = 10
+
+class AdaptiveSampler:
+    def __init__(self, minInterval, maxInterval, changeThreshold):
+        self.minInterval = minInterval
+        self.maxInterval = maxInterval
+        self.changeThreshold = changeThreshold
+        # start fast so we learn what the signal looks like quickly
+        self.interval = minInterval
+        self.nextTime = 0.0
+        # smoothed relative change, so one noisy sample doesn't flip us around
+        self.activity = 0.0
+        # sensorIndex -> value of the previous sample
+        self.previous = {}
+
+    def due(self, now):
+        return now >= self.nextTime
+
+    def update(self, vals, now):
+        change = 0.0
+        for sensorIndex, value in vals.items():
+            previous = self.previous.get(sensorIndex)
+            if previous is not None:
+                # scale by the size of the value so a 12-bit ADC count and a
+                # pressure in kPa can share one threshold.  Keep the divisor
+                # away from zero for signals that sit near zero.
+                change = max(change, 
+                             abs(value - previous) / max(abs(previous), 1.0))
+            self.previous[sensorIndex] = value
+
+        self.activity = 0.5 * self.activity + 0.5 * change
+        if self.activity > self.changeThreshold:
+            self.interval = max(self.minInterval, self.interval / 2)
+        else:
+            self.interval = min(self.maxInterval, self.interval * 1.5)
+        self.nextTime = now + self.interval
+
+samplers = {readRoutine: AdaptiveSampler(ADAPTIVE_MIN_INTERVAL, ADAPTIVE_MAX_INTERVAL,
+                                         ADAPTIVE_CHANGE_THRESHOLD)
+            for readRoutine, sensorIndices in SENSOR_READERS}
+
+# Drift-free timing for the main loop.  Sleeping for a fixed time after each
+# cycle makes the real period the sleep plus however long the cycle took, so
+# our timestamps slowly walk away from everybody else's.  Instead we work
+# from absolute deadlines on the monotonic clock.  Deadlines are lined up with
+# multiples of the period on the wall clock, plus a per-device phase offset,
+# so a fleet of devices doesn't all publish in the same instant.
+#
+# If a cycle runs past the next deadline, that's an overrun.  We start the
+# next cycle right away.  If we're more than a whole period late, the
+# deadlines we missed are skipped rather than run back to back.  Jitter is
+# how late we actually woke up compared to the deadline.  A wait can also be
+# cut short by an Event, so a new config doesn't have to sit out a long
+# period before it takes effect.
+class PeriodicScheduler:
+    def __init__(self, period, phase=0.0):
+        self.setPeriod(period, phase)
+        self.cycles = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.lastJitter = 0.0
+        self.resetJitter()
+
+    # Change the period.  The next deadline moves to the new grid.
+    def setPeriod(self, period, phase=0.0):
+        self.period = period
+        self.phase = phase % period
+        # find the next wall clock time that's phase past a multiple of
+        # period and turn it into a monotonic deadline
+        wallNow = time.time()
+        wallDeadline = (math.floor((wallNow - self.phase) / period) + 1) * period + self.phase
+        self.deadline = time.monotonic() + (wallDeadline - wallNow)
+
+    def resetJitter(self):
+        self.jitterSum = 0.0
+        self.jitterMax = 0.0
+        self.jitterCount = 0
+
+    # Sleep until the next deadline and return True, or return False as soon
+    # as wake is set.  Being woken doesn't count as a cycle.
+    def wait(self, wake=None):
+        now = time.monotonic()
+        if now < self.deadline:
+            if wake is None:
+                time.sleep(self.deadline - now)
+            elif wake.wait(self.deadline - now):
+                wake.clear()
+                return False
+        else:
+            self.overruns += 1
+            missed = int((now - self.deadline) // self.period)
+            if missed > 0:
+                print("Overran by %d cycles, skipping them"%(missed))
+                self.skipped += missed
+                self.deadline += missed * self.period
+
+        jitter = time.monotonic() - self.deadline
+        self.lastJitter = jitter
+        self.jitterSum += jitter
+        self.jitterMax = max(self.jitterMax, jitter)
+        self.jitterCount += 1
+
+        self.cycles += 1
+        self.deadline += self.period
+        return True
+
+    # Timing statistics, in milliseconds.  The jitter figures cover the time
+    # since the last call.
+    def stats(self):
+        stats = {
+            "cycles": self.cycles,
+            "overruns": self.overruns,
+            "skipped": self.skipped,
+            "jitterMean": round(1000.0 * self.jitterSum / max(self.jitterCount, 1), 3),
+            "jitterMax": round(1000.0 * self.jitterMax, 3),
+        }
+        self.resetJitter()
+        return stats
+
+# Spread devices across the period.  STATUS_PHASE, in seconds, wins if it's
+# set.  Otherwise the phase comes from a hash of the devkey, which is stable
+# from one boot to the next.
+def statusPhase(period):
+    phase = os.getenv('STATUS_PHASE')
+    if phase is not None:
+        return float(phase)
+    return (zlib.crc32(str(MQTT_DEVKEY).encode()) % 1000) / 1000.0 * period
+
+# The effective sample rate of every sensor index goes out on the metrics
+# topic every METRICS_PERIOD seconds.
+METRICS_PERIOD = 60
+metricsTime = time.monotonic()
+# sensorIndex -> samples taken since the last report
+sampleCounts = {}
+
+def sendMetrics():
+    global metricsTime
+
+    now = time.monotonic()
+    elapsed = now - metricsTime
+    metricsTime = now
+
+    # samples per second that were actually taken since the last report
+    sampleRates = {}
+    for readRoutine, sensorIndices in SENSOR_READERS:
+        for sensorIndex in sensorIndices:
+            sampleRates[sensorIndex] = round(sampleCounts.get(sensorIndex, 0) / elapsed, 5)
+    sampleCounts.clear()
+
+    metrics = {
+        "sampleRate": sampleRates,
+        "timing": scheduler.stats(),
+    }
+    if args.publish_timing:
+        metrics["stages"] = profiler.summary()
+    if compressor.mode != "none":
+        metrics["compression"] = compressor.stats()
+    failing = {breaker.name: breaker.failures for breaker in breakers.values() 
+               if breaker.isOpen()}
+    if failing:
+        metrics["failingSensors"] = failing
+    data = json.dumps(metrics, separators=(',', ':'))
+    mmi = topicAliases.publish(client, "device/%s/metrics"%(MQTT_DEVKEY), data)
+    print("Result of attempting to publish metrics: %s"%(mqtt.error_string(mmi.rc)))
+
+# Device configuration that the server can change on the fly.  Anything here
+# can be pushed as JSON on server/<devkey>/config and takes effect on the next
+# trip through the main loop - no restart, no reconnect, no TLS handshake and
+# no sensor setup.  A config message only needs the keys it wants to change,
+# plus a version that's higher than the one we're running:
+#     {"version": 7, "statusPeriod": 30, "deadbands": {"2": 0.5}}
+# The update is merged into a copy of the current config and checked.  If
+# anything is wrong with it the whole update is rejected and we carry on with
+# the config we had.  Either way the outcome is published on
+# device/<devkey>/config.  The last good config is saved in CONFIG_FILE so it
+# survives a reboot.
+#
+#   statusPeriod     seconds between status cycles without adaptive sampling
+#   precision        decimal places the sensor values are rounded to
+#   enabledSensors   the sensor indices we read and publish
+#   deadbands        sensorIndex -> how far a value has to move from the last
+#                    published value before we publish it again
+#   adaptive         adaptive sampling: enabled, minInterval, maxInterval and
+#                    changeThreshold
+#   batch            maxSamples samples per sensor index are sent together in
+#                    one records message, or whatever we have once the oldest
+#                    is maxAge seconds old.  maxSamples of 1 means no batching.
+#                    encoding is "json" or "columnar" (see encodeSeries).
+CONFIG_FILE = os.getenv('CONFIG_FILE', 
+                        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'deviceconfig.json'))
+
+ALL_SENSOR_INDICES = [sensorIndex for readRoutine, sensorIndices in SENSOR_READERS 
+                      for sensorIndex in sensorIndices]
+
+DEFAULT_CONFIG = {
+    "version": 0,
+    "statusPeriod": STATUS_PERIOD,
+    "precision": 5,
+    "enabledSensors": ALL_SENSOR_INDICES,
+    "deadbands": {},
+    "adaptive": {
+        "enabled": ADAPTIVE_SAMPLING,
+        "minInterval": ADAPTIVE_MIN_INTERVAL,
+        "maxInterval": ADAPTIVE_MAX_INTERVAL,
+        "changeThreshold": ADAPTIVE_CHANGE_THRESHOLD,
+    },
+    "batch": {
+        "maxSamples": 1,
+        "maxAge": 60,
+        "encoding": "json",
+    },
+}
+
+# The config in use.  It's never changed in place.  An update builds a new
+# dict and swaps it in, so a reader that grabs config once per cycle always
+# sees one consistent version.
+config = DEFAULT_CONFIG
+configLock = threading.Lock()
+# Set when a new config has been applied, to wake the sampling loop.
+configChanged = threading.Event()
+
+# Return a copy of base with update merged in.  Nested dicts are merged one
+# level down, so {"adaptive": {"enabled": true}} leaves the intervals alone.
+def mergeConfig(base, update):
+    merged = dict(base)
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = dict(merged[key], **value)
+        else:
+            merged[key] = value
+    return merged
+
+# JSON lets NaN and Infinity through, and True would pass for 1, so neither
+# counts as a number here.
+def isInteger(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+def isNumber(value):
+    return isInteger(value) or (isinstance(value, float) and math.isfinite(value))
+
+# The longest period a config can ask for.  Anything much bigger overflows
+# time.sleep.
+MAX_CONFIG_PERIOD = 24 * 3600
+# The highest version a config can have.  The split process control block
+# (see SplitControl) holds it in 8 unsigned bytes.
+MAX_CONFIG_VERSION = 2 ** 64 - 1
+
+# Return None if cfg is good to go, otherwise a string that says what's wrong
+# with it.
+def validateConfig(cfg):
+    unknown = set(cfg) - set(DEFAULT_CONFIG)
+    if unknown:
+        return "unknown keys: %s"%(", ".join(sorted(unknown)))
+    if not isInteger(cfg["version"]) or not 0 <= cfg["version"] <= MAX_CONFIG_VERSION:
+        return "version must be an integer from 0 to %d"%(MAX_CONFIG_VERSION)
+    if not isNumber(cfg["statusPeriod"]) or not 1 <= cfg["statusPeriod"] <= MAX_CONFIG_PERIOD:
+        return "statusPeriod must be from 1 to %d seconds"%(MAX_CONFIG_PERIOD)
+    if not isInteger(cfg["precision"]) or not 0 <= cfg["precision"] <= 10:
+        return "precision must be an integer from 0 to 10"
+    if (not isinstance(cfg["enabledSensors"], list) 
+            or not all(isinstance(sensorIndex, str) for sensorIndex in cfg["enabledSensors"])
+            or not set(cfg["enabledSensors"]) <= set(ALL_SENSOR_INDICES)):
+        return "enabledSensors must be a list of sensor indices"
+    for key in ("deadbands", "adaptive", "batch"):
+        if not isinstance(cfg[key], dict):
+            return "%s must be a JSON object"%(key)
+    for sensorIndex, deadband in cfg["deadbands"].items():
+        if sensorIndex not in ALL_SENSOR_INDICES or not isNumber(deadband) or deadband < 0:
+            return "deadbands must map sensor indices to numbers >= 0"
+    adaptive = cfg["adaptive"]
+    if set(adaptive) != set(DEFAULT_CONFIG["adaptive"]):
+        return "adaptive needs exactly %s"%(", ".join(sorted(DEFAULT_CONFIG["adaptive"])))
+    if not isinstance(adaptive["enabled"], bool):
+        return "adaptive.enabled must be true or false"
+    if (not isNumber(adaptive["minInterval"]) or not isNumber(adaptive["maxInterval"])
+            or not 0.1 <= adaptive["minInterval"] <= adaptive["maxInterval"] <= MAX_CONFIG_PERIOD):
+        return "adaptive intervals must satisfy 0.1 <= minInterval <= maxInterval <= %d"%(
+               MAX_CONFIG_PERIOD)
+    if not isNumber(adaptive["changeThreshold"]) or adaptive["changeThreshold"] <= 0:
+        return "adaptive.changeThreshold must be positive"
+    batch = cfg["batch"]
+    if set(batch) != set(DEFAULT_CONFIG["batch"]):
+        return "batch needs exactly %s"%(", ".join(sorted(DEFAULT_CONFIG["batch"])))
+    if not isInteger(batch["maxSamples"]) or batch["maxSamples"] < 1:
+        return "batch.maxSamples must be a positive integer"
+    if not isNumber(batch["maxAge"]) or not 0 < batch["maxAge"] <= MAX_CONFIG_PERIOD:
+        return "batch.maxAge must be positive and at most %d"%(MAX_CONFIG_PERIOD)
+    if batch["encoding"] not in ("json", "columnar"):
+        return "batch.encoding must be json or columnar"
+    return None
+
+# Apply a config update.  Returns None if it was applied, otherwise the
+# reason it wasn't.
+def updateConfig(update):
+    global config
+
+    if not isinstance(update, dict):
+        return "config must be a JSON object"
+    with configLock:
+        if not isInteger(update.get("version")) or update["version"] <= config["version"]:
+            return "version must be an integer greater than %d"%(config["version"])
+        candidate = mergeConfig(config, update)
+        problem = validateConfig(candidate)
+        if problem is not None:
+            return problem
+        # save it first, so anybody who sees the new version can also read
+        # it from the file
+        saveConfig(candidate)
+        config = candidate
+    configChanged.set()
+    return None
+
+# Write the config to a temporary file and rename it into place, so a power
+# cut can't leave us with half a file.
+def saveConfig(cfg):
+    try:
+        with open(CONFIG_FILE + ".tmp", "w") as f:
+            json.dump(cfg, f)
+        os.replace(CONFIG_FILE + ".tmp", CONFIG_FILE)
+    except OSError as err:
+        print("Couldn't save config: %s"%(err))
+
+# Pick up the config saved by an earlier run, if there is one and it's good.
+def loadConfig():
+    global config
+
+    try:
+        with open(CONFIG_FILE) as f:
+            saved = json.load(f)
+    except (OSError, ValueError):
+        return
+    if not isinstance(saved, dict):
+        print("Ignoring saved config: not a JSON object")
+        return
+    saved = mergeConfig(DEFAULT_CONFIG, saved)
+    problem = validateConfig(saved)
+    if problem is None:
+        config = saved
+        print("Loaded config version %d"%(config["version"]))
+    else:
+        print("Ignoring saved config: %s"%(problem))
+
+def on_config(client, userdata, msg):
+    print("Config received: " + msg.payload.decode(errors="replace"))
+    try:
+        update = json.loads(msg.payload)
+    except (ValueError, RecursionError):
+        update = None
+    # paho doesn't catch what a callback raises, and it would take the network
+    # thread down with it, so anything validateConfig missed is a rejection too
+    try:
+        problem = updateConfig(update)
+    except Exception as err:
+        problem = "couldn't apply config: %r"%(err)
+
+    version = update.get("version") if isinstance(update, dict) else None
+    if problem is None:
+        resp = {"version": version, "status": "applied"}
+        flushStrandedBatch()
+    else:
+        print("Config rejected: " + problem)
+        resp = {"version": version, "status": "rejected", "error": problem,
+                "active": config["version"]}
+    client.publish("device/%s/config"%(MQTT_DEVKEY), payload=json.dumps(resp), 
+                   qos=1, retain=False)
+
+# How often the main loop runs under cfg.
+def cyclePeriod(cfg):
+    if cfg["adaptive"]["enabled"]:
+        return cfg["adaptive"]["minInterval"]
+    return cfg["statusPeriod"]
+
+# Bring the samplers in line with cfg.
+def configureSamplers(cfg):
+    adaptive = cfg["adaptive"]
+    for sampler in samplers.values():
+        sampler.minInterval = adaptive["minInterval"]
+        sampler.maxInterval = adaptive["maxInterval"]
+        sampler.changeThreshold = adaptive["changeThreshold"]
+        sampler.interval = min(max(sampler.interval, sampler.minInterval), sampler.maxInterval)
+
+# Put a new config into effect on the sampling side: the samplers and the
+# scheduler's period.
+def applyConfig(scheduler):
+    print("Switching to config version %d"%(config["version"]))
+    configureSamplers(config)
+    if cyclePeriod(config) != scheduler.period:
+        period = cyclePeriod(config)
+        scheduler.setPeriod(period, statusPhase(period))
+
+# Deadbands.  The last value we published for each sensor index.
+lastPublished = {}
+
+def outsideDeadband(sensorIndex, value, cfg):
+    deadband = cfg["deadbands"].get(sensorIndex, 0)
+    last = lastPublished.get(sensorIndex)
+    if last is not None and abs(value - last) < deadband:
+        return False
+    lastPublished[sensorIndex] = value
+    return True
+
+# Batching.  When batch.maxSamples is more than 1, samples collect here and
+# go out together as
+#     {"1": {"t": [ms, ms, ...], "v": [value, value, ...]}, ...}
+# where t holds the wall clock time of each sample in milliseconds.
+class SampleBatcher:
+    def __init__(self):
+        # sensorIndex -> (times, values), kept in arrays rather than lists.
+        # A list of floats costs a pointer and a float object per sample; 
+        # an array is 8 bytes a sample.
+        self.series = {}
+        self.oldest = None
+
+    def add(self, vals, timestamp):
+        if self.oldest is None:
+            self.oldest = timestamp
+        millis = int(timestamp * 1000)
+        for sensorIndex, value in vals.items():
+            series = self.series.get(sensorIndex)
+            if series is None:
+                series = self.series[sensorIndex] = (array.array('q'), array.array('d'))
+            series[0].append(millis)
+            series[1].append(value)
+
+    def ready(self, batch, timestamp):
+        if self.oldest is None:
+            return False
+        if timestamp - self.oldest >= batch["maxAge"]:
+            return True
+        return any(len(times) >= batch["maxSamples"] for times, values in self.series.values())
+
+    # The values come back out as floats.  Whole numbers go back to being
+    # ints, as they were when they went in.
+    def take(self):
+        records = {sensorIndex: {"t": times.tolist(), 
+                                 "v": [int(value) if value.is_integer() else value 
+                                       for value in values]}
+                   for sensorIndex, (times, values) in self.series.items()}
+        self.series = {}
+        self.oldest = None
+        return records
+
+batcher = SampleBatcher()
+
+# On-device history.  Every sample we read also goes into a fixed-size ring
+# buffer file per sensor index, so the server can ask for high resolution
+# history when something interesting happened, without us having to send
+# everything all the time.
+#
+# The file is memory mapped.  It starts with a header:
+#     magic "GBRB", capacity (u32), writeSeq (u64), reserved (u64)
+# followed by capacity slots of
+#     seq (u64), timestamp (f64, wall clock seconds), value (f64)
+# Sample number n lives in slot n % capacity.  Samples are written with
+# struct.pack_into straight into the map, so there's no allocation per 
+# sample.  A slot is marked invalid (seq 0) while it's being written and
+# stamped with n + 1 when it's done, and only then is writeSeq in the header
+# moved on.  A reader checks the stamp before and after reading a slot, so it
+# never returns a half-written sample.  If we crash part way through a write,
+# the slot is either invalid or fully written, and openFile() recovers
+# writeSeq from the stamps.
+class SampleRing:
+    HEADER = struct.Struct('<4sIQQ')
+    RECORD = struct.Struct('<Qdd')
+    SEQ = struct.Struct('<Q')
+    MAGIC = b'GBRB'
+    # where writeSeq lives in the header
+    WRITE_SEQ_OFFSET = 8
+
+    def __init__(self, buf, capacity):
+        self.buf = buf
+        self.capacity = capacity
+        self.writeSeq = self.SEQ.unpack_from(buf, self.WRITE_SEQ_OFFSET)[0]
+
+    # Bytes needed for a ring that holds capacity samples.
+    @classmethod
+    def size(cls, capacity):
+        return cls.HEADER.size + capacity * cls.RECORD.size
+
+    # Set up an empty ring in buf.
+    @classmethod
+    def format(cls, buf, capacity):
+        buf[:cls.size(capacity)] = bytes(cls.size(capacity))
+        cls.HEADER.pack_into(buf, 0, cls.MAGIC, capacity, 0, 0)
+
+    # Open the ring in path, creating it if needed.  A file that isn't a
+    # ring of the right capacity is started over.
+    @classmethod
+    def openFile(cls, path, capacity):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            size = cls.size(capacity)
+            fresh = os.fstat(fd).st_size != size
+            if fresh:
+                os.ftruncate(fd, size)
+            buf = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        magic, fileCapacity, writeSeq, reserved = cls.HEADER.unpack_from(buf, 0)
+        if fresh or magic != cls.MAGIC or fileCapacity != capacity:
+            cls.format(buf, capacity)
+        ring = cls(buf, capacity)
+        ring.recover()
+        return ring
+
+    def slotOffset(self, seq):
+        return self.HEADER.size + (seq % self.capacity) * self.RECORD.size
+
+    # If we died between stamping a slot and updating writeSeq, catch up.
+    def recover(self):
+        while self.SEQ.unpack_from(self.buf, self.slotOffset(self.writeSeq))[0] == self.writeSeq + 1:
+            self.writeSeq += 1
+        self.SEQ.pack_into(self.buf, self.WRITE_SEQ_OFFSET, self.writeSeq)
+
+    # Add a sample.  Only one process or thread may write to a ring.
+    def append(self, timestamp, value):
+        seq = self.writeSeq
+        offset = self.slotOffset(seq)
+        self.RECORD.pack_into(self.buf, offset, 0, timestamp, value)
+        self.SEQ.pack_into(self.buf, offset, seq + 1)
+        self.writeSeq = seq + 1
+        self.SEQ.pack_into(self.buf, self.WRITE_SEQ_OFFSET, seq + 1)
+
+    # The writeSeq a reader should use.  The writer may be somebody else, so
+    # always look at the header.
+    def committed(self):
+        return self.SEQ.unpack_from(self.buf, self.WRITE_SEQ_OFFSET)[0]
+
+    # Return (timestamp, value) for sample number seq, or None if it's been
+    # overwritten or is being written right now.
+    def read(self, seq):
+        offset = self.slotOffset(seq)
+        stamp, timestamp, value = self.RECORD.unpack_from(self.buf, offset)
+        if stamp != seq + 1 or self.SEQ.unpack_from(self.buf, offset)[0] != stamp:
+            return None
+        return timestamp, value
+
+    # All the samples we still have with start <= timestamp <= end, oldest
+    # first, as two lists: timestamps and values.
+    def query(self, start, end):
+        times = []
+        values = []
+        last = self.committed()
+        for seq in range(max(0, last - self.capacity), last):
+            sample = self.read(seq)
+            if sample is not None and start <= sample[0] <= end:
+                times.append(sample[0])
+                values.append(sample[1])
+        return times, values
+
+    def flush(self):
+        self.buf.flush()
+
+# Where the history files go and how many samples each one holds.  8640 is a
+# day's worth at the default 10 second period, and 1440 is four hours' worth
+# in low-memory mode.  Set HISTORY_DIR to an empty string to turn history off.
+HISTORY_DIR = os.getenv('HISTORY_DIR', 
+                        os.path.join(os.path.dirname(os.path.abspath(__file__)), 'history'))
+HISTORY_CAPACITY = int(os.getenv('HISTORY_CAPACITY', '1440' if LOW_MEMORY else '8640'))
+# The maps are flushed to the SD card this often, in seconds.
+HISTORY_FLUSH_PERIOD = 60
+# Samples per message when we send history to the server.
+HISTORY_PAGE_SIZE = 200
+
+# sensorIndex -> SampleRing.  Empty when history is off.
+historyRings = {}
+historyFlushTime = time.monotonic()
+
+def openHistory():
+    if not HISTORY_DIR:
+        return
+    os.makedirs(HISTORY_DIR, exist_ok=True)
+    for sensorIndex in ALL_SENSOR_INDICES:
+        path = os.path.join(HISTORY_DIR, "sensor%s.ring"%(sensorIndex))
+        historyRings[sensorIndex] = SampleRing.openFile(path, HISTORY_CAPACITY)
+
+def recordHistory(vals, timestamp):
+    global historyFlushTime
+
+    for sensorIndex, value in vals.items():
+        ring = historyRings.get(sensorIndex)
+        if ring is not None:
+            ring.append(timestamp, value)
+
+    if time.monotonic() - historyFlushTime >= HISTORY_FLUSH_PERIOD:
+        historyFlushTime = time.monotonic()
+        for ring in historyRings.values():
+            ring.flush()
+
+# The server asks for history with a query command on server/<devkey>/command:
+#     {"q": "history", "si": "1", "from": ms, "to": ms, "id": "anything"}
+# from and to are wall clock milliseconds.  The answer goes out on 
+# device/<devkey>/history in pages of up to HISTORY_PAGE_SIZE samples:
+#     {"id": "anything", "si": "1", "page": 0, "pages": 3, 
+#      "t": [ms, ...], "v": [value, ...]}
+# There's always at least one page, even if it's empty, so the server knows
+# we heard it.  The pages are sent from their own thread so a big query
+# doesn't hold up the MQTT network thread.
+def sendHistory(client, query):
+    sensorIndex = str(query.get("si"))
+    ring = historyRings.get(sensorIndex)
+    if ring is None:
+        times, values = [], []
+    else:
+        times, values = ring.query(query.get("from", 0) / 1000.0, 
+                                   query.get("to", float("inf")) / 1000.0)
+
+    pages = max(1, (len(times) + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE)
+    for page in range(pages):
+        first = page * HISTORY_PAGE_SIZE
+        last = first + HISTORY_PAGE_SIZE
+        resp = {
+            "id": query.get("id"),
+            "si": sensorIndex,
+            "page": page,
+            "pages": pages,
+            "t": [int(t * 1000) for t in times[first:last]],
+            "v": values[first:last],
+        }
+        client.publish("device/%s/history"%(MQTT_DEVKEY), 
+                       payload=json.dumps(resp, separators=(',', ':')), qos=1, retain=False)
+
+# Queries are answered one at a time by a single thread, so a burst of them
+# can't pile up threads.  If HISTORY_QUERY_QUEUE are already waiting, the
+# new one is dropped.
+HISTORY_QUERY_QUEUE = 4
+historyQueries = queue.Queue(HISTORY_QUERY_QUEUE)
+historyThread = None
+
+def answerHistoryQueries():
+    while True:
+        client, query = historyQueries.get()
+        # this is the only thread there is, so one bad query mustn't end it
+        try:
+            sendHistory(client, query)
+        except Exception as err:
+            print("History query failed: %r"%(err))
+
+def startHistoryQuery(client, query):
+    global historyThread
+
+    if historyThread is None:
+        historyThread = threading.Thread(target=answerHistoryQueries, daemon=True)
+        historyThread.start()
+    try:
+        historyQueries.put_nowait((client, query))
+    except queue.Full:
+        print("Too many history queries waiting, dropping one")
+
+# Compression for outbound records.  Our records are tiny JSON objects like
+#     {"1":43.2,"2":71.5,"4":101.3,...}
+# and a general purpose compressor can't do much with something that short,
+# because it has nothing to refer back to.  So we hand it a preset
+# dictionary of the strings our records are made of.  The server has the same
+# dictionaries, looked up by version number.  Never change a dictionary that's
+# been shipped; add a new version instead.
+#
+# COMPRESSION picks the mode:
+#   none   plain JSON, as always
+#   zlib   raw deflate with ZLIB_DICTIONARIES[ZLIB_DICTIONARY_VERSION]
+#   zstd   zstandard with the trained dictionary in the file ZSTD_DICTIONARY,
+#          whose version is ZSTD_DICTIONARY_VERSION.  Needs the zstandard
+#          package; without it we fall back to zlib.
+#
+# A compressed payload starts with a three byte header: 0xFE, the algorithm
+# (1 is zlib, 2 is zstd) and the dictionary version.  JSON can never start
+# with 0xFE, so the server can tell the two apart.  If compressing doesn't
+# make the payload smaller, we send the plain JSON instead.
+COMPRESSION = os.getenv('COMPRESSION', 'none')
+ZLIB_DICTIONARY_VERSION = int(os.getenv('ZLIB_DICTIONARY_VERSION', '1'))
+ZSTD_DICTIONARY = os.getenv('ZSTD_DICTIONARY')
+ZSTD_DICTIONARY_VERSION = int(os.getenv('ZSTD_DICTIONARY_VERSION', '1'))
+
+COMPRESSED_MAGIC = 0xFE
+COMPRESSED_ZLIB = 1
+COMPRESSED_ZSTD = 2
+
+# zlib gets the most out of strings near the end of the dictionary, so the
+# commonest ones go last.
+ZLIB_DICTIONARIES = {
+    1: (b'"t":[' b'"v":[' b'.0,' b'0123456789' b'}},' 
+        + b''.join(b',"%d":'%(i) for i in range(9, 1, -1)) + b'{"1":'),
+}
+
+# A setting we can't use costs us the compression, not the app: we say so and
+# fall back to something that works.
+class PayloadCompressor:
+    def __init__(self, mode):
+        self.mode = mode
+        if mode not in ("none", "zlib", "zstd"):
+            print("Unknown COMPRESSION %s, sending plain JSON"%(mode))
+            self.mode = "none"
+        zstandard = None
+        if mode == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                pass
+        if mode == "zstd" and (zstandard is None or not ZSTD_DICTIONARY):
+            print("zstd compression needs the zstandard package and ZSTD_DICTIONARY, using zlib")
+            self.mode = "zlib"
+
+        if self.mode == "zstd":
+            try:
+                with open(ZSTD_DICTIONARY, "rb") as f:
+                    dictionary = zstandard.ZstdCompressionDict(f.read())
+            except OSError as err:
+                print("Couldn't read ZSTD_DICTIONARY (%s), using zlib"%(err))
+                self.mode = "zlib"
+            else:
+                self.header = bytes([COMPRESSED_MAGIC, COMPRESSED_ZSTD, ZSTD_DICTIONARY_VERSION])
+                # level 19 wants tens of MB for its tables
+                self.zstd = zstandard.ZstdCompressor(level=3 if LOW_MEMORY else 19, 
+                                                     dict_data=dictionary, 
+                                                     write_content_size=False, 
+                                                     write_checksum=False, write_dict_id=False)
+        if self.mode == "zlib":
+            version = ZLIB_DICTIONARY_VERSION
+            if version not in ZLIB_DICTIONARIES:
+                version = max(ZLIB_DICTIONARIES)
+                print("There's no zlib dictionary version %d, using version %d"%(
+                      ZLIB_DICTIONARY_VERSION, version))
+            self.header = bytes([COMPRESSED_MAGIC, COMPRESSED_ZLIB, version])
+            self.dictionary = ZLIB_DICTIONARIES[version]
+
+        # what compression has saved us, and what it cost
+        self.messages = 0
+        self.compressed = 0
+        self.rawBytes = 0
+        self.sentBytes = 0
+        self.cpuNs = 0
+
+    def compress(self, raw):
+        if self.mode == "zlib":
+            # A 4 KB window and the smallest memLevel are plenty for messages
+            # this size.  The defaults make zlib set up (and clear) hundreds
+            # of KB of state per message, which costs more than the
+            # compression.  The server decompresses with the full 32 KB 
+            # window, which reads anything we send.
+            compressor = zlib.compressobj(9, zlib.DEFLATED, -12, 1, zdict=self.dictionary)
+            return self.header + compressor.compress(raw) + compressor.flush()
+        return self.header + self.zstd.compress(raw)
+
+    # Turn a JSON string into the bytes we'll publish.
+    def encode(self, data):
+        raw = data.encode()
+        payload = raw
+        if self.mode != "none":
+            start = time.process_time_ns()
+            compressed = self.compress(raw)
+            self.cpuNs += time.process_time_ns() - start
+            if len(compressed) < len(raw):
+                payload = compressed
+                self.compressed += 1
+        self.messages += 1
+        self.rawBytes += len(raw)
+        self.sentBytes += len(payload)
+        return payload
+
+    # Compression statistics since the last call.
+    def stats(self):
+        stats = {
+            "mode": self.mode,
+            "messages": self.messages,
+            "compressed": self.compressed,
+            "rawBytes": self.rawBytes,
+            "sentBytes": self.sentBytes,
+            "cpuUs": self.cpuNs // 1000,
+        }
+        self.messages = self.compressed = self.rawBytes = self.sentBytes = self.cpuNs = 0
+        return stats
+
+compressor = PayloadCompressor(COMPRESSION)
+
+# The server's side of the bargain: turn a payload back into JSON text.
+def decodePayload(payload):
+    if payload and payload[0] == SERIES_MAGIC:
+        return json.dumps(decodeSeries(payload), separators=(',', ':'))
+    if not payload or payload[0] != COMPRESSED_MAGIC:
+        return payload.decode()
+    algorithm, version = payload[1], payload[2]
+    if algorithm == COMPRESSED_ZLIB:
+        decompressor = zlib.decompressobj(-15, zdict=ZLIB_DICTIONARIES[version])
+        return (decompressor.decompress(payload[3:]) + decompressor.flush()).decode()
+    raise ValueError("can't decode compression algorithm %d here"%(algorithm))
+
+# Columnar encoding for batched series.  A JSON batch spends most of its
+# bytes repeating timestamps that go up by nearly the same amount every time,
+# and values that barely move.  With batch.encoding set to "columnar", a batch
+# goes out as a compact binary payload instead:
+#
+#     0xFD, format version (1), varint number of series, then per series:
+#         varint sensorIndex, varint sample count, value type byte,
+#         timestamps, values
+#
+# Timestamps are milliseconds.  We send the first one, then the first delta,
+# then just the change in delta (delta-of-delta) for the rest, which is
+# nearly always 0 or close to it.  Values come in one of three types:
+#   0  integers (the 12-bit ADC counts): first value, then deltas
+#   1  decimals (values rounded to a few places): a scale byte p, then the
+#      values times 10**p as integers, first value and deltas
+#   2  anything else: Gorilla-style XOR of each float's bits with the one
+#      before, as a bit stream prefixed with its length in bytes
+# Signed numbers are zigzag encoded, so small negatives stay small, and all
+# numbers are varints.  decodeSeries() turns a payload back into the same
+# {"1": {"t": [...], "v": [...]}} shape as a JSON batch.
+SERIES_MAGIC = 0xFD
+SERIES_VERSION = 1
+SERIES_INTEGERS = 0
+SERIES_DECIMALS = 1
+SERIES_FLOATS = 2
+
+DOUBLE = struct.Struct('>d')
+UINT64 = struct.Struct('>Q')
+
+def putVarint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+def getVarint(data, pos):
+    n = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+def putSigned(out, n):
+    putVarint(out, n * 2 if n >= 0 else -n * 2 - 1)
+
+def getSigned(data, pos):
+    n, pos = getVarint(data, pos)
+    return (n >> 1) if not n & 1 else -((n + 1) >> 1), pos
+
+# integers as first value then deltas
+def putDeltas(out, numbers):
+    previous = 0
+    for n in numbers:
+        putSigned(out, n - previous)
+        previous = n
+
+def getDeltas(data, pos, count):
+    numbers = []
+    n = 0
+    for i in range(count):
+        delta, pos = getSigned(data, pos)
+        n += delta
+        numbers.append(n)
+    return numbers, pos
+
+# Writes bit fields most significant bit first.
+class BitWriter:
+    def __init__(self):
+        self.out = bytearray()
+        self.acc = 0
+        self.bits = 0
+
+    def write(self, value, width):
+        self.acc = (self.acc << width) | value
+        self.bits += width
+        while self.bits >= 8:
+            self.bits -= 8
+            self.out.append((self.acc >> self.bits) & 0xFF)
+        self.acc &= (1 << self.bits) - 1
+
+    def getvalue(self):
+        if self.bits:
+            return bytes(self.out) + bytes([(self.acc << (8 - self.bits)) & 0xFF])
+        return bytes(self.out)
+
+class BitReader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, width):
+        value = 0
+        for i in range(width):
+            byte = self.data[self.pos >> 3]
+            value = (value << 1) | ((byte >> (7 - (self.pos & 7))) & 1)
+            self.pos += 1
+        return value
+
+def putFloats(out, values):
+    writer = BitWriter()
+    previous = UINT64.unpack(DOUBLE.pack(values[0]))[0]
+    writer.write(previous, 64)
+    # the leading and trailing zero counts of the last XOR we described in
+    # full.  Later XORs that fit inside the same window reuse them.
+    lead = trail = -1
+    for value in values[1:]:
+        bits = UINT64.unpack(DOUBLE.pack(value))[0]
+        xor = bits ^ previous
+        previous = bits
+        if xor == 0:
+            writer.write(0, 1)
+            continue
+        newLead = min(64 - xor.bit_length(), 31)
+        newTrail = (xor & -xor).bit_length() - 1
+        if lead >= 0 and newLead >= lead and newTrail >= trail:
+            writer.write(0b10, 2)
+            writer.write(xor >> trail, 64 - lead - trail)
+        else:
+            lead, trail = newLead, newTrail
+            significant = 64 - lead - trail
+            writer.write(0b11, 2)
+            writer.write(lead, 5)
+            # 64 significant bits doesn't fit in 6 bits, so it's sent as 0
+            writer.write(significant & 63, 6)
+            writer.write(xor >> trail, significant)
+    stream = writer.getvalue()
+    putVarint(out, len(stream))
+    out += stream
+
+def getFloats(data, pos, count):
+    length, pos = getVarint(data, pos)
+    reader = BitReader(data[pos:pos + length])
+    previous = reader.read(64)
+    values = [DOUBLE.unpack(UINT64.pack(previous))[0]]
+    lead = trail = 0
+    for i in range(count - 1):
+        if reader.read(1):
+            if reader.read(1):
+                lead = reader.read(5)
+                significant = reader.read(6) or 64
+                trail = 64 - lead - significant
+            previous ^= reader.read(64 - lead - trail) << trail
+        values.append(DOUBLE.unpack(UINT64.pack(previous))[0])
+    return values, pos + length
+
+# Scaled decimals have to stay below this, so they're whole numbers a double
+# holds exactly.  It also keeps value * scale from overflowing to infinity.
+DECIMAL_LIMIT = 2 ** 53
+
+# The smallest number of decimal places that holds every value exactly, or
+# None if they aren't short decimals.  -0.0 would come back as 0.0, so it
+# isn't one.
+def decimalPlaces(values):
+    if not all(map(math.isfinite, values)):
+        return None
+    if 0 in values and any(value == 0 and math.copysign(1.0, value) < 0 for value in values):
+        return None
+    biggest = max(map(abs, values), default=0)
+    for places in range(11):
+        scale = 10 ** places
+        if biggest * scale >= DECIMAL_LIMIT:
+            return None
+        if all(round(value * scale) / scale == value for value in values):
+            return places
+    return None
+
+def encodeSeries(records):
+    out = bytearray([SERIES_MAGIC, SERIES_VERSION])
+    putVarint(out, len(records))
+    for sensorIndex, series in records.items():
+        times = series["t"]
+        values = series["v"]
+        putVarint(out, int(sensorIndex))
+        putVarint(out, len(times))
+
+        places = None
+        if all(isinstance(value, int) for value in values):
+            valueType = SERIES_INTEGERS
+        else:
+            places = decimalPlaces(values)
+            valueType = SERIES_FLOATS if places is None else SERIES_DECIMALS
+        out.append(valueType)
+        if not times:
+            continue
+
+        # timestamps: first, first delta, then delta-of-deltas
+        putSigned(out, times[0])
+        delta = 0
+        for i in range(1, len(times)):
+            newDelta = times[i] - times[i - 1]
+            putSigned(out, newDelta - delta)
+            delta = newDelta
+
+        if valueType == SERIES_INTEGERS:
+            putDeltas(out, values)
+        elif valueType == SERIES_DECIMALS:
+            out.append(places)
+            scale = 10 ** places
+            putDeltas(out, [round(value * scale) for value in values])
+        else:
+            putFloats(out, values)
+    return bytes(out)
+
+def decodeSeries(data):
+    if data[0] != SERIES_MAGIC or data[1] != SERIES_VERSION:
+        raise ValueError("not a version %d series payload"%(SERIES_VERSION))
+    count, pos = getVarint(data, 2)
+    records = {}
+    for i in range(count):
+        sensorIndex, pos = getVarint(data, pos)
+        length, pos = getVarint(data, pos)
+        valueType = data[pos]
+        pos += 1
+        times = []
+        values = []
+        if length:
+            t, pos = getSigned(data, pos)
+            times.append(t)
+            delta = 0
+            for j in range(1, length):
+                deltaOfDelta, pos = getSigned(data, pos)
+                delta += deltaOfDelta
+                t += delta
+                times.append(t)
+            if valueType == SERIES_INTEGERS:
+                values, pos = getDeltas(data, pos, length)
+            elif valueType == SERIES_DECIMALS:
+                scale = 10 ** data[pos]
+                scaled, pos = getDeltas(data, pos + 1, length)
+                values = [n / scale for n in scaled]
+            else:
+                values, pos = getFloats(data, pos, length)
+        records[str(sensorIndex)] = {"t": times, "v": values}
+    return records
+
+# MQTT version 5.  Every records message used to carry the whole 
+# "device/<devkey>/records" topic, which is a big share of a small payload.
+# With MQTT_V5=True we connect with version 5 and give each telemetry topic
+# (records and metrics) a topic alias.  The topic goes out once with its 
+# alias, after that only the two byte alias does.  The broker says how many
+# aliases it takes when we connect, and they only last as long as the 
+# connection, so TopicAliases starts again on every connect.  Telemetry 
+# also carries a message expiry interval of MQTT_MESSAGE_EXPIRY seconds
+# (0 for none), so readings held up by an outage are dropped by the broker
+# rather than delivered long after they stopped being news.  Telemetry is
+# QoS 0, so paho never resends it on a later connection with an alias that
+# connection doesn't know.  A broker that only speaks 3.1.1 turns us down,
+# and then we connect again with 3.1.1 and none of this.
+MQTT_V5 = os.getenv('MQTT_V5', 'True') == 'True'
+MQTT_MESSAGE_EXPIRY = int(os.getenv('MQTT_MESSAGE_EXPIRY', '300'))
+# the most topic aliases we use, whatever the broker would take
+MAX_TOPIC_ALIASES = 8
+# The version 5 reason code for "unsupported protocol version".  paho hands
+# it to on_connect when a 3.1.1 broker turns a version 5 client down, too.
+UNSUPPORTED_PROTOCOL_VERSION = 132
+
+class TopicAliases:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset(None)
+
+    # Start again for a new connection.  properties are the CONNACK's, None
+    # for anything but version 5.
+    def reset(self, properties):
+        with self.lock:
+            self.v5 = properties is not None
+            self.maximum = min(getattr(properties, "TopicAliasMaximum", 0), MAX_TOPIC_ALIASES)
+            # topic -> alias
+            self.aliases = {}
+
+    # Publish telemetry on topic.  It's done under the lock, so a message
+    # that uses an alias can't overtake the one that sets it up.
+    def publish(self, client, topic, data):
+        with self.lock:
+            properties = None
+            sendTopic = topic
+            new = False
+            if self.v5:
+                properties = Properties(PacketTypes.PUBLISH)
+                if MQTT_MESSAGE_EXPIRY > 0:
+                    properties.MessageExpiryInterval = MQTT_MESSAGE_EXPIRY
+                alias = self.aliases.get(topic)
+                if alias is not None:
+                    # the broker knows it, so the alias is enough
+                    sendTopic = ""
+                elif len(self.aliases) < self.maximum:
+                    alias = len(self.aliases) + 1
+                    self.aliases[topic] = alias
+                    new = True
+                if alias is not None:
+                    properties.TopicAlias = alias
+            mmi = client.publish(sendTopic, payload=data, qos=0, retain=False, 
+                                 properties=properties)
+            # if the message that sets the alias up didn't go, the next one
+            # has to try again
+            if new and mmi.rc != mqtt.MQTT_ERR_SUCCESS:
+                del self.aliases[topic]
+            return mmi
+
+topicAliases = TopicAliases()
 
 # Declare the canonical Raspberry Pi routines.  This requires some explanation.  
 # There are two cases when we want to initiate an action and wait for a 
@@ -362,11 +2499,15 @@ def sendTSLData(sensorVals):
 
 # In addition to all that, on_message is called each time the server
 # sends a command.  For now, we just toggle the display each time
-# a command is received.
+# a command is received.  The server can also send several commands in one
+# message; see runCommands.
 
-def on_connect(client, data, flags, rc):
+# properties only come with MQTT version 5
+def on_connect(client, data, flags, rc, properties=None):
+    client.protocolRefused = rc == UNSUPPORTED_PROTOCOL_VERSION
     if rc==0:
         client.connectedFlag = True
+        topicAliases.reset(properties)
         print('client connected properly, rc: '+mqtt.connack_string(rc))
     else:
         client.connectedFlag = False
@@ -374,7 +2515,8 @@ def on_connect(client, data, flags, rc):
     if client.oneAndDone:
         client.keepLooping = False
 
-def on_disconnect(client, data, rc):
+def on_disconnect(client, data, rc, properties=None):
+    topicAliases.reset(None)
     if rc==0:
         print('client disconnected properly, rc: '+mqtt.connack_string(rc))
     else:
@@ -386,68 +2528,426 @@ def on_publish(client, data, mid):
     print('published ', str(mid))
     print()
     
+@profiled
 def on_message(client, userdata, msg):
-    data = msg.payload.decode()
-    print("Message received: "+ data)
-
-    command = json.loads(data)
-    # invert the display so we can see that the command arrived.
-    # when we get real commands, this will get fancier.
-    if client.display.displayIsOn==False:
-        # display is off, turn it on
-        client.display.fill(0xFF)
-        client.display.displayIsOn = True
-    else:
-        client.display.fill(0)
-        client.display.displayIsOn = False
-    client.display.show()
+    print("Message received: " + msg.payload.decode(errors="replace"))
+
+    # paho doesn't catch what a callback raises, and it would take the 
+    # network thread down with it, so a payload we can't read is rejected
+    # here, the same way a bad command in a batch is
+    try:
+        command = json.loads(msg.payload)
+    except (ValueError, RecursionError):
+        print("Command rejected: not JSON")
+        publishResults(client, [{"status": "rejected", "error": "a command must be JSON"}])
+        return
+
+    # several commands at once
+    if isinstance(command, list):
+        runCommands(client, command)
+        return
+
+    # history queries are answered on their own topic and don't count as
+    # commands for the display
+    if isinstance(command, dict) and "q" in command:
+        if command["q"] == "history":
+            if all(isNumber(command.get(key, 0)) for key in ("from", "to")):
+                startHistoryQuery(client, command)
+            else:
+                print("History query rejected: from and to must be numbers")
+        return
+
+    problem = applyCommand(client.display, command)
+    if problem is not None:
+        print("Command rejected: " + problem)
+        return
+    showCommandState(client.display)
 
     resp = {
         str(command["si"]): str(command["c"])
     }
 
-    data = json.dumps(resp)
+    data = profiler.timed("json.dumps", json.dumps, resp)
 
-    r = client.publish("device/%s/records"%(MQTT_DEVKEY), payload=data, qos=0, retain=False)
+    r = profiler.timed("client.publish", topicAliases.publish, client,
+                       "device/%s/records"%(MQTT_DEVKEY), data)
+
+# Carry out one command.  Returns None if it worked, or what was wrong with
+# it.  The display isn't touched here; whoever called us shows the result 
+# with showCommandState.
+def applyCommand(display, command):
+    if not isinstance(command, dict) or "si" not in command or "c" not in command:
+        return "a command needs an si and a c"
+
+    # invert the display so we can see that the command arrived.
+    # when we get real commands, this will get fancier.
+    display.displayIsOn = not display.displayIsOn
+    return None
+
+# Show the state the last command left the display in.  With the dashboard
+# running, the display is inverted in hardware by the dashboard's thread, so
+# the readings stay readable and we never wait for the display here.  
+# Without it, the display is filled or cleared.
+def showCommandState(display):
+    if dashboard is not None:
+        dashboard.setInverted(display.displayIsOn)
+    else:
+        display.fill(0xFF if display.displayIsOn else 0)
+        display.show()
+
+# A batch of commands is a JSON array of them:
+#     [{"si": "3", "c": "1"}, {"si": "10", "c": "0"}, ...]
+# They're carried out in order.  However many there are, the display is 
+# refreshed once and the echoes of the ones that worked go back together in
+# one records message, {"3": "1", "10": "0"}.  If a batch has the same si
+# twice, the echo has the last c.  The result of each command, in the same 
+# order as the batch, goes to device/<devkey>/command:
+#     {"results": [{"si": "3", "status": "applied"}, 
+#                  {"status": "rejected", "error": "..."}, ...]}
+# A message that isn't JSON at all gets a single rejected result there too.
+def runCommands(client, commands):
+    results = []
+    echoes = {}
+    for command in commands:
+        problem = applyCommand(client.display, command)
+        if problem is None:
+            echoes[str(command["si"])] = str(command["c"])
+            results.append({"si": str(command["si"]), "status": "applied"})
+        else:
+            print("Command rejected: " + problem)
+            results.append({"status": "rejected", "error": problem})
+
+    if echoes:
+        showCommandState(client.display)
+        data = profiler.timed("json.dumps", json.dumps, echoes, separators=(',', ':'))
+        profiler.timed("client.publish", topicAliases.publish, client,
+                       "device/%s/records"%(MQTT_DEVKEY), data)
+    publishResults(client, results)
+
+def publishResults(client, results):
+    client.publish("device/%s/command"%(MQTT_DEVKEY), 
+                   payload=json.dumps({"results": results}, separators=(',', ':')), 
+                   qos=1, retain=False)
 
 def sendStatus(sensorVals):
     print("Sending...")
     
-    # gather all the sensor data into sensorVals
-    sendHCPAData(sensorVals)
-    sendMPLData(sensorVals)
-    sendGasData(sensorVals)
-    sendSoilData(sensorVals)
-    sendProximityData(sensorVals)
-    sendTSLData(sensorVals)
-
-    # convert the sensorVals dictionary to a JSON Object
-    data = json.dumps(sensorVals, separators=(',', ':'))
-    
-    # publish that data.
-    mmi = client.publish("device/%s/records"%(MQTT_DEVKEY), payload=data, 
-                        qos=0, retain=False)
+    # grab the config once so the whole cycle sees the same one
+    cfg = config
+    publishSamples(sensorVals, acquireSamples(cfg), cfg)
+
+# Read the sensors.  Returns a list of (timestamp, vals), one for each read
+# routine that produced something.  Values that somebody else read within 
+# STATUS_MAX_AGE come out of the cache instead of the bus.  Disabled sensors
+# are skipped, and so are sensors that aren't due yet when we're sampling 
+# adaptively, are failing or are interrupt driven.
+def acquireSamples(cfg):
+    enabled = cfg["enabledSensors"]
+    samples = []
+    for readRoutine, sensorIndices in SENSOR_READERS:
+        if not any(sensorIndex in enabled for sensorIndex in sensorIndices):
+            continue
+        if readRoutine in interruptRoutines:
+            continue
+        sampler = samplers[readRoutine]
+        now = time.monotonic()
+        if cfg["adaptive"]["enabled"] and not sampler.due(now):
+            continue
+        vals = readSensor(readRoutine, sensorIndices, STATUS_MAX_AGE)
+        if vals is None:
+            # a failed sensor is left out of the records
+            continue
+        sampler.update(vals, now)
+        samples.append((time.time(), vals))
+    return samples
+
+# The cycle and the interrupt watcher both publish, so they take turns.
+publishLock = threading.Lock()
+
+# Record the samples in the history and publish the ones the server wants
+# to hear about.  Values that haven't moved past their deadband since we 
+# last published them are left out.
+def publishSamples(sensorVals, samples, cfg):
+    with publishLock:
+        enabled = cfg["enabledSensors"]
+        batching = cfg["batch"]["maxSamples"] > 1
+        for timestamp, vals in samples:
+            recordHistory(vals, timestamp)
+            passed = {}
+            for sensorIndex, value in vals.items():
+                sampleCounts[sensorIndex] = sampleCounts.get(sensorIndex, 0) + 1
+                if sensorIndex in enabled and outsideDeadband(sensorIndex, value, cfg):
+                    passed[sensorIndex] = value
+            # With batching on, the samples wait in the batcher until there are
+            # enough of them, or the oldest one is old enough.
+            if batching and passed:
+                batcher.add(passed, timestamp)
+            sensorVals.update(passed)
+
+        if time.monotonic() - metricsTime >= METRICS_PERIOD:
+            sendMetrics()
+
+        if batching:
+            if batcher.ready(cfg["batch"], time.time()):
+                publishBatch(cfg)
+            return
+        # batching has just been turned off, so what's still waiting goes now
+        if batcher.oldest is not None:
+            publishBatch(cfg)
+
+        # nothing was due, so there's nothing to tell the server
+        if not sensorVals:
+            return
+        publishRecords(sensorVals)
+
+# Send everything in the batcher to the server.
+def publishBatch(cfg):
+    if cfg["batch"]["encoding"] == "columnar":
+        publishPayload(profiler.timed("encodeSeries", encodeSeries, batcher.take()))
+    else:
+        publishRecords(batcher.take())
+
+# When a config turns batching off, the samples already waiting go out right
+# away, rather than with whenever the next cycle is.
+def flushStrandedBatch():
+    with publishLock:
+        if config["batch"]["maxSamples"] == 1 and batcher.oldest is not None:
+            publishBatch(config)
+
+# Send records to the server.
+def publishRecords(records):
+    # convert the records dictionary to a JSON Object
+    data = profiler.timed("json.dumps", json.dumps, records, separators=(',', ':'))
+
+    # compress it, if that's what we're doing and it helps
+    publishPayload(profiler.timed("compress", compressor.encode, data))
+
+# Publish an encoded payload on the records topic.
+def publishPayload(data):
+    mmi = profiler.timed("client.publish", topicAliases.publish, client,
+                         "device/%s/records"%(MQTT_DEVKEY), data)
     print("Result of attempting to publish sensorVals: %s"%(mqtt.error_string(mmi.rc)))
-    
-# Here's where execution starts.  Get an MQTT client.  We'll use it to
-# send sensor data and receive commands.
-# This is an insecure system.
-# We obtain the devKey and secret strings from your target project on
-# app.gigibits.io. devkey is used as the new mqtt clientID and
-# username.  Secret turns into password. 
-  
-client = mqtt.Client(client_id=MQTT_DEVKEY)
-client.username_pw_set(username=MQTT_DEVKEY,password=MQTT_PASSWORD)
-client.on_connect = on_connect
-client.on_disconnect = on_disconnect
-client.on_message = on_message
-client.on_publish = on_publish
-
-# set up the numeric precision
-getcontext().prec = 5
 
-# This is where we had the call to "breakpoint".  That lets us
-# set breakpoints before the fun stuff happens.
+# Splitting acquisition and publishing.  Normally everything runs in one 
+# process under one GIL: the sensor conversions, JSON encoding, all the 
+# printing and paho's network thread.  With --split-process the sensors are
+# read by a process of their own, which gets its own core.  It keeps the 
+# deadlines and writes every sample into a SampleRing per sensor index in
+# shared memory.  This process reads them back out and does everything else -
+# history, deadbands, batching, publishing and commands - so a slow network 
+# or a TLS handshake can't make us miss a sample.
+#
+# The shared memory holds a control block followed by the rings.  Nothing is
+# locked.  Every field and every ring has exactly one writer, and readers go
+# by sequence counters:
+#   configVersion  written by the publisher when the server sends a new 
+#                  config.  Acquisition then reloads it from CONFIG_FILE.
+#   cycles         written by acquisition once a cycle's samples are in the
+#                  rings.  It goes up last, so when the publisher sees it 
+#                  change, the samples and the fields below are there too.
+#   overruns, skipped, jitter
+#                  the acquisition scheduler's counts, and how late its last
+#                  cycle woke up, in seconds.
+# The rings keep their own writeSeq and per-slot stamps, so the publisher
+# can tell a sample that's been overwritten from one that hasn't.
+SPLIT_RING_CAPACITY = 1024
+# How often the publisher looks for a finished cycle, in seconds.
+SPLIT_POLL_INTERVAL = 0.05
+
+class SplitControl:
+    LAYOUT = struct.Struct('<QQQQd')
+    COUNTS = struct.Struct('<QQd')
+    FIELD = struct.Struct('<Q')
+    CYCLES_OFFSET = 8
+    COUNTS_OFFSET = 16
+
+    def __init__(self, buf):
+        self.buf = buf
+
+    def configVersion(self):
+        return self.FIELD.unpack_from(self.buf, 0)[0]
+
+    def setConfigVersion(self, version):
+        self.FIELD.pack_into(self.buf, 0, version)
+
+    def cycles(self):
+        return self.FIELD.unpack_from(self.buf, self.CYCLES_OFFSET)[0]
+
+    # (overruns, skipped, jitter)
+    def counts(self):
+        return self.COUNTS.unpack_from(self.buf, self.COUNTS_OFFSET)
+
+    # Called by acquisition after the cycle's samples are written.
+    def endCycle(self, scheduler):
+        self.COUNTS.pack_into(self.buf, self.COUNTS_OFFSET, scheduler.overruns,
+                              scheduler.skipped, scheduler.lastJitter)
+        self.FIELD.pack_into(self.buf, self.CYCLES_OFFSET, scheduler.cycles)
+
+# sensorIndex -> SampleRing, laid out in buf after the control block.
+def splitRings(buf, capacity, create):
+    rings = {}
+    size = SampleRing.size(capacity)
+    offset = SplitControl.LAYOUT.size
+    for sensorIndex in ALL_SENSOR_INDICES:
+        ringBuf = buf[offset:offset + size]
+        if create:
+            SampleRing.format(ringBuf, capacity)
+        rings[sensorIndex] = SampleRing(ringBuf, capacity)
+        offset += size
+    return rings
+
+# The acquisition process.  It sets up the bus and the sensors and then 
+# reads them on schedule until the publisher goes away.
+def acquisitionMain(memoryName, capacity, parentPid):
+    global bus
+    from multiprocessing import shared_memory
+
+    memory = shared_memory.SharedMemory(name=memoryName)
+    control = SplitControl(memory.buf)
+    rings = splitRings(memory.buf, capacity, False)
+
+    loadConfig()
+    bus = openBus()
+    for readRoutine, setupRoutine in SENSOR_SETUPS.items():
+        setupSensor(readRoutine)
+
+    period = cyclePeriod(config)
+    scheduler = PeriodicScheduler(period, statusPhase(period))
+    configureSamplers(config)
+    configVersion = control.configVersion()
+    # the publisher can't set our configChanged, so a thread watches the
+    # control block for it
+    def watchConfigVersion():
+        seen = configVersion
+        while True:
+            time.sleep(SPLIT_POLL_INTERVAL)
+            if control.configVersion() != seen:
+                seen = control.configVersion()
+                configChanged.set()
+    threading.Thread(target=watchConfigVersion, daemon=True).start()
+    try:
+        while os.getppid() == parentPid:
+            due = scheduler.wait(configChanged)
+            if control.configVersion() != configVersion:
+                configVersion = control.configVersion()
+                loadConfig()
+                applyConfig(scheduler)
+            if not due:
+                continue
+            for timestamp, vals in acquireSamples(config):
+                for sensorIndex, value in vals.items():
+                    rings[sensorIndex].append(timestamp, value)
+            control.endCycle(scheduler)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # let go of our views of the memory so it can be closed
+        for ring in rings.values():
+            ring.buf.release()
+
+# The publisher's side.  Starts the acquisition process and hands back its
+# samples.  stats() matches PeriodicScheduler.stats() so the metrics look the
+# same either way.
+class SplitAcquisition:
+    def __init__(self, capacity=SPLIT_RING_CAPACITY):
+        import multiprocessing
+        from multiprocessing import shared_memory
+
+        size = SplitControl.LAYOUT.size + len(ALL_SENSOR_INDICES) * SampleRing.size(capacity)
+        self.memory = shared_memory.SharedMemory(create=True, size=size)
+        atexit.register(self.memory.unlink)
+        # a service being stopped gets SIGTERM, which would skip the atexit
+        signal.signal(signal.SIGTERM, lambda signum, frame: exit(0))
+        self.control = SplitControl(self.memory.buf)
+        self.control.setConfigVersion(config["version"])
+        self.rings = splitRings(self.memory.buf, capacity, True)
+        # sensorIndex -> the next sample we haven't seen
+        self.readSeqs = {sensorIndex: 0 for sensorIndex in self.rings}
+        self.cycles = 0
+        self.resetJitter()
+
+        # spawn rather than fork.  paho, the bus guard and the profiler all
+        # have threads, and forking a process with threads is asking for 
+        # trouble.
+        context = multiprocessing.get_context("spawn")
+        self.process = context.Process(target=acquisitionMain, daemon=True,
+                                       args=(self.memory.name, capacity, os.getpid()))
+        self.process.start()
+
+    def resetJitter(self):
+        self.jitterSum = 0.0
+        self.jitterMax = 0.0
+        self.jitterCount = 0
+
+    # Wait for acquisition to finish a cycle, passing on new configs while we
+    # wait, then return the new samples like acquireSamples() does.
+    def waitForSamples(self):
+        while True:
+            if not self.process.is_alive():
+                # it stops cleanly at the end of an I2C replay
+                print("Acquisition process exited, exit code %s"%(self.process.exitcode))
+                exit(0 if self.process.exitcode == 0 else 1)
+            if config["version"] != self.control.configVersion():
+                self.control.setConfigVersion(config["version"])
+            cycles = self.control.cycles()
+            if cycles != self.cycles:
+                break
+            time.sleep(SPLIT_POLL_INTERVAL)
+
+        self.cycles = cycles
+        jitter = self.control.counts()[2]
+        self.jitterSum += jitter
+        self.jitterMax = max(self.jitterMax, jitter)
+        self.jitterCount += 1
+        return self.drain()
+
+    def drain(self):
+        # timestamp -> vals.  Everything one read routine produced has the 
+        # same timestamp, so this puts them back together.
+        samples = {}
+        clockOffset = time.monotonic() - time.time()
+        for sensorIndex, ring in self.rings.items():
+            committed = ring.committed()
+            # if we fell a whole ring behind, the oldest ones are gone
+            for seq in range(max(self.readSeqs[sensorIndex], committed - ring.capacity), committed):
+                sample = ring.read(seq)
+                if sample is None:
+                    continue
+                timestamp, value = sample
+                # the rings hold doubles.  Counts go back to being ints so
+                # the records look the same as they do unsplit.
+                if value.is_integer():
+                    value = int(value)
+                samples.setdefault(timestamp, {})[sensorIndex] = value
+                # so anything here that reads the cache sees the new value
+                sensorCache.put(sensorIndex, value, timestamp + clockOffset)
+            self.readSeqs[sensorIndex] = committed
+        return sorted(samples.items())
+
+    def stats(self):
+        overruns, skipped, jitter = self.control.counts()
+        stats = {
+            "cycles": self.cycles,
+            "overruns": overruns,
+            "skipped": skipped,
+            "jitterMean": round(1000.0 * self.jitterSum / max(self.jitterCount, 1), 3),
+            "jitterMax": round(1000.0 * self.jitterMax, 3),
+        }
+        self.resetJitter()
+        return stats
+    
+# Get an MQTT client, version 5 if v5 is True and 3.1.1 if it isn't.
+def makeClient(v5):
+    protocol = mqtt.MQTTv5 if v5 else mqtt.MQTTv311
+    client = mqtt.Client(client_id=MQTT_DEVKEY, protocol=protocol)
+    client.username_pw_set(username=MQTT_DEVKEY,password=MQTT_PASSWORD)
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    client.on_message = on_message
+    client.on_publish = on_publish
+    client.max_queued_messages_set(MAX_QUEUED_MESSAGES)
+    client.protocolRefused = False
+    return client
 
 # Establish a connection to the broker.  keepLooping tells us
 # whether to continue to look for either a connection or sensor data.
@@ -455,56 +2955,153 @@ getcontext().prec = 5
 # oneAndDone tells us whether we're looking for a connection or sensor
 # data.  Looking for a connection and something appears in on_connect
 # or on_disconnect => exit loop.  Looking for sensor data => always
-# look for more.
-client.keepLooping = True
-client.connectedFlag = False
-client.oneAndDone = True
-
-# try to connect to broker by isssuing the connect command,
-# then looping to wait for a reply.
-client.connect(MQTT_BROKER, MQTT_PORT)
-client.loop_start()
-while client.keepLooping == True:
-    print("Waiting to connect to broker %s"%(MQTT_BROKER))
-    print("Waiting to connect to port %s"%(MQTT_PORT))
-    time.sleep(1)
-client.loop_stop()
-# are we connected?  If not, something's wrong and a message
-# should have been printed in on_connect or on_disconnect.
-if (client.connectedFlag == False):
-    exit(1)
-
-# we're connected to the mqtt broker!  Subscribe to commands from
-# the server.
-client.subscribe('server/%s/command'%(MQTT_DEVKEY), 1)
-
-# setup all the sensors and actuators.
-# Get the bus that we'll use to read sensor data
-bus = smbus.SMBus(1)
-
-client.display = setupDisplay()
-setupMPL()
-setupGas()
-setupSoilData()
-setupProximity()
-setupTSL()
-
-# Remember what state the display is in so we can reliably invert it
-client.display.displayIsOn = False
-client.keepLooping = True
-client.oneAndDone = False
-# Loop through all the sensors.
-client.loop_start()
-
-while True:
-    sendStatus(sensorVals)
-    print()
-    # clear sensorVals so we won't get confused next time through
-    # this loop.
-    sensorVals = {}
-
-    time.sleep(10)
-    
-client.loop_stop()
+# look for more.  Returns True if we're connected.
+def connectBroker(client):
+    client.keepLooping = True
+    client.connectedFlag = False
+    client.oneAndDone = True
+
+    # try to connect to broker by isssuing the connect command,
+    # then looping to wait for a reply.
+    client.connect(MQTT_BROKER, MQTT_PORT)
+    client.loop_start()
+    while client.keepLooping == True:
+        print("Waiting to connect to broker %s"%(MQTT_BROKER))
+        print("Waiting to connect to port %s"%(MQTT_PORT))
+        time.sleep(1)
+    client.loop_stop()
+    return client.connectedFlag
+
+# Command line options.  args starts out with the defaults so the routines
+# above work when this file is imported rather than run (the benchmarks do
+# that).  Running it as a program replaces them with the real command line.
+parser = argparse.ArgumentParser(description="Gigabits Raspberry Pi demo app")
+parser.add_argument("--timing-report", type=float, default=0, metavar="SECONDS",
+                    help="print a per-stage timing report every SECONDS seconds")
+parser.add_argument("--sample-profile", type=float, default=0, metavar="HZ",
+                    help="run the sampling profiler at HZ samples per second")
+parser.add_argument("--publish-timing", action="store_true",
+                    help="add the per-stage timings to the metrics topic")
+parser.add_argument("--split-process", action="store_true",
+                    help="read the sensors in a separate process")
+args = parser.parse_args([])
 
-    
+# Here's where execution starts.  Get an MQTT client.  We'll use it to
+# send sensor data and receive commands.
+# This is an insecure system.
+# We obtain the devKey and secret strings from your target project on
+# app.gigibits.io. devkey is used as the new mqtt clientID and
+# username.  Secret turns into password. 
+#
+# None of this runs when the file is imported, only when it's run.
+if __name__ == "__main__":
+    args = parser.parse_args()
+
+    if args.sample_profile > 0:
+        samplingProfiler = SamplingProfiler(args.sample_profile)
+        samplingProfiler.start()
+    else:
+        samplingProfiler = None
+
+    client = makeClient(MQTT_V5)
+
+    # use the config the server gave us last time, if there is one
+    loadConfig()
+
+    # open the history ring buffers
+    openHistory()
+
+    # This is where we had the call to "breakpoint".  That lets us
+    # set breakpoints before the fun stuff happens.
+
+    # Connect to the broker.  If it doesn't speak MQTT version 5, try again
+    # with 3.1.1.
+    if not connectBroker(client) and client.protocolRefused:
+        print("The broker doesn't support MQTT v5, falling back to 3.1.1")
+        client = makeClient(False)
+        connectBroker(client)
+    # are we connected?  If not, something's wrong and a message
+    # should have been printed in on_connect or on_disconnect.
+    if (client.connectedFlag == False):
+        exit(1)
+
+    # we're connected to the mqtt broker!  Subscribe to commands and 
+    # config updates from the server.
+    client.subscribe('server/%s/command'%(MQTT_DEVKEY), 1)
+    client.message_callback_add('server/%s/config'%(MQTT_DEVKEY), on_config)
+    client.subscribe('server/%s/config'%(MQTT_DEVKEY), 1)
+
+    # setup all the sensors and actuators.
+    if I2C_REPLAY:
+        client.display = NullDisplay()
+    else:
+        client.display = setupDisplay()
+    if args.split_process:
+        # the acquisition process does the bus and the sensors
+        split = SplitAcquisition()
+    else:
+        # Get the bus that we'll use to read sensor data.
+        bus = openBus()
+
+        # A sensor that won't set up is skipped for now and tried again later.
+        for readRoutine, setupRoutine in SENSOR_SETUPS.items():
+            setupSensor(readRoutine)
+
+    # Remember what state the display is in so we can reliably invert it
+    client.display.displayIsOn = False
+    if DASHBOARD and not I2C_REPLAY:
+        dashboard = Dashboard(client.display)
+        dashboard.start()
+    client.keepLooping = True
+    client.oneAndDone = False
+    # Loop through all the sensors.
+    client.loop_start()
+
+    # With adaptive sampling we wake up often and let each sensor decide whether
+    # it's due.  Otherwise every sensor is read once per statusPeriod.
+    # Split up, the acquisition process keeps the schedule and we publish
+    # whatever it read.
+    if args.split_process:
+        scheduler = split
+        if PROXY_INT_PIN or TSL_INT_PIN:
+            print("Interrupt sensing doesn't work with --split-process, polling instead")
+    else:
+        period = cyclePeriod(config)
+        scheduler = PeriodicScheduler(period, statusPhase(period))
+        configureSamplers(config)
+        # sensors with an INT line wired up publish on their own from now on
+        interruptWatcher = startInterruptSensing()
+    configVersion = config["version"]
+    reportTime = time.monotonic()
+
+    while True:
+        if args.split_process:
+            samples = split.waitForSamples()
+            print("Sending...")
+            publishSamples(sensorVals, samples, config)
+        else:
+            # on_config wakes us, so a new config doesn't wait for the end 
+            # of what could be a very long period
+            due = scheduler.wait(configChanged)
+
+            # has the server sent us a new config?
+            if config["version"] != configVersion:
+                configVersion = config["version"]
+                applyConfig(scheduler)
+            if not due:
+                continue
+
+            sendStatus(sensorVals)
+        print()
+        # clear sensorVals so we won't get confused next time through
+        # this loop.
+        sensorVals.clear()
+
+        if args.timing_report > 0 and time.monotonic() - reportTime >= args.timing_report:
+            reportTime = time.monotonic()
+            print(profiler.report())
+            if samplingProfiler is not None:
+                print(samplingProfiler.report())
+            print()
+
+    client.loop_stop()
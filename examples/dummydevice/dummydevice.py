@@ -1,10 +1,13 @@
 #!/usr/bin/env python
 
 import paho.mqtt.client as mqtt
+from paho.mqtt.properties import Properties
+from paho.mqtt.packettypes import PacketTypes
 import random
 import json
 import time
 import os
+import threading
 from dotenv import load_dotenv
 load_dotenv()
 
@@ -13,29 +16,86 @@ MQTT_PORT=int(os.getenv('MQTT_PORT'))
 MQTT_USERNAME=os.getenv('MQTT_USERNAME')
 MQTT_PASSWORD=os.getenv('MQTT_PASSWORD')
 
-def on_connect(client, data, flags, result):
+# MQTT version 5, if the broker speaks it.  The records topic then goes out
+# once as topic alias 1 and after that only the alias does, and records 
+# expire after MQTT_MESSAGE_EXPIRY seconds.  See RPIDemoApp.py for the rest.
+MQTT_V5 = os.getenv('MQTT_V5', 'True') == 'True'
+MQTT_MESSAGE_EXPIRY = int(os.getenv('MQTT_MESSAGE_EXPIRY', '300'))
+UNSUPPORTED_PROTOCOL_VERSION = 132
+RECORDS_ALIAS = 1
+
+def on_connect(client, data, flags, result, properties=None):
+    if result == UNSUPPORTED_PROTOCOL_VERSION:
+        print('client connection refused, the broker does not speak MQTT v5')
+        client.protocolRefused = True
+        return
     print('client connected')
+    with client.aliasLock:
+        client.aliasSet = False
+        client.useAlias = getattr(properties, "TopicAliasMaximum", 0) >= RECORDS_ALIAS
 
-def on_disconnect(client, data, status):
+def on_disconnect(client, data, status, properties=None):
     print('client disconnected')
+    with client.aliasLock:
+        client.aliasSet = False
+        client.useAlias = False
 
 def on_publish(client, data, mid):
     print('published ', str(mid))
 
 def on_message(client, userdata, msg):
-    data = msg.payload.decode()
-    print("Message received: "+ data)
-
-    command = json.loads(data)
-
-    resp = {
-        str(command["si"]): str(command["c"])
-    }
-
-    data = json.dumps(resp)
-
-    r = client.publish("device/%s/records"%(devKey), payload=data, qos=0, retain=False)
-    print(r)
+    print("Message received: " + msg.payload.decode(errors="replace"))
+
+    # an exception here would stop paho's network thread, so anything we
+    # can't use is rejected instead, on device/<devkey>/command like
+    # RPIDemoApp.py does
+    try:
+        command = json.loads(msg.payload)
+    except (ValueError, RecursionError):
+        publishResults(client, [{"status": "rejected", "error": "a command must be JSON"}])
+        return
+
+    # a batch of commands is an array of them.  Echo them all in one record.
+    batch = isinstance(command, list)
+    commands = command if batch else [command]
+
+    resp = {}
+    results = []
+    for command in commands:
+        if not isinstance(command, dict) or "si" not in command or "c" not in command:
+            print("Command rejected: a command needs an si and a c")
+            results.append({"status": "rejected", "error": "a command needs an si and a c"})
+            continue
+        resp[str(command["si"])] = str(command["c"])
+        results.append({"si": str(command["si"]), "status": "applied"})
+
+    if resp:
+        r = publishRecords(client, json.dumps(resp))
+        print(r)
+    if batch:
+        publishResults(client, results)
+
+def publishResults(client, results):
+    client.publish("device/%s/command"%(devKey), payload=json.dumps({"results": results}), 
+                   qos=1, retain=False)
+
+# Publish on the records topic, with the alias and the expiry if we can.
+def publishRecords(client, data):
+    topic = "device/%s/records"%(devKey)
+    if client.v5 == False:
+        return client.publish(topic, payload=data, qos=0, retain=False)
+    properties = Properties(PacketTypes.PUBLISH)
+    if MQTT_MESSAGE_EXPIRY > 0:
+        properties.MessageExpiryInterval = MQTT_MESSAGE_EXPIRY
+    with client.aliasLock:
+        if client.useAlias:
+            properties.TopicAlias = RECORDS_ALIAS
+            if client.aliasSet:
+                topic = ""
+        r = client.publish(topic, payload=data, qos=0, retain=False, properties=properties)
+        if client.useAlias and r.rc == mqtt.MQTT_ERR_SUCCESS:
+            client.aliasSet = True
+    return r
 
 def sendStatus():
     print("Sending...")
@@ -51,7 +111,7 @@ def sendStatus():
 
     data = json.dumps(infoResponse)
 
-    r = client.publish("device/%s/records"%(devKey), payload=data, qos=0, retain=False)
+    r = publishRecords(client, data)
     print(r)
 
 
@@ -68,20 +128,34 @@ def sendStatus():
 
 activeStatus = [False, False, False, False]
 devKey = "Iur8LTvFvR75kcJAMdzr3EJ"
-client = mqtt.Client(client_id="dummyDevice")
-client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
-client.on_connect = on_connect
-client.on_disconnect = on_disconnect
-client.on_message = on_message
-client.on_publish = on_publish
 
-print("Connecting to {}".format(MQTT_BROKER))
+def makeClient(v5):
+    client = mqtt.Client(client_id="dummyDevice", protocol=mqtt.MQTTv5 if v5 else mqtt.MQTTv311)
+    client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+    client.on_connect = on_connect
+    client.on_disconnect = on_disconnect
+    client.on_message = on_message
+    client.on_publish = on_publish
+    client.v5 = v5
+    client.protocolRefused = False
+    client.aliasLock = threading.Lock()
+    client.aliasSet = False
+    client.useAlias = False
+
+    print("Connecting to {}".format(MQTT_BROKER))
+
+    client.connect(MQTT_BROKER, MQTT_PORT)
+    client.subscribe('server/%s/command'%(devKey), 1)
 
-client.connect(MQTT_BROKER, MQTT_PORT)
-client.subscribe('server/%s/command'%(devKey), 1)
+    client.loop_start()
+    return client
 
-client.loop_start()
+client = makeClient(MQTT_V5)
 
 while True:
+    if client.protocolRefused:
+        # try again with 3.1.1
+        client.loop_stop()
+        client = makeClient(False)
     sendStatus()
     time.sleep(3)
@@ -0,0 +1,538 @@
+#!/usr/bin/env python
+
+# A reference ingestion service for the receiving end of the topic contract.
+# Devices publish telemetry and command echoes on device/<devkey>/records;
+# this subscribes to all of them with a wildcard and writes every value to a
+# SQLite database.  It's meant for testing and for small deployments, and for
+# measuring how many devices a box can keep up with.
+#
+# Messages go through three stages:
+#   1. paho's network thread drops each message into the inbox, stamped with
+#      the time it arrived.  That's all it does, so it keeps up.
+#   2. The main loop takes messages out of the inbox in batches of up to
+#      --batch-size (or whatever arrived in --flush-interval seconds) and
+#      hands each batch to a process pool to be decoded into rows.  Decoding
+#      is where the CPU time goes, so the pool gives us every core.
+#   3. Decoded batches are written in the order they were taken, each one
+#      with one executemany and one commit.  Committing a whole batch at a
+#      time (a group commit) is what makes SQLite fast enough.
+#
+# Every payload the devices can send is understood: plain JSON records, JSON
+# batches ({"1": {"t": [...], "v": [...]}}), compressed records (0xFE) and 
+# columnar batches (0xFD).  The decoders are copies of the ones in 
+# RPIDemoApp.py, which imports the Pi hardware libraries and so can't be 
+# imported here.  Keep them in step.
+#
+# Each value becomes one row:
+#     devkey, sensor_index, t, value, received
+# t is when the value was sampled, in milliseconds since the epoch.  Plain
+# records don't say, so for them it's when the message arrived, which is
+# received.  Every --report-period seconds we print the message and row 
+# rates, how many messages are waiting, and the end-to-end lag: the time 
+# from a value being sampled to its row being committed.
+#
+# To see how far a fleet can go, benchmarks/ingestbench.py runs this against
+# the local broker with as many simulated devices as you like.
+#
+# When one box isn't enough, run several with the same --share group.  They
+# connect with MQTT version 5 and subscribe to $share/<group>/<topic>, and 
+# the broker hands each message to just one of them.  A broker that only 
+# speaks 3.1.1 turns version 5 down; then we connect with 3.1.1 and a plain
+# subscription, and every instance gets every message.
+
+import paho.mqtt.client as mqtt
+import argparse
+import collections
+import concurrent.futures
+import json
+import math
+import multiprocessing
+import os
+import sqlite3
+import struct
+import threading
+import time
+import zlib
+from dotenv import load_dotenv
+load_dotenv()
+
+MQTT_BROKER=os.getenv('MQTT_BROKER')
+MQTT_PORT=int(os.getenv('MQTT_PORT', '1883'))
+MQTT_CLIENT_ID=os.getenv('MQTT_CLIENT_ID', 'ingest')
+MQTT_USERNAME=os.getenv('MQTT_USERNAME')
+MQTT_PASSWORD=os.getenv('MQTT_PASSWORD')
+MQTT_V5 = os.getenv('MQTT_V5', 'True') == 'True'
+MQTT_SHARE_GROUP = os.getenv('MQTT_SHARE_GROUP')
+
+# The version 5 reason code for "unsupported protocol version".  paho hands
+# it to on_connect when a 3.1.1 broker turns a version 5 client down, too.
+UNSUPPORTED_PROTOCOL_VERSION = 132
+
+RECORDS_TOPIC = "device/+/records"
+
+# Payload formats, as in RPIDemoApp.py.
+COMPRESSED_MAGIC = 0xFE
+COMPRESSED_ZLIB = 1
+COMPRESSED_ZSTD = 2
+SERIES_MAGIC = 0xFD
+SERIES_VERSION = 1
+SERIES_INTEGERS = 0
+SERIES_DECIMALS = 1
+SERIES_FLOATS = 2
+
+DOUBLE = struct.Struct('>d')
+UINT64 = struct.Struct('>Q')
+
+ZLIB_DICTIONARIES = {
+    1: (b'"t":[' b'"v":[' b'.0,' b'0123456789' b'}},' 
+        + b''.join(b',"%d":'%(i) for i in range(9, 1, -1)) + b'{"1":'),
+}
+
+# zstd dictionaries are files.  ZSTD_DICTIONARY is the one devices use as
+# version ZSTD_DICTIONARY_VERSION.
+ZSTD_DICTIONARY = os.getenv('ZSTD_DICTIONARY')
+ZSTD_DICTIONARY_VERSION = int(os.getenv('ZSTD_DICTIONARY_VERSION', '1'))
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+zstdDecompressors = {}
+
+def zstdDecompressor(version):
+    if version not in zstdDecompressors:
+        if zstandard is None or not ZSTD_DICTIONARY or version != ZSTD_DICTIONARY_VERSION:
+            raise ValueError("no zstd dictionary version %d"%(version))
+        with open(ZSTD_DICTIONARY, "rb") as f:
+            dictionary = zstandard.ZstdCompressionDict(f.read())
+        zstdDecompressors[version] = zstandard.ZstdDecompressor(dict_data=dictionary)
+    return zstdDecompressors[version]
+
+# Columnar batches, copied from RPIDemoApp.py.
+def getVarint(data, pos):
+    n = 0
+    shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+def getSigned(data, pos):
+    n, pos = getVarint(data, pos)
+    return (n >> 1) if not n & 1 else -((n + 1) >> 1), pos
+
+def getDeltas(data, pos, count):
+    numbers = []
+    n = 0
+    for i in range(count):
+        delta, pos = getSigned(data, pos)
+        n += delta
+        numbers.append(n)
+    return numbers, pos
+
+class BitReader:
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def read(self, width):
+        value = 0
+        for i in range(width):
+            byte = self.data[self.pos >> 3]
+            value = (value << 1) | ((byte >> (7 - (self.pos & 7))) & 1)
+            self.pos += 1
+        return value
+
+def getFloats(data, pos, count):
+    length, pos = getVarint(data, pos)
+    reader = BitReader(data[pos:pos + length])
+    previous = reader.read(64)
+    values = [DOUBLE.unpack(UINT64.pack(previous))[0]]
+    lead = trail = 0
+    for i in range(count - 1):
+        if reader.read(1):
+            if reader.read(1):
+                lead = reader.read(5)
+                significant = reader.read(6) or 64
+                trail = 64 - lead - significant
+            previous ^= reader.read(64 - lead - trail) << trail
+        values.append(DOUBLE.unpack(UINT64.pack(previous))[0])
+    return values, pos + length
+
+def decodeSeries(data):
+    if data[0] != SERIES_MAGIC or data[1] != SERIES_VERSION:
+        raise ValueError("not a version %d series payload"%(SERIES_VERSION))
+    count, pos = getVarint(data, 2)
+    records = {}
+    for i in range(count):
+        sensorIndex, pos = getVarint(data, pos)
+        length, pos = getVarint(data, pos)
+        valueType = data[pos]
+        pos += 1
+        times = []
+        values = []
+        if length:
+            t, pos = getSigned(data, pos)
+            times.append(t)
+            delta = 0
+            for j in range(1, length):
+                deltaOfDelta, pos = getSigned(data, pos)
+                delta += deltaOfDelta
+                t += delta
+                times.append(t)
+            if valueType == SERIES_INTEGERS:
+                values, pos = getDeltas(data, pos, length)
+            elif valueType == SERIES_DECIMALS:
+                scale = 10 ** data[pos]
+                scaled, pos = getDeltas(data, pos + 1, length)
+                values = [n / scale for n in scaled]
+            else:
+                values, pos = getFloats(data, pos, length)
+        records[str(sensorIndex)] = {"t": times, "v": values}
+    return records
+
+# Turn a records payload into the {sensorIndex: value} or
+# {sensorIndex: {"t": [...], "v": [...]}} it stands for.
+def decodeRecords(payload):
+    if payload and payload[0] == SERIES_MAGIC:
+        return decodeSeries(payload)
+    if payload and payload[0] == COMPRESSED_MAGIC:
+        algorithm, version = payload[1], payload[2]
+        if algorithm == COMPRESSED_ZLIB:
+            decompressor = zlib.decompressobj(-15, zdict=ZLIB_DICTIONARIES[version])
+            payload = decompressor.decompress(payload[3:]) + decompressor.flush()
+        elif algorithm == COMPRESSED_ZSTD:
+            payload = zstdDecompressor(version).decompress(payload[3:])
+        else:
+            raise ValueError("unknown compression algorithm %d"%(algorithm))
+    records = json.loads(payload)
+    if not isinstance(records, dict):
+        raise ValueError("records must be a JSON object")
+    return records
+
+# SQLite integers are 64 bits, and a bigger Python int makes the insert fail.
+def isInteger(value):
+    return (isinstance(value, int) and not isinstance(value, bool) 
+            and -2**63 <= value < 2**63)
+
+def isValue(value):
+    return isInteger(value) or isinstance(value, (float, str))
+
+# The rows for one message's records.  Raises ValueError if anything in them
+# isn't a sensor value we can store, so a bad message goes in whole or not at
+# all.
+def recordRows(devkey, records, receivedMillis):
+    rows = []
+    for sensorIndex, entry in records.items():
+        if isinstance(entry, dict):
+            times, values = entry.get("t", []), entry.get("v", [])
+            if not isinstance(times, list) or not isinstance(values, list):
+                raise ValueError("t and v must be lists")
+            for t, value in zip(times, values):
+                if not isInteger(t) or not isValue(value):
+                    raise ValueError("bad sample for sensor %s"%(sensorIndex))
+                rows.append((devkey, sensorIndex, t, value, receivedMillis))
+        elif isValue(entry):
+            rows.append((devkey, sensorIndex, receivedMillis, entry, receivedMillis))
+        else:
+            raise ValueError("bad value for sensor %s"%(sensorIndex))
+    return rows
+
+# Decode a batch of (topic, payload, received) messages into rows.  This runs
+# in the worker processes.  Returns the rows and the number of messages we
+# couldn't make sense of.  A mangled payload can make the decoders raise
+# almost anything (zlib and zstd errors, RecursionError from deeply nested
+# JSON, OverflowError from a huge number), and whatever it is only costs us
+# that one message.
+def decodeBatch(messages):
+    rows = []
+    errors = 0
+    for topic, payload, received in messages:
+        devkey = topic.split("/")[1]
+        receivedMillis = int(received * 1000)
+        try:
+            rows.extend(recordRows(devkey, decodeRecords(payload), receivedMillis))
+        except Exception:
+            errors += 1
+    return rows, errors
+
+# Where paho's thread leaves messages for the main loop.
+class Inbox:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.messages = []
+
+    def put(self, topic, payload, received):
+        with self.condition:
+            self.messages.append((topic, payload, received))
+            if len(self.messages) == 1:
+                self.condition.notify()
+
+    # Wait up to timeout seconds for a message, then take up to maxCount.
+    def take(self, maxCount, timeout):
+        with self.condition:
+            if not self.messages:
+                self.condition.wait(timeout)
+            batch = self.messages[:maxCount]
+            del self.messages[:maxCount]
+        return batch
+
+    def depth(self):
+        with self.condition:
+            return len(self.messages)
+
+class RecordStore:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        # The write-ahead log lets readers look at the data while we write,
+        # and with synchronous=NORMAL a commit doesn't wait for the disk.  A
+        # power cut can lose the last few commits but can't corrupt anything.
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS records (
+                               devkey TEXT NOT NULL,
+                               sensor_index TEXT NOT NULL,
+                               t INTEGER NOT NULL,
+                               value,
+                               received INTEGER NOT NULL)""")
+        self.db.execute("""CREATE INDEX IF NOT EXISTS records_by_sensor 
+                               ON records (devkey, sensor_index, t)""")
+        self.db.commit()
+
+    def write(self, rows):
+        with self.db:
+            self.db.executemany("INSERT INTO records VALUES (?, ?, ?, ?, ?)", rows)
+
+    def close(self):
+        self.db.close()
+
+# Message and row counts and lags since the last report.
+class IngestStats:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.totalMessages = 0
+        self.totalRows = 0
+        self.totalErrors = 0
+        self.reset()
+
+    def reset(self):
+        self.since = time.monotonic()
+        self.messages = 0
+        self.rows = 0
+        self.errors = 0
+        # lag of every row, in milliseconds
+        self.lags = []
+
+    def add(self, messages, rows, errors, committed):
+        self.messages += messages
+        self.rows += len(rows)
+        self.errors += errors
+        self.totalMessages += messages
+        self.totalRows += len(rows)
+        self.totalErrors += errors
+        committedMillis = committed * 1000.0
+        self.lags.extend(committedMillis - row[2] for row in rows)
+
+    def percentile(self, lags, fraction):
+        return lags[min(len(lags) - 1, int(math.ceil(fraction * len(lags))) - 1)]
+
+    def summary(self):
+        elapsed = max(time.monotonic() - self.since, 1e-9)
+        summary = {
+            "messagesPerSec": round(self.messages / elapsed, 1),
+            "rowsPerSec": round(self.rows / elapsed, 1),
+            "errors": self.errors,
+        }
+        if self.lags:
+            lags = sorted(self.lags)
+            summary["lagP50"] = round(self.percentile(lags, 0.5), 1)
+            summary["lagP99"] = round(self.percentile(lags, 0.99), 1)
+            summary["lagMax"] = round(lags[-1], 1)
+        return summary
+
+class Ingestor:
+    def __init__(self, db, topic=RECORDS_TOPIC, workers=None, batchSize=1000, 
+                 flushInterval=0.1, shareGroup=None):
+        self.topic = topic
+        self.shareGroup = shareGroup
+        self.batchSize = batchSize
+        self.flushInterval = flushInterval
+        self.inbox = Inbox()
+        self.store = RecordStore(db)
+        self.stats = IngestStats()
+        # The workers are spawned rather than forked, since paho has a thread
+        # running by the time they start and forking a process with threads
+        # is asking for trouble.  With no workers we decode in the main loop,
+        # which is handy for comparison.
+        if workers is None:
+            workers = os.cpu_count()
+        self.workers = workers
+        self.pool = None
+        if workers > 0:
+            self.startPool()
+        # keep every worker busy, with one batch waiting for each
+        self.maxInFlight = max(2 * workers, 1)
+        # (future, message count), oldest first
+        self.pending = collections.deque()
+        self.client = None
+        self.v5 = MQTT_V5
+
+    # The topic filter to subscribe to.  Sharing needs version 5.
+    def subscription(self):
+        if self.shareGroup and self.v5:
+            return "$share/%s/%s"%(self.shareGroup, self.topic)
+        return self.topic
+
+    # properties only come with MQTT version 5
+    def on_connect(self, client, data, flags, rc, properties=None):
+        if rc == 0:
+            print('client connected properly, rc: '+mqtt.connack_string(rc))
+            # subscribe here so we're subscribed again after a reconnect
+            client.subscribe(self.subscription(), 0)
+        elif rc == UNSUPPORTED_PROTOCOL_VERSION and self.v5:
+            print("The broker doesn't support MQTT v5, falling back to 3.1.1")
+            if self.shareGroup:
+                print("Without v5 there are no shared subscriptions; every instance gets every message")
+            client.disconnect()
+            self.v5 = False
+            self.open()
+        else:
+            print('client connection ERROR: '+mqtt.connack_string(rc))
+
+    def on_disconnect(self, client, data, rc, properties=None):
+        print('client disconnected, rc: '+mqtt.connack_string(rc))
+
+    def on_message(self, client, userdata, msg):
+        self.inbox.put(msg.topic, msg.payload, time.time())
+
+    def connect(self, broker, port, clientId=MQTT_CLIENT_ID, username=None, password=None):
+        # instances sharing a subscription can't share a client id too
+        if self.shareGroup:
+            clientId = "%s-%d"%(clientId, os.getpid())
+        self.connection = (broker, port, clientId, username, password)
+        self.open()
+
+    def open(self):
+        broker, port, clientId, username, password = self.connection
+        protocol = mqtt.MQTTv5 if self.v5 else mqtt.MQTTv311
+        self.client = mqtt.Client(client_id=clientId, protocol=protocol)
+        if username:
+            self.client.username_pw_set(username=username, password=password)
+        self.client.on_connect = self.on_connect
+        self.client.on_disconnect = self.on_disconnect
+        self.client.on_message = self.on_message
+        self.client.connect(broker, port)
+        self.client.loop_start()
+
+    # One trip round the loop: take a batch, start decoding it, and write
+    # every batch that's been decoded.
+    def step(self):
+        batch = self.inbox.take(self.batchSize, self.flushInterval)
+        if batch:
+            if self.pool is None:
+                self.commit(decodeBatch(batch), len(batch))
+            else:
+                self.pending.append((self.submit(batch), len(batch)))
+        # write in order.  If too many are in flight, wait for the oldest.
+        while self.pending and (self.pending[0][0].done() or 
+                                len(self.pending) > self.maxInFlight):
+            future, count = self.pending.popleft()
+            try:
+                decoded = future.result()
+            except Exception as err:
+                # a worker died under it; the batch is lost, we aren't
+                print("Lost a batch of %d messages: %r"%(count, err))
+                decoded = ([], count)
+            self.commit(decoded, count)
+
+    def startPool(self):
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    # Hand a batch to the pool.  A worker that dies breaks the whole pool, so
+    # then we start a new one.
+    def submit(self, batch):
+        try:
+            return self.pool.submit(decodeBatch, batch)
+        except concurrent.futures.BrokenExecutor:
+            print("The decoding pool broke, starting a new one")
+            self.pool.shutdown(wait=False)
+            self.startPool()
+            return self.pool.submit(decodeBatch, batch)
+
+    def commit(self, decoded, count):
+        rows, errors = decoded
+        if rows:
+            self.store.write(rows)
+        self.stats.add(count, rows, errors, time.time())
+
+    # Run until duration seconds are up (or forever), printing a report 
+    # every reportPeriod seconds.
+    def run(self, duration=None, reportPeriod=5.0):
+        start = time.monotonic()
+        reportTime = start
+        while duration is None or time.monotonic() - start < duration:
+            self.step()
+            if reportPeriod and time.monotonic() - reportTime >= reportPeriod:
+                reportTime = time.monotonic()
+                self.report()
+
+    # Finish the batches that are still being decoded.
+    def drain(self):
+        while self.inbox.depth() or self.pending:
+            self.step()
+
+    def report(self):
+        summary = self.stats.summary()
+        self.stats.reset()
+        line = "%.1f msgs/s, %.1f rows/s, backlog %d"%(summary["messagesPerSec"], 
+                                                      summary["rowsPerSec"], 
+                                                      self.inbox.depth() + len(self.pending))
+        if "lagP50" in summary:
+            line += ", lag p50 %.1f ms, p99 %.1f ms, max %.1f ms"%(summary["lagP50"], 
+                                                                   summary["lagP99"], 
+                                                                   summary["lagMax"])
+        if summary["errors"]:
+            line += ", %d bad messages"%(summary["errors"])
+        print(line)
+        return summary
+
+    def stop(self):
+        if self.client is not None:
+            self.client.loop_stop()
+            self.client.disconnect()
+        if self.pool is not None:
+            self.pool.shutdown()
+        self.store.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gigabits records ingestion")
+    parser.add_argument("--db", default="records.db",
+                        help="the SQLite database to write to")
+    parser.add_argument("--topic", default=RECORDS_TOPIC,
+                        help="the topic filter to subscribe to")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                        help="decoding processes; 0 decodes in the main process")
+    parser.add_argument("--batch-size", type=int, default=1000,
+                        help="most messages decoded and committed together")
+    parser.add_argument("--flush-interval", type=float, default=0.1, metavar="SECONDS",
+                        help="longest a message waits for its batch to fill up")
+    parser.add_argument("--report-period", type=float, default=5.0, metavar="SECONDS",
+                        help="how often to print the rates and lag")
+    parser.add_argument("--share", default=MQTT_SHARE_GROUP, metavar="GROUP",
+                        help="share the subscription with the other instances in GROUP")
+    args = parser.parse_args()
+
+    ingestor = Ingestor(args.db, args.topic, args.workers, args.batch_size, 
+                        args.flush_interval, args.share)
+    ingestor.connect(MQTT_BROKER, MQTT_PORT, MQTT_CLIENT_ID, MQTT_USERNAME, MQTT_PASSWORD)
+    try:
+        ingestor.run(reportPeriod=args.report_period)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        ingestor.stop()